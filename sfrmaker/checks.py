@@ -1,7 +1,7 @@
 import numpy as np
 import pandas as pd
 
-from sfrmaker.routing import find_path, make_graph
+from sfrmaker.routing import make_graph, RoutingGraph
 
 
 def valid_rnos(rnos):
@@ -33,14 +33,10 @@ def valid_nsegs(nsegs, outsegs=None, increasing=True):
     if increasing:
         assert outsegs is not None
         graph = make_graph(nsegs, outsegs, one_to_many=False)
-        monotonic = []
-        for s in nsegs:
-            try:
-                seg_sequence = find_path(graph.copy(), s)[:-1]  # last number is 0 for outlet
-            except:
-                j=2
-            monotonic.append(np.all(np.diff(np.array(seg_sequence)) > 0))
-        monotonic = np.all(monotonic)
+        # numbering increases along every path
+        # if it increases across every connection between segments
+        monotonic = np.all([outseg > seg for seg, outseg in graph.items()
+                            if outseg in graph])
         return consecutive_and_onebased & monotonic
     else:
         return consecutive_and_onebased
@@ -160,12 +156,7 @@ def routing_is_circular(fromid, toid):
     toid = np.atleast_1d(toid)
 
     graph = make_graph(fromid, toid, one_to_many=False)
-    paths = {fid: find_path(graph, fid) for fid in graph.keys()}
-    # a fromid should not appear more than once in its sequence
-    for k, v in paths.items():
-        if v.count(k) > 1:
-            return True
-    return False
+    return RoutingGraph(graph).is_circular
 
 
 def same_sfr_numbering(reach_data1, reach_data2):
@@ -1,13 +1,665 @@
 """Methods related to sampling and smoothing elevations."""
+import hashlib
+import os
+import sqlite3
 import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 
 import numpy as np
+import rasterio
+from rasterio import features as rio_features
+from rasterio.windows import Window
+from shapely import wkb
+from shapely.geometry import box
 
-from sfrmaker.routing import get_nextupsegs, get_upsegs, make_graph
+from sfrmaker.gis import intersect_strtree
+from sfrmaker.routing import get_nextupsegs, get_upsegs, make_graph, RoutingGraph
 
 
-def smooth_elevations(fromids, toids, elevations, start_elevations=None):  # elevup, elevdn):
+def zonal_statistics(features, raster, stats='min', all_touched=False,
+                     block_size=4096):
+    """Compute statistics of raster values within polygon features.
+    A faster alternative to ``rasterstats.zonal_stats`` for many features:
+    the raster is opened once and read in blocks of rows
+    (of about block_size**2 pixels), and
+    all of the features in each block are rasterized at once
+    into an array of feature labels. Features that overlap
+    are rasterized in separate passes. The statistics for all features
+    are then computed together from the labeled pixel values.
+
+    Parameters
+    ----------
+    features : sequence of shapely Polygons
+        Must be in the same coordinate reference system as the raster.
+    raster : str or pathlike
+        Path to a raster dataset (only the first band is sampled).
+    stats : str or list of str
+        Statistics to compute. Any of 'min', 'max', 'mean', 'std',
+        'sum', 'count', 'median', or 'percentile_<q>' (e.g. 'percentile_10').
+        Multiple statistics can also be specified as a single
+        space-delimited string. By default, 'min'.
+    all_touched : bool
+        If True, include all pixels touched by each feature;
+        if False (default), include only pixels with centers
+        inside each feature.
+    block_size : int
+        The raster is read in blocks of rows with
+        about block_size**2 pixels. By default, 4096.
+
+    Returns
+    -------
+    results : list of dicts
+        Statistics for each feature, as with ``rasterstats.zonal_stats``.
+        Statistics are None (count is 0) for features
+        that don't contain any valid raster values.
+    """
+    if isinstance(stats, str):
+        stats = stats.split()
+    features = list(features)
+    nfeatures = len(features)
+    labels = []
+    values = []
+    with rasterio.open(raster) as src:
+        # pixel extent of each feature (padded by one pixel)
+        bounds = np.array([g.bounds for g in features]).reshape(-1, 4)
+        inverse = ~src.transform
+        cols1, rows1 = inverse * (bounds[:, 0], bounds[:, 3])
+        cols2, rows2 = inverse * (bounds[:, 2], bounds[:, 1])
+        col_off = np.floor(np.minimum(cols1, cols2)).astype(int) - 1
+        col_end = np.ceil(np.maximum(cols1, cols2)).astype(int) + 1
+        row_off = np.floor(np.minimum(rows1, rows2)).astype(int) - 1
+        row_end = np.ceil(np.maximum(rows1, rows2)).astype(int) + 1
+        col_off, col_end = np.clip([col_off, col_end], 0, src.width)
+        row_off, row_end = np.clip([row_off, row_end], 0, src.height)
+        on_raster = (col_end > col_off) & (row_end > row_off)
+
+        # assign features with overlapping extents to different passes
+        pixel_extents = [box(c0, r0, c1, r1) for c0, r0, c1, r1
+                         in zip(col_off, row_off, col_end, row_end)]
+        overlaps = intersect_strtree(pixel_extents, pixel_extents)
+        passes = np.full(nfeatures, -1)
+        for i in np.flatnonzero(on_raster):
+            used = {passes[j] for j in overlaps[i]}
+            passes[i] = min(set(range(len(used) + 1)).difference(used))
+
+        if on_raster.any():
+            c0, c1 = col_off[on_raster].min(), col_end[on_raster].max()
+            r0, r1 = row_off[on_raster].min(), row_end[on_raster].max()
+        else:
+            c0 = c1 = r0 = r1 = 0
+        # limit the number of pixels (not rows) in each block,
+        # so that memory use doesn't depend on the extent of the features
+        rows_per_block = max(1, block_size**2 // max(c1 - c0, 1))
+        for block_start in range(r0, r1, rows_per_block):
+            block_end = min(block_start + rows_per_block, r1)
+            window = Window(c0, block_start, c1 - c0, block_end - block_start)
+            data = src.read(1, window=window)
+            valid = np.ones(data.shape, dtype=bool)
+            if src.nodata is not None:
+                valid &= data != src.nodata
+            if np.issubdtype(data.dtype, np.floating):
+                valid &= ~np.isnan(data)
+            in_block = on_raster & (row_off < block_end) & (row_end > block_start)
+            for pass_number in np.unique(passes[in_block]):
+                inds = np.flatnonzero(in_block & (passes == pass_number))
+                # burn the feature positions into the block (0 is background)
+                burned = rio_features.rasterize(
+                    ((features[i], i + 1) for i in inds),
+                    out_shape=data.shape,
+                    transform=src.window_transform(window),
+                    fill=0, all_touched=all_touched, dtype='int32')
+                mask = (burned > 0) & valid
+                labels.append(burned[mask] - 1)
+                values.append(data[mask].astype(float))
+    if len(labels) > 0:
+        labels = np.concatenate(labels)
+        values = np.concatenate(values)
+    else:
+        labels = np.array([], dtype=int)
+        values = np.array([], dtype=float)
+
+    # compute the statistics for all features at once
+    count, results = _labeled_statistics(labels, values, nfeatures, stats)
+
+    has_values = count > 0
+    output = []
+    for i in range(nfeatures):
+        feature_stats = {}
+        for stat in stats:
+            if stat == 'count':
+                feature_stats[stat] = int(count[i])
+            elif has_values[i]:
+                feature_stats[stat] = float(results[stat][i])
+            else:
+                feature_stats[stat] = None
+        output.append(feature_stats)
+    return output
+
+
+def zonal_statistics_parallel(features, raster, stats='min', all_touched=False,
+                              function=zonal_statistics, n_workers=None, executor=None):
+    """Compute statistics of raster values within polygon features,
+    using a pool of worker processes. The features are sorted from north
+    to south (by their upper bounds) and split into contiguous chunks,
+    so that each worker samples a compact band of the raster.
+    Statistics for each feature don't depend on the other features,
+    so the results are the same as calling ``function`` with all of the features.
+
+    Parameters
+    ----------
+    features : sequence of shapely Polygons
+        Must be in the same coordinate reference system as the raster.
+    raster : str or pathlike
+        Path to a raster dataset (only the first band is sampled).
+    stats : str or list of str
+        Statistics to compute (see :func:`zonal_statistics`). By default, 'min'.
+    all_touched : bool
+        See :func:`zonal_statistics`. By default, False.
+    function : callable
+        Function for sampling each chunk of features, with the same call
+        signature as :func:`zonal_statistics` (for example, ``rasterstats.zonal_stats``).
+        Must be importable by the worker processes. By default, :func:`zonal_statistics`.
+    n_workers : int, optional
+        Number of worker processes. By default, None (``os.cpu_count()``).
+    executor : concurrent.futures.Executor, optional
+        Executor instance (with a ``submit`` method) to use instead of
+        creating a :class:`concurrent.futures.ProcessPoolExecutor`
+        with ``n_workers``. By default, None.
+
+    Returns
+    -------
+    results : list of dicts
+        Statistics for each feature, as with ``rasterstats.zonal_stats``.
     """
+    features = list(features)
+    if len(features) == 0:
+        return []
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    tops = np.array([g.bounds[3] for g in features])
+    order = np.argsort(-tops, kind='stable')
+    # a few chunks per worker, to even out the load
+    chunks = np.array_split(order, min(len(features), n_workers * 4))
+    print('computing zonal statistics for {:,d} features in {} chunks...'.format(
+        len(features), len(chunks)))
+
+    shutdown = False
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        shutdown = True
+    try:
+        futures = [executor.submit(_zonal_statistics_chunk,
+                                   [features[i].wkb for i in chunk], raster,
+                                   stats, all_touched, function)
+                   for chunk in chunks]
+        # reassemble in the original order
+        output = [None] * len(features)
+        for chunk, future in zip(chunks, futures):
+            for i, feature_stats in zip(chunk, future.result()):
+                output[i] = feature_stats
+    finally:
+        if shutdown:
+            executor.shutdown()
+    return output
+
+
+def _zonal_statistics_chunk(feature_wkbs, raster, stats, all_touched, function):
+    """Worker function for :func:`zonal_statistics_parallel`,
+    with features passed as WKB."""
+    features = [wkb.loads(g) for g in feature_wkbs]
+    return list(function(features, raster, stats=stats, all_touched=all_touched))
+
+
+class ZonalStatisticsCache:
+    """Persistent cache of zonal statistics, stored in a local
+    SQLite database. Statistics are stored for each feature
+    under a key made from a hash of the feature geometry
+    (well-known binary), the raster (absolute path, modification time
+    and size), and the ``all_touched`` setting, so that
+    repeated runs (for example, while iterating on a model) only
+    sample features that are new or have changed. Buffered features
+    have different geometries for different buffer distances,
+    so the buffer distance is part of the key implicitly.
+
+    Parameters
+    ----------
+    filename : str or pathlike
+        SQLite database file for the cache. Created if it doesn't exist.
+
+    Attributes
+    ----------
+    hits : int
+        Number of features found in the cache (for the last call to
+        :meth:`zonal_statistics`).
+    misses : int
+        Number of features sampled from the raster (for the last call to
+        :meth:`zonal_statistics`).
+    """
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.hits = 0
+        self.misses = 0
+        with closing(sqlite3.connect(self.filename)) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS zonal_statistics '
+                         '(key TEXT, stat TEXT, value REAL, PRIMARY KEY (key, stat))')
+
+    @staticmethod
+    def _get_raster_id(raster, all_touched=False):
+        path = os.path.normpath(os.path.abspath(raster))
+        stat = os.stat(path)
+        return '{}|{}|{}|{}'.format(path, stat.st_mtime_ns, stat.st_size,
+                                    bool(all_touched))
+
+    def get_keys(self, features, raster, all_touched=False):
+        """Get the cache keys for a sequence of features sampled from a raster."""
+        raster_id = self._get_raster_id(raster, all_touched).encode()
+        return [hashlib.sha1(raster_id + g.wkb).hexdigest() for g in features]
+
+    def zonal_statistics(self, features, raster, stats='min', all_touched=False,
+                         function=zonal_statistics, chunksize=500):
+        """Get zonal statistics for features from the cache,
+        sampling only the features (or statistics) that aren't
+        in the cache yet, and adding them to the cache.
+
+        Parameters
+        ----------
+        features : sequence of shapely Polygons
+            Must be in the same coordinate reference system as the raster.
+        raster : str or pathlike
+            Path to a raster dataset.
+        stats : str or list of str
+            Statistics to compute (see :func:`zonal_statistics`). By default, 'min'.
+        all_touched : bool
+            See :func:`zonal_statistics`. By default, False.
+        function : callable
+            Function for sampling features that aren't in the cache,
+            with the same call signature as :func:`zonal_statistics`
+            (for example, ``rasterstats.zonal_stats``).
+            By default, :func:`zonal_statistics`.
+        chunksize : int
+            Number of keys to query from the database at a time.
+
+        Returns
+        -------
+        results : list of dicts
+            Statistics for each feature, as with ``rasterstats.zonal_stats``.
+        """
+        if isinstance(stats, str):
+            stats = stats.split()
+        features = list(features)
+        keys = self.get_keys(features, raster, all_touched=all_touched)
+        unique_keys = list(dict.fromkeys(keys))
+        cached = {}
+        with closing(sqlite3.connect(self.filename)) as conn, conn:
+            for start in range(0, len(unique_keys), chunksize):
+                chunk = unique_keys[start:start + chunksize]
+                query = ('SELECT key, stat, value FROM zonal_statistics '
+                         'WHERE key IN ({})'.format(','.join('?' * len(chunk))))
+                for key, stat, value in conn.execute(query, chunk):
+                    cached.setdefault(key, {})[stat] = value
+
+            # sample the features that don't have all of the statistics
+            missing = [k for k in unique_keys
+                       if not set(stats).issubset(cached.get(k, {}))]
+            self.hits = len(unique_keys) - len(missing)
+            self.misses = len(missing)
+            if len(missing) > 0:
+                first_feature = dict(zip(reversed(keys), reversed(features)))
+                results = function([first_feature[k] for k in missing], raster,
+                                   stats=stats, all_touched=all_touched)
+                rows = []
+                for key, feature_stats in zip(missing, results):
+                    for stat in stats:
+                        value = feature_stats[stat]
+                        value = None if value is None else float(value)
+                        cached.setdefault(key, {})[stat] = value
+                        rows.append((key, stat, value))
+                conn.executemany('INSERT OR REPLACE INTO zonal_statistics '
+                                 '(key, stat, value) VALUES (?, ?, ?)', rows)
+        print('zonal statistics cache ({}): {:,d} hits, {:,d} misses'.format(
+            self.filename, self.hits, self.misses))
+
+        output = []
+        for key in keys:
+            feature_stats = {}
+            for stat in stats:
+                value = cached[key][stat]
+                if stat == 'count' and value is not None:
+                    value = int(value)
+                feature_stats[stat] = value
+            output.append(feature_stats)
+        return output
+
+
+def grid_statistics(raster, grid, stats='min', block_size=4096):
+    """Compute statistics of raster values within each cell of a
+    structured model grid, for the whole grid at once.
+    A raster pixel is included in a cell if its center is
+    inside of the cell (as with ``all_touched=False``
+    in :func:`zonal_statistics`).
+
+    If the grid is uniform, unrotated and aligned with the raster
+    (with cells that are an integer number of pixels on a side),
+    the statistics are computed by reading windows of the raster
+    that cover blocks of model rows, and reshaping them so that the
+    pixels in each cell are along one axis. Otherwise, the
+    pixel centers are located in the grid analytically
+    from the row and column spacing, and the statistics
+    are computed from the pixel values grouped by cell.
+
+    Parameters
+    ----------
+    raster : str or pathlike
+        Path to a raster dataset (only the first band is sampled).
+        Must be in the same coordinate reference system as the grid.
+    grid : sfrmaker.StructuredGrid
+        Structured grid with xul, yul, and either uniform (dx, dy) or
+        rectilinear (delr, delc) spacing (see :attr:`~sfrmaker.grid.StructuredGrid.lattice`).
+    stats : str or list of str
+        Statistics to compute. Any of 'min', 'max', 'mean', 'std',
+        'sum', 'count', 'median', or 'percentile_<q>' (e.g. 'percentile_10').
+        Multiple statistics can also be specified as a single
+        space-delimited string. By default, 'min'.
+    block_size : int
+        The raster is read in blocks of rows with
+        about block_size**2 pixels. By default, 4096.
+
+    Returns
+    -------
+    results : dict
+        (nrow, ncol) arrays of each statistic, keyed by statistic.
+        Values are nan (count is 0) for cells that don't contain any
+        valid raster values.
+    """
+    if isinstance(stats, str):
+        stats = stats.split()
+    for stat in stats:
+        if stat not in {'min', 'max', 'mean', 'std', 'sum', 'count', 'median'} and \
+                not stat.startswith('percentile_'):
+            raise ValueError('Unsupported statistic: {}'.format(stat))
+    lattice = grid.lattice
+    if lattice is None:
+        raise ValueError('Computing raster statistics by cell requires a StructuredGrid '
+                         'with xul, yul and either dx and dy or delr and delc.')
+    xedges, yedges, xul, yul, rotation = lattice
+    nrow, ncol = len(yedges) - 1, len(xedges) - 1
+
+    with rasterio.open(raster) as src:
+        aligned = _get_aligned_block_shape(src.transform, xedges, yedges, xul, yul, rotation)
+        if aligned is not None:
+            results = _aligned_grid_statistics(src, stats, nrow, ncol,
+                                               *aligned, block_size=block_size)
+        else:
+            blocks = _label_pixels_by_cell(src, xedges, yedges, xul, yul, rotation,
+                                           block_size=block_size)
+            count, results = _reduce_labeled_blocks(blocks, nrow * ncol, stats)
+            results = {stat: results[stat].reshape(nrow, ncol).astype(float)
+                       for stat in stats}
+            results['count'] = count.reshape(nrow, ncol)
+    count = results['count']
+    for stat in stats:
+        if stat != 'count':
+            results[stat][count == 0] = np.nan
+    return {stat: results[stat] for stat in stats}
+
+
+def _get_aligned_block_shape(transform, xedges, yedges, xul, yul, rotation, tol=1e-6):
+    """If a uniform grid is unrotated and aligned with a raster,
+    with cells that are an integer number of pixels on a side, return
+    the row and column offsets of the grid origin in the raster, and the
+    number of pixel rows and columns in each cell. Otherwise, return None.
+    """
+    if rotation != 0 or transform.b != 0 or transform.d != 0 or \
+            transform.a <= 0 or transform.e >= 0:
+        return
+    delr, delc = np.diff(xedges), np.diff(yedges)
+    if not np.allclose(delr, delr[0]) or not np.allclose(delc, delc[0]):
+        return
+    values = np.array([delc[0] / -transform.e, delr[0] / transform.a,
+                       (transform.f - yul) / -transform.e,
+                       (xul - transform.c) / transform.a])
+    rounded = np.round(values)
+    if not np.allclose(values, rounded, atol=tol) or np.any(rounded[:2] < 1):
+        return
+    pixels_per_row, pixels_per_col, row_off, col_off = rounded.astype(int)
+    return row_off, col_off, pixels_per_row, pixels_per_col
+
+
+def _aligned_grid_statistics(src, stats, nrow, ncol, row_off, col_off,
+                             pixels_per_row, pixels_per_col, block_size=4096):
+    """Compute grid cell statistics from an aligned raster
+    (see :func:`_get_aligned_block_shape`), by reading the raster
+    for blocks of model rows (of about block_size**2 pixels)
+    and reshaping the pixels into cells."""
+    results = {stat: np.full((nrow, ncol), np.nan) for stat in stats}
+    results['count'] = np.zeros((nrow, ncol), dtype=int)
+    width = ncol * pixels_per_col
+    # limit the number of pixels (not rows) in each block,
+    # so that memory use doesn't depend on the raster width
+    rows_per_block = max(1, block_size**2 // (pixels_per_row * width))
+    for i0 in range(0, nrow, rows_per_block):
+        i1 = min(i0 + rows_per_block, nrow)
+        # window of the raster covering these model rows;
+        # pixels outside of the raster are filled with nan
+        r0 = row_off + i0 * pixels_per_row
+        r1 = row_off + i1 * pixels_per_row
+        data = np.full((r1 - r0, width), np.nan)
+        rr0, rr1 = max(r0, 0), min(r1, src.height)
+        cc0, cc1 = max(col_off, 0), min(col_off + width, src.width)
+        if rr1 > rr0 and cc1 > cc0:
+            values = src.read(1, window=Window(cc0, rr0, cc1 - cc0, rr1 - rr0)).astype(float)
+            if src.nodata is not None:
+                values[values == src.nodata] = np.nan
+            data[rr0 - r0:rr1 - r0, cc0 - col_off:cc1 - col_off] = values
+        # (model rows, model columns, pixels in each cell)
+        cells = data.reshape(i1 - i0, pixels_per_row, ncol, pixels_per_col)
+        cells = cells.transpose(0, 2, 1, 3).reshape(i1 - i0, ncol, -1)
+        count = np.sum(~np.isnan(cells), axis=-1)
+        results['count'][i0:i1] = count
+        has_values = count > 0
+        cells = cells[has_values]
+        for stat in stats:
+            if stat == 'count':
+                continue
+            elif stat == 'min':
+                result = np.nanmin(cells, axis=-1)
+            elif stat == 'max':
+                result = np.nanmax(cells, axis=-1)
+            elif stat == 'mean':
+                result = np.nanmean(cells, axis=-1)
+            elif stat == 'std':
+                result = np.nanstd(cells, axis=-1)
+            elif stat == 'sum':
+                result = np.nansum(cells, axis=-1)
+            else:
+                q = 50. if stat == 'median' else float(stat.split('_')[1])
+                result = np.nanpercentile(cells, q, axis=-1)
+            results[stat][i0:i1][has_values] = result
+    return results
+
+
+def _label_pixels_by_cell(src, xedges, yedges, xul, yul, rotation, block_size=4096):
+    """Locate the raster pixel centers in a structured grid,
+    reading the raster in blocks of about block_size**2 pixels.
+    For each block, yield the grid cell (node) number and value of each
+    valid pixel inside of the grid."""
+    # raster window covering the grid
+    theta = np.radians(rotation)
+    x = np.array([0, xedges[-1], xedges[-1], 0])
+    y = np.array([0, 0, yedges[-1], yedges[-1]])
+    cols, rows = ~src.transform * (xul + x * np.cos(theta) + y * np.sin(theta),
+                                   yul + x * np.sin(theta) - y * np.cos(theta))
+    c0, c1 = np.clip([int(np.floor(cols.min())), int(np.ceil(cols.max()))], 0, src.width)
+    r0, r1 = np.clip([int(np.floor(rows.min())), int(np.ceil(rows.max()))], 0, src.height)
+    ncol = len(xedges) - 1
+    # limit the number of pixels (not rows) in each block,
+    # so that memory use doesn't depend on the raster width
+    rows_per_block = max(1, block_size**2 // max(c1 - c0, 1))
+    for block_start in range(r0, r1, rows_per_block):
+        block_end = min(block_start + rows_per_block, r1)
+        window = Window(c0, block_start, c1 - c0, block_end - block_start)
+        data = src.read(1, window=window).astype(float)
+        if src.nodata is not None:
+            data[data == src.nodata] = np.nan
+        # pixel centers, in grid coordinates
+        # (distances along the rows and down the columns from the upper left corner)
+        pixel_cols, pixel_rows = np.meshgrid(np.arange(c0, c1) + 0.5,
+                                             np.arange(block_start, block_end) + 0.5)
+        px, py = src.transform * (pixel_cols.ravel(), pixel_rows.ravel())
+        dx, dy = px - xul, py - yul
+        gx = dx * np.cos(theta) + dy * np.sin(theta)
+        gy = dx * np.sin(theta) - dy * np.cos(theta)
+        j = np.searchsorted(xedges, gx, side='right') - 1
+        i = np.searchsorted(yedges, gy, side='right') - 1
+        data = data.ravel()
+        valid = (j >= 0) & (j < ncol) & (i >= 0) & (i < len(yedges) - 1) & ~np.isnan(data)
+        yield i[valid] * ncol + j[valid], data[valid]
+
+
+def _reduce_labeled_blocks(blocks, nlabels, stats):
+    """Compute statistics of values grouped by integer labels
+    (see :func:`_labeled_statistics`), from a sequence of (labels, values)
+    blocks. The count, min, max, sum, mean and std are combined
+    block by block; only the values needed for medians and percentiles
+    are kept for all of the blocks.
+    """
+    percentile_stats = [stat for stat in stats
+                        if stat == 'median' or stat.startswith('percentile_')]
+    count = np.zeros(nlabels, dtype=int)
+    minimum = np.full(nlabels, np.inf)
+    maximum = np.full(nlabels, -np.inf)
+    total = np.zeros(nlabels)
+    mean = np.zeros(nlabels)
+    # sum of squared deviations from the mean
+    m2 = np.zeros(nlabels)
+    all_labels = []
+    all_values = []
+    for labels, values in blocks:
+        if len(labels) == 0:
+            continue
+        # statistics for the labels in this block
+        block_labels, inverse = np.unique(labels, return_inverse=True)
+        block_count, block_results = _labeled_statistics(
+            inverse, values, len(block_labels), ['min', 'max', 'sum', 'std'])
+        # combine the means and squared deviations
+        # (Chan et al., 1979, parallel algorithm)
+        n_a = count[block_labels]
+        n = n_a + block_count
+        block_mean = block_results['sum'] / block_count
+        delta = block_mean - mean[block_labels]
+        mean[block_labels] += delta * block_count / n
+        m2[block_labels] += block_results['std']**2 * block_count + \
+                            delta**2 * n_a * block_count / n
+        count[block_labels] = n
+        minimum[block_labels] = np.minimum(minimum[block_labels], block_results['min'])
+        maximum[block_labels] = np.maximum(maximum[block_labels], block_results['max'])
+        total[block_labels] += block_results['sum']
+        if len(percentile_stats) > 0:
+            all_labels.append(labels)
+            all_values.append(values)
+
+    results = {}
+    if len(percentile_stats) > 0:
+        if len(all_labels) > 0:
+            all_labels, all_values = np.concatenate(all_labels), np.concatenate(all_values)
+        else:
+            all_labels, all_values = np.array([], dtype=int), np.array([], dtype=float)
+        results.update(_labeled_statistics(all_labels, all_values, nlabels,
+                                           percentile_stats)[1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for stat in stats:
+            if stat == 'count':
+                results[stat] = count
+            elif stat == 'min':
+                results[stat] = minimum
+            elif stat == 'max':
+                results[stat] = maximum
+            elif stat == 'sum':
+                results[stat] = total
+            elif stat == 'mean':
+                results[stat] = total / count
+            elif stat == 'std':
+                results[stat] = np.sqrt(m2 / count)
+    return count, results
+
+
+def _labeled_statistics(labels, values, nlabels, stats):
+    """Compute statistics of values grouped by integer labels.
+
+    Parameters
+    ----------
+    labels : 1D array of ints
+        Label (0 to nlabels - 1) for each value.
+    values : 1D array of floats
+    nlabels : int
+        Number of labels (groups).
+    stats : list of str
+        Statistics to compute (see :func:`zonal_statistics`).
+
+    Returns
+    -------
+    count : 1D array of ints
+        Number of values for each label.
+    results : dict
+        1D arrays of length nlabels, keyed by statistic. Values
+        for labels without any values are undefined (inf or nan).
+    """
+    count = np.bincount(labels, minlength=nlabels)
+    results = {}
+    for stat in stats:
+        if stat == 'count':
+            results[stat] = count
+        elif stat == 'min':
+            results[stat] = np.full(nlabels, np.inf)
+            np.minimum.at(results[stat], labels, values)
+        elif stat == 'max':
+            results[stat] = np.full(nlabels, -np.inf)
+            np.maximum.at(results[stat], labels, values)
+        elif stat in {'sum', 'mean', 'std'}:
+            total = np.bincount(labels, weights=values, minlength=nlabels)
+            if stat == 'sum':
+                results[stat] = total
+                continue
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total / count
+                if stat == 'mean':
+                    results[stat] = mean
+                else:
+                    deviations = values - mean[labels]
+                    results[stat] = np.sqrt(np.bincount(labels, weights=deviations**2,
+                                                        minlength=nlabels) / count)
+        elif stat == 'median' or stat.startswith('percentile_'):
+            q = 50. if stat == 'median' else float(stat.split('_')[1])
+            # linear interpolation between the sorted values for each label
+            # (same as numpy.percentile)
+            sorted_values = values[np.lexsort((values, labels))]
+            starts = np.cumsum(count) - count
+            position = q / 100 * np.maximum(count - 1, 0)
+            lower = np.floor(position).astype(int)
+            upper = np.ceil(position).astype(int)
+            has_values = count > 0
+            result = np.full(nlabels, np.nan)
+            lower_values = sorted_values[(starts + lower)[has_values]]
+            upper_values = sorted_values[(starts + upper)[has_values]]
+            fraction = (position - lower)[has_values]
+            result[has_values] = lower_values + (upper_values - lower_values) * fraction
+            results[stat] = result
+        else:
+            raise ValueError('Unsupported statistic: {}'.format(stat))
+    return count, results
+
+
+def smooth_elevations(fromids, toids, elevations, start_elevations=None):
+    """Smooth elevations in a stream network, so that they never rise
+    going downstream. The smoothed elevation for each edge (line) is the minimum
+    of that edge and all edges upstream. If start elevations are specified,
+    they are also reduced to the lowest end elevation upstream, and end elevations
+    are reduced to the start elevation of the next edge downstream.
+    Only edges that ultimately route to an outlet (0) are smoothed.
+
+    Running minima are propagated downstream through the network
+    in one pass, in topological order (see :func:`smooth_reach_elevations`).
 
     Parameters
     ----------
@@ -27,6 +679,91 @@ def smooth_elevations(fromids, toids, elevations, start_elevations=None):  # ele
         Dictionary of smoothed edge elevations,
         or smoothed end elevations, start elevations
     """
+    graph = dict(zip(fromids, toids))
+    assert 0 in set(graph.values()), 'No outlets in routing network!'
+    # if fromids are listed more than once, use the last elevations
+    elevations = dict(zip(fromids, elevations))
+    ids = list(graph.keys())
+    end_elevations = [elevations[id] for id in ids]
+    if start_elevations is not None:
+        start_elevations = dict(zip(fromids, start_elevations))
+        start_elevations = [start_elevations[id] for id in ids]
+
+    print('\nSmoothing elevations...')
+    ta = time.time()
+    results = smooth_reach_elevations(ids, list(graph.values()),
+                                      end_elevations, start_elevations)
+    print("finished in {:.2f}s".format(time.time() - ta))
+    if start_elevations is not None:
+        end_elevations, start_elevations = results
+        return dict(zip(ids, end_elevations.tolist())), \
+               dict(zip(ids, start_elevations.tolist()))
+    return dict(zip(ids, results.tolist()))
+
+
+def smooth_reach_elevations(rno, outreach, elevations, start_elevations=None):
+    """Array-based version of :func:`smooth_elevations`, for unique
+    reach numbers (rno) and their downstream connections (outreach).
+
+    Parameters
+    ----------
+    rno : 1D array
+        Unique reach numbers.
+    outreach : 1D array
+        Downstream connections of rno (0 for outlets).
+    elevations : 1D array
+        Elevation for each reach, or if start_elevations
+        are specified, the end elevation for each reach.
+    start_elevations : 1D array, optional
+        Start elevation for each reach.
+        By default, None.
+
+    Returns
+    -------
+    elevations : 1D array or tuple
+        Smoothed elevations aligned with rno,
+        or smoothed end elevations, start elevations
+    """
+    rno = np.asarray(rno)
+    outreach = np.asarray(outreach)
+    elevations = np.array(elevations, dtype=float)
+    graph = RoutingGraph(dict(zip(rno.tolist(), outreach.tolist())))
+    assert len(graph) == len(rno), 'rno must be unique'
+
+    # only smooth reaches that ultimately route to an outlet (0)
+    drains = np.isin(rno, list(graph.get_upstream(0)))
+    graph = RoutingGraph(dict(zip(rno[drains].tolist(),
+                                  outreach[drains].tolist())))
+    # minimum elevation at or upstream of each reach
+    upstream_min = graph.accumulate(elevations[drains], ufunc=np.minimum)
+    upstream_min = np.array(list(upstream_min.values()))
+    if start_elevations is None:
+        elevations[drains] = upstream_min
+        return elevations
+
+    start_elevations = np.array(start_elevations, dtype=float)
+    drain_rno, drain_outreach = rno[drains], outreach[drains]
+    drain_start = start_elevations[drains]
+    # position of each outreach in drain_rno
+    sorter = np.argsort(drain_rno)
+    pos = np.searchsorted(drain_rno, drain_outreach, sorter=sorter)
+    pos = sorter[np.minimum(pos, len(drain_rno) - 1)]
+    routed = (drain_outreach != 0) & (drain_rno[pos] == drain_outreach)
+    # reset start elevations to the lowest end elevation upstream
+    np.minimum.at(drain_start, pos[routed], upstream_min[routed])
+    # reset end elevations to the start elevation downstream
+    upstream_min[routed] = np.minimum(upstream_min[routed],
+                                      drain_start[pos[routed]])
+    elevations[drains] = upstream_min
+    start_elevations[drains] = drain_start
+    return elevations, start_elevations
+
+
+def _smooth_elevations_by_search(fromids, toids, elevations, start_elevations=None):
+    """Original version of :func:`smooth_elevations`, which searches
+    the whole network upstream of each edge. Retained as a reference
+    for testing.
+    """
     # make forward and reverse dictionaries with routing info
     graph = dict(zip(fromids, toids))
     assert 0 in set(graph.values()), 'No outlets in routing network!'
@@ -1,15 +1,30 @@
 import json
+import os
 import sys
 
 import numpy as np
 import pandas as pd
+import pyproj
+import shapely.wkb
+from shapely.geometry.base import BaseGeometry
+from gisutils import shp2df, df2shp
 try:
     import flopy
 except:
     flopy = False
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = False
 
 from sfrmaker.utils import get_input_arguments
 
+# file extensions for the columnar formats supported by read_table and write_table
+columnar_formats = {'.parquet': 'parquet',
+                    '.feather': 'feather'}
+
 
 def load_mf2005_package(f, model=None):
 
@@ -214,6 +229,218 @@ def load_mf2005_package(f, model=None):
                        options=options)
 
 
+def is_columnar_file(filename):
+    """Check whether a file is in one of the columnar (Apache Arrow-based)
+    formats supported by :func:`read_table` and :func:`write_table`,
+    based on its extension."""
+    return os.path.splitext(str(filename))[1].lower() in columnar_formats
+
+
+def _get_geometry_columns(df):
+    """Get the names of the columns in a DataFrame
+    that contain shapely geometries."""
+    geometry_columns = []
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        values = df[column].dropna()
+        if len(values) > 0 and isinstance(values.iloc[0], BaseGeometry):
+            geometry_columns.append(column)
+    return geometry_columns
+
+
+def write_table(df, filename, crs=None, index=False):
+    """Write a DataFrame to a Parquet (.parquet), Feather (.feather)
+    or csv file, depending on the file extension.
+
+    In the Parquet and Feather formats, data types are preserved, and
+    any columns of shapely geometries are written as well-known binary (WKB),
+    with `GeoParquet <https://geoparquet.org>`_ metadata describing the
+    geometry columns (and CRS), so that the files can be read by
+    :func:`read_table` (or other GeoParquet-aware software).
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Table to write.
+    filename : str or pathlike
+        Output file.
+    crs : obj, optional
+        Coordinate reference system of the geometries;
+        anything accepted by :meth:`pyproj.crs.CRS.from_user_input`.
+        By default, None.
+    index : bool
+        Whether to write the DataFrame index. By default, False.
+    """
+    file_format = columnar_formats.get(os.path.splitext(str(filename))[1].lower())
+    if file_format is None:
+        df.to_csv(filename, index=index)
+        print('wrote {}'.format(filename))
+        return
+    if not pyarrow:
+        raise ImportError('Writing {} files requires pyarrow'.format(file_format))
+    df = df.copy()
+    geometry_columns = _get_geometry_columns(df)
+    geo = {'version': '1.0.0',
+           'primary_column': geometry_columns[0] if len(geometry_columns) > 0 else None,
+           'columns': {}}
+    for column in geometry_columns:
+        geom_types = sorted({g.geom_type for g in df[column].dropna()})
+        df[column] = [None if g is None else g.wkb for g in df[column]]
+        geo['columns'][column] = {'encoding': 'WKB', 'geometry_types': geom_types}
+        # an explicit null crs means unknown
+        # (readers assume OGC:CRS84 if the crs is omitted)
+        if crs is not None:
+            geo['columns'][column]['crs'] = pyproj.CRS.from_user_input(crs).to_json_dict()
+        else:
+            geo['columns'][column]['crs'] = None
+    table = pyarrow.Table.from_pandas(df, preserve_index=index)
+    if len(geometry_columns) > 0:
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'geo'] = json.dumps(geo).encode('utf-8')
+        table = table.replace_schema_metadata(metadata)
+    if file_format == 'parquet':
+        pyarrow.parquet.write_table(table, str(filename))
+    else:
+        pyarrow.feather.write_feather(table, str(filename))
+    print('wrote {}'.format(filename))
+
+
+def read_table(filename, columns=None, **kwargs):
+    """Read a table written by :func:`write_table`, in the Parquet (.parquet),
+    Feather (.feather) or csv format (depending on the file extension).
+
+    Geometry columns (as described by
+    `GeoParquet <https://geoparquet.org>`_ metadata) in Parquet or Feather files
+    are converted from well-known binary (WKB) to shapely geometries.
+    The CRS of the primary geometry column (if any) is stored as a
+    :class:`pyproj.crs.CRS` instance under ``df.attrs['crs']``.
+
+    Parameters
+    ----------
+    filename : str or pathlike
+        Input file.
+    columns : list of str, optional
+        Subset of columns to read. By default, None (all columns).
+    **kwargs : keyword arguments to :func:`pandas.read_csv`
+        (for csv files only)
+
+    Returns
+    -------
+    df : DataFrame
+    """
+    file_format = columnar_formats.get(os.path.splitext(str(filename))[1].lower())
+    if file_format is None:
+        return pd.read_csv(filename, usecols=columns, **kwargs)
+    if not pyarrow:
+        raise ImportError('Reading {} files requires pyarrow'.format(file_format))
+    if file_format == 'parquet':
+        table = pyarrow.parquet.read_table(str(filename), columns=columns)
+    else:
+        table = pyarrow.feather.read_table(str(filename), columns=columns)
+    df = table.to_pandas()
+    metadata = table.schema.metadata or {}
+    geo = json.loads(metadata.get(b'geo', b'{}'))
+    df.attrs['crs'] = None
+    for column, info in geo.get('columns', {}).items():
+        if column not in df.columns:
+            continue
+        df[column] = [None if b is None else shapely.wkb.loads(b) for b in df[column]]
+        if column == geo.get('primary_column') and info.get('crs') is not None:
+            df.attrs['crs'] = pyproj.CRS.from_json_dict(info['crs'])
+    return df
+
+
+def read_features(filename, filter=None, **kwargs):
+    """Read features from a shapefile (or dbf file), or from a Parquet or
+    Feather file written by :func:`write_table`, into a DataFrame.
+
+    Parameters
+    ----------
+    filename : str, pathlike or list of str
+        Input file(s).
+    filter : tuple, optional
+        (xmin, ymin, xmax, ymax) bounding box; only features with
+        bounding boxes that intersect the filter are read.
+        By default None.
+    **kwargs : keyword arguments to :func:`gisutils.shp2df`
+        (for shapefiles only)
+
+    Returns
+    -------
+    df : DataFrame
+    """
+    filenames = filename if isinstance(filename, list) else [filename]
+    if not is_columnar_file(filenames[0]):
+        return shp2df(filename, filter=filter, **kwargs)
+    dfs = []
+    for f in filenames:
+        df = read_table(f)
+        if filter is not None:
+            df = filter_features(df, filter)
+        dfs.append(df)
+    crs = dfs[0].attrs.get('crs')
+    df = pd.concat(dfs).reset_index(drop=True) if len(dfs) > 1 else dfs[0]
+    df.attrs['crs'] = crs
+    return df
+
+
+def filter_features(df, filter):
+    """Subset a DataFrame of features to those with bounding boxes
+    that intersect a bounding box (as with the ``filter`` argument
+    to :func:`gisutils.shp2df`).
+
+    Parameters
+    ----------
+    df : DataFrame
+        Table of features, with geometries in a 'geometry' column.
+    filter : tuple
+        (xmin, ymin, xmax, ymax) bounding box.
+
+    Returns
+    -------
+    df : DataFrame
+    """
+    bounds = np.array([g.bounds if g is not None else [np.nan] * 4
+                       for g in df.geometry]).reshape(-1, 4)
+    xmin, ymin, xmax, ymax = filter
+    in_bbox = (bounds[:, 0] <= xmax) & (bounds[:, 2] >= xmin) & \
+              (bounds[:, 1] <= ymax) & (bounds[:, 3] >= ymin)
+    crs = df.attrs.get('crs')
+    df = df.loc[in_bbox].copy()
+    df.attrs['crs'] = crs
+    return df
+
+
+def write_features(df, filename, crs=None, **kwargs):
+    """Write a DataFrame of features to a shapefile (or dbf file), or to a
+    Parquet or Feather file (see :func:`write_table`), depending on
+    the file extension.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Table of features, with any geometries in a 'geometry' column.
+    filename : str or pathlike
+        Output file.
+    crs : obj, optional
+        Coordinate reference system of the geometries;
+        anything accepted by :meth:`pyproj.crs.CRS.from_user_input`.
+        By default, None.
+    **kwargs : keyword arguments to :func:`gisutils.df2shp`
+        (for shapefiles only)
+    """
+    if is_columnar_file(filename):
+        if crs is None and kwargs.get('epsg') is not None:
+            crs = kwargs['epsg']
+        write_table(df, filename, crs=crs, index=kwargs.get('index', False))
+    else:
+        if crs is not None:
+            kwargs['crs'] = crs
+        df2shp(df, filename, **kwargs)
+
+
 def read_tables(data, **kwargs):
     # allow input via a list of tables or single table
     input_data = data
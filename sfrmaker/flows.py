@@ -2,7 +2,7 @@ import numpy as np
 import pandas as pd
 from shapely.geometry import box
 import flopy
-from sfrmaker.routing import find_path, make_graph
+from sfrmaker.routing import make_graph, RoutingGraph
 from gisutils import shp2df
 from mfexport.budget_output import read_sfr_output
 from .fileio import read_tables
@@ -89,7 +89,7 @@ def get_inflow_locations_from_parent_model(parent_reach_data, inset_reach_data,
     mustinclude_cols = {'line_id', 'rno', 'iseg', 'ireach'}
     assert len(mustinclude_cols.intersection(ird.columns)) == len(mustinclude_cols)
 
-    graph = make_graph(ird.rno.values, ird.outreach.values, one_to_many=False)
+    graph = RoutingGraph(make_graph(ird.rno.values, ird.outreach.values, one_to_many=False))
 
     # cull parent reach data to only lines that cross or are just upstream of inset boundary
     buffered = active_area.buffer(5000, cap_style=2)
@@ -130,12 +130,9 @@ def get_inflow_locations_from_parent_model(parent_reach_data, inset_reach_data,
 
     # for each reach in ird (potential inset inlets)
     # check that there isn't another inlet downstream
-    drop_reaches = []
-    for i, r in ird.iterrows():
-        path = find_path(graph, r.rno)
-        another_inlet_downstream = len(set(path[1:]).intersection(set(ird.rno))) > 0
-        if another_inlet_downstream:
-            drop_reaches.append(r.rno)
+    next_inlets = graph.get_next_in_subset(ird.rno, ids=ird.rno)
+    drop_reaches = [rno for rno, next_inlet in next_inlets.items()
+                    if next_inlet is not None]
 
     ird = ird.loc[~ird.rno.isin(drop_reaches)]
     # cull parent flows to outlet reaches
@@ -276,8 +273,9 @@ def add_to_perioddata(sfrdata, data, flowline_routing=None,
         line_ids = set(data[line_id_column])
         drop = set()
         dropped_line_info_file = 'dropped_inflows_locations.csv'
+        paths = RoutingGraph(flowline_routing).paths
         for lid in line_ids:
-            path = find_path(flowline_routing, start=lid)
+            path = paths[lid]
             duplicated = set(path[1:]).intersection(line_ids)
             if len(duplicated) > 0:
                 drop.add(lid)
@@ -337,8 +335,9 @@ def add_to_segment_data(sfrdata, data, flowline_routing=None,
         line_ids = set(data[line_id_column])
         drop = set()
         dropped_line_info_file = 'dropped_inflows_locations.csv'
+        paths = RoutingGraph(flowline_routing).paths
         for lid in line_ids:
-            path = find_path(flowline_routing, start=lid)
+            path = paths[lid]
             duplicated = set(path[1:]).intersection(line_ids)
             if len(duplicated) > 0:
                 drop.add(lid)
@@ -7,6 +7,7 @@ import traceback
 import fiona
 import numpy as np
 import pyproj
+import shapely
 from shapely.geometry import shape, Polygon, box
 from shapely.ops import unary_union
 import gisutils
@@ -69,9 +70,10 @@ def export_reach_data(reach_data, grid, filename,
     else:
         rd = reach_data.copy()
     assert isinstance(grid, sfrmaker.grid.Grid), "grid needs to be an sfrmaker.Grid instance"
-    assert np.array_equal(grid.df.node.values, np.arange(grid.size))
-    assert np.array_equal(grid.df.node.values, grid.df.index.values)
-    polygons = grid.df.loc[rd.node, 'geometry'].values
+    if not grid._lazy_geometry:
+        assert np.array_equal(grid.df.node.values, np.arange(grid.size))
+        assert np.array_equal(grid.df.node.values, grid.df.index.values)
+    polygons = grid.get_cell_polygons(rd.node.values)
     if geomtype.lower() == 'polygon':
         rd['geometry'] = polygons
     elif geomtype.lower() == 'point':
@@ -117,6 +119,151 @@ def intersect_rtree(geom1, geom2, index=None):
     return isfr
 
 
+def intersect_strtree(geom1, geom2):
+    """Intersect features in geom1 with those in geom2 using a single
+    packed (Sort-Tile-Recursive) spatial index. Candidate pairs are resolved
+    against the index in bulk, and the exact intersection tests are
+    made with prepared geometries, so that each feature in geom2 only
+    has to be prepared once.
+
+    Parameters:
+    ----------
+    geom1 : list
+        list of shapely geometry objects
+    geom2 : list
+        list of shapely polygon objects to be intersected with features in geom1
+
+    Returns:
+    -------
+    A list of the same length as geom2; containing for each feature in geom2,
+    a sorted list of indicies of intersecting geometries in geom1.
+    """
+    from shapely.strtree import STRtree
+    from shapely.prepared import prep
+
+    geom2 = list(geom2)
+    if len(geom2) == 0:
+        return []
+
+    print('\nBuilding STR tree spatial index...')
+    ta = time.time()
+    geom1 = list(geom1)
+    tree = STRtree(geom1)
+    print("finished in {:.2f}s".format(time.time() - ta))
+
+    print('\nIntersecting {} features...'.format(len(geom2)))
+    ta = time.time()
+    if version.parse(shapely.__version__) >= version.parse('2.0'):
+        # bulk query returns (input index, tree index) pairs
+        # for all features in geom2 in one vectorized call
+        geom2_inds, geom1_inds = tree.query(geom2, predicate='intersects')
+        order = np.lexsort((geom1_inds, geom2_inds))
+        geom2_inds, geom1_inds = geom2_inds[order], geom1_inds[order]
+        counts = np.bincount(geom2_inds, minlength=len(geom2))
+        isfr = [inds.tolist() for inds in
+                np.split(geom1_inds, np.cumsum(counts)[:-1])]
+    else:
+        # shapely < 2 returns the geometries themselves from tree queries;
+        # map them back to their positions in geom1
+        positions = {id(g): i for i, g in enumerate(geom1)}
+        isfr = []
+        for g in geom2:
+            prepared = prep(g)
+            inds = [positions[id(c)] for c in tree.query(g)
+                    if prepared.intersects(c)]
+            isfr.append(sorted(inds))
+    print("finished in {:.2f}s".format(time.time() - ta))
+    return isfr
+
+
+def nearest_strtree(geom1, geom2, k=1, max_distance=None):
+    """Find the nearest feature(s) in geom1 to each feature in geom2
+    (for example, the reach lines closest to a set of measurement sites),
+    using a single packed (Sort-Tile-Recursive) spatial index. Distances
+    are measured to the geometries themselves (e.g. the line segments,
+    rather than their vertices). With shapely >= 2, all features in geom2
+    are located in bulk.
+
+    Parameters:
+    ----------
+    geom1 : list
+        list of shapely geometry objects
+    geom2 : list
+        list of shapely geometry objects (e.g. Points) to be located
+    k : int
+        Number of nearest features in geom1 to return for each
+        feature in geom2. By default, 1.
+    max_distance : float (optional)
+        Only consider features in geom1 within this distance.
+
+    Returns:
+    -------
+    inds, distances : lists of lists
+        Lists of the same length as geom2; containing for each feature in geom2,
+        the indices of (up to) the k nearest geometries in geom1,
+        and the distances to them, sorted by distance.
+    """
+    from shapely.strtree import STRtree
+
+    geom1 = list(geom1)
+    geom2 = list(geom2)
+    n = len(geom2)
+    if n == 0:
+        return [], []
+    if version.parse(shapely.__version__) < version.parse('2.0'):
+        # shapely < 2: without bulk queries, compute all of the distances
+        inds, distances = [], []
+        for g in geom2:
+            d = np.array([g1.distance(g) for g1 in geom1])
+            order = np.argsort(d, kind='stable')[:k]
+            if max_distance is not None:
+                order = order[d[order] <= max_distance]
+            inds.append(order.tolist())
+            distances.append(d[order].tolist())
+        return inds, distances
+
+    tree = STRtree(geom1)
+    geom2 = np.array(geom2, dtype=object)
+    # nearest feature for each feature in geom2
+    (geom2_inds, geom1_inds), nearest = tree.query_nearest(geom2, max_distance=max_distance,
+                                                           return_distance=True,
+                                                           all_matches=False)
+    if k == 1:
+        pairs = geom2_inds, geom1_inds
+    else:
+        # search within expanding distances of each feature in geom2,
+        # until k features are found, or no more are within max_distance;
+        # starting with the nearest distance plus a typical feature size
+        bounds = shapely.bounds(tree.geometries)
+        size = np.median(np.hypot(bounds[:, 2] - bounds[:, 0],
+                                  bounds[:, 3] - bounds[:, 1]))
+        radius = nearest + max(size, np.finfo(float).eps)
+        pairs = ([], [])
+        todo = geom2_inds
+        while len(todo) > 0:
+            if max_distance is not None:
+                radius = np.minimum(radius, max_distance)
+            points_inds, candidates = tree.query(geom2[todo], predicate='dwithin',
+                                                 distance=radius)
+            counts = np.bincount(points_inds, minlength=len(todo))
+            done = (counts >= k) | (counts == len(geom1))
+            if max_distance is not None:
+                done |= radius >= max_distance
+            keep = done[points_inds]
+            pairs[0].append(todo[points_inds[keep]])
+            pairs[1].append(candidates[keep])
+            todo, radius = todo[~done], radius[~done] * 2
+        pairs = np.concatenate(pairs[0]), np.concatenate(pairs[1])
+    geom2_inds, geom1_inds = pairs
+    d = shapely.distance(geom2[geom2_inds], tree.geometries[geom1_inds])
+    order = np.lexsort((geom1_inds, d, geom2_inds))
+    geom2_inds, geom1_inds, d = geom2_inds[order], geom1_inds[order], d[order]
+    counts = np.bincount(geom2_inds, minlength=n)
+    inds = [i.tolist()[:k] for i in np.split(geom1_inds, np.cumsum(counts)[:-1])]
+    distances = [i.tolist()[:k] for i in np.split(d, np.cumsum(counts)[:-1])]
+    return inds, distances
+
+
 def intersect(geom1, geom2):
     """Same as intersect_rtree, except without spatial indexing. Fine for smaller datasets,
     but scales by 10^4 with the side of the problem domain.
@@ -147,6 +294,58 @@ def intersect(geom1, geom2):
     return isfr
 
 
+def clip_lines_to_polygon(lines, polygon, intersects_polygon=None):
+    """Clip LineStrings to a polygon in bulk. The polygon is prepared once,
+    and the lines are classified as fully inside the polygon (retained as-is),
+    outside of the polygon (dropped), or crossing the polygon boundary, so that
+    intersections only need to be computed for the crossing lines. Unlike
+    with an intersection, lines inside of the polygon are returned unchanged
+    (self-intersecting lines are not split at their crossings).
+
+    Parameters
+    ----------
+    lines : sequence of LineStrings
+    polygon : shapely Polygon or MultiPolygon
+        Polygon to clip the lines to.
+    intersects_polygon : shapely Polygon or MultiPolygon, optional
+        Polygon (e.g. a simplified version of polygon) for selecting the
+        lines to retain (lines that intersect it), if different from polygon.
+
+    Returns
+    -------
+    keep : 1D boolean array
+        True for lines in the input that were retained.
+    clipped : 1D array of shapely geometries
+        Clipped geometries for the retained lines.
+    """
+    if intersects_polygon is None:
+        intersects_polygon = polygon
+    lines = np.array(list(lines), dtype=object)
+    if version.parse(shapely.__version__) >= version.parse('2.0'):
+        shapely.prepare(polygon)
+        shapely.prepare(intersects_polygon)
+        intersects = shapely.intersects(lines, intersects_polygon)
+        inside = shapely.contains_properly(polygon, lines)
+    else:
+        from shapely.prepared import prep
+        prepared_intersects = prep(intersects_polygon)
+        prepared = prep(polygon)
+        intersects = np.array([prepared_intersects.intersects(g) for g in lines], dtype=bool)
+        inside = np.array([prepared.contains_properly(g) for g in lines], dtype=bool)
+
+    # only intersect lines that cross the polygon boundary
+    clipped = lines.copy()
+    crossing = intersects & ~inside
+    if version.parse(shapely.__version__) >= version.parse('2.0'):
+        clipped[crossing] = shapely.intersection(lines[crossing], polygon)
+        empty = shapely.is_empty(clipped)
+    else:
+        clipped[crossing] = [g.intersection(polygon) for g in lines[crossing]]
+        empty = np.array([g.is_empty for g in clipped], dtype=bool)
+    keep = intersects & ~empty
+    return keep, clipped[keep]
+
+
 def parse_units_from_proj_str(proj_str):
     units = None
     from pyproj import CRS
@@ -13,8 +13,10 @@ import pandas as pd
 from rasterio import Affine
 from rasterio import features
 from shapely.geometry import Polygon, shape
+from shapely.prepared import prep
 from shapely.ops import unary_union
 from gisutils import shp2df, df2shp, get_shapefile_crs
+from .elevations import grid_statistics
 from .gis import get_crs, read_polygon_feature, \
     build_rtree_index, intersect
 
@@ -60,12 +62,12 @@ class Grid:
     def __repr__(self):
         s = 'Model grid information\n'
         if isinstance(self, StructuredGrid):
-            s += 'structured grid\nnnodes: {:,d}\n'.format(len(self.df))
+            s += 'structured grid\nnnodes: {:,d}\n'.format(self.size)
             for dim in ['nlay', 'nrow', 'ncol']:
                 s += '{}: {:d}\n'.format(dim, self.__dict__[dim])
         else:
             s += 'unstructured grid\n'
-            s += 'nnodes: {:,d}\n'.format(len(self.df))
+            s += 'nnodes: {:,d}\n'.format(self.size)
         s += 'model length units: {}\n'.format(self.model_units)
         s += 'crs: {}\n'.format(self.crs)
         s += 'bounds: {:.2f}, {:.2f}, {:.2f}, {:.2f}\n'.format(*self.bounds)
@@ -105,32 +107,65 @@ class Grid:
         """Shapely Polygon delinating area where SFR will be simulated."""
         return self._active_area
 
+    @property
+    def df(self):
+        """DataFrame with information for each model cell. For grids
+        with cell geometries that are created on demand (see
+        :meth:`StructuredGrid.from_modelgrid`), the geometry column
+        is added to the DataFrame on first access; use
+        :meth:`get_cell_polygons` instead to avoid storing a
+        Polygon for every cell in the grid."""
+        if 'geometry' not in self._df.columns and self._lazy_geometry:
+            self._df['geometry'] = self.get_cell_polygons()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
+    @property
+    def _lazy_geometry(self):
+        """True if cell polygons are created on demand."""
+        return False
+
     @property
     def bounds(self):
         if self._bounds is None:
-            allX = []  # all x coordinates
-            allY = []  # all y coordinatess
-            geoms = self.df.geometry.tolist()  # cell polygons
-            for g in geoms:
-                gx, gy = g.exterior.coords.xy
-                allX += gx
-                allY += gy
-            allX = np.array(allX)
-            allY = np.array(allY)
-            self._bounds = allX.min(), allY.min(), allX.max(), allY.max()
+            self._bounds = self._get_bounds()
         return self._bounds
 
     @property
     def size(self):
-        return len(self.df)
+        return len(self._df)
 
     @property
     def spatial_index(self):
         """Rtree index for intersecting features with model grid."""
         if self._idx is None:
-            self._idx = build_rtree_index(self.df.geometry.tolist())
+            self._idx = build_rtree_index(self.get_cell_polygons())
         return self._idx
 
+    def _get_bounds(self):
+        bounds = np.array([g.bounds for g in self.get_cell_polygons()])
+        return (bounds[:, 0].min(), bounds[:, 1].min(),
+                bounds[:, 2].max(), bounds[:, 3].max())
+
+    def get_cell_polygons(self, nodes=None):
+        """Get shapely Polygons for model cells.
+
+        Parameters
+        ----------
+        nodes : sequence of ints, optional
+            Node numbers of the cells to get. By default, None (all cells).
+
+        Returns
+        -------
+        polygons : list of shapely Polygons
+        """
+        if nodes is None:
+            return self._df.geometry.tolist()
+        return self._df.loc[nodes, 'geometry'].tolist()
+
     @property
     def lenuni(self):
         return self.units_dict.get(self.model_units, 0)
@@ -152,7 +187,7 @@ class Grid:
 
             # if a polygon feature is supplied but all cells are active
             # set isfr from polygon
-            if self.df.isfr.sum() == len(self.df):
+            if self._df.isfr.sum() == self.size:
                 self._set_isfr_from_active_area()
                 if isinstance(feature, str):
                     self._active_area_defined_by = feature
@@ -167,7 +202,7 @@ class Grid:
         # is that unary_unions of a lot of cells are slow
         # and with all cells active,
         # don't have to worry about inactive cells getting intersected
-        elif self.df.isfr.sum() == len(self.df):
+        elif self._df.isfr.sum() == self.size:
             self._active_area_defined_by = 'all cells'
 
         # no feature was supplied; set from isfr values
@@ -182,11 +217,15 @@ class Grid:
         #                                [self.active_area],
         #                                index=self.spatial_index)
         print('setting isfr values...')
-        intersections = intersect(self.df.geometry.tolist(),
-                                  [self.active_area])
-        self.df.sort_values(by='node', inplace=True)
-        self.df['isfr'] = 0
-        self.df.loc[np.squeeze(intersections), 'isfr'] = 1
+        nodes = self._get_intersecting_nodes(self.active_area)
+        self._df.sort_values(by='node', inplace=True)
+        self._df['isfr'] = 0
+        self._df.loc[nodes, 'isfr'] = 1
+
+    def _get_intersecting_nodes(self, feature):
+        """Get the node numbers of the cells intersecting a polygon feature."""
+        intersections = intersect(self.get_cell_polygons(), [feature])
+        return intersections[0]
 
     def create_active_area_polygon_from_isfr(self):
         """The StructuredGrid and UnstructuredGrid classes
@@ -206,7 +245,10 @@ class Grid:
         df2shp(df, outshp, crs=self.crs)
 
     def write_grid_shapefile(self, outshp='grid.shp'):
-        df2shp(self.df, outshp, crs=self.crs)
+        df = self._df.copy()
+        if 'geometry' not in df.columns:
+            df['geometry'] = self.get_cell_polygons()
+        df2shp(df, outshp, crs=self.crs)
 
 
 class StructuredGrid(Grid):
@@ -246,6 +288,22 @@ class StructuredGrid(Grid):
         Grid rotation angle in degrees, counter-clockwise
         about the origin, by default 0. Only used for creating
         the :attr:`transform` attribute, by default None
+    delr : sequence of floats, optional
+        Cell spacings along a row (in the x-direction), for grids
+        that are rectilinear but not uniform. Along with ``delc``, ``xul``,
+        ``yul`` and ``rotation``, used to define the :attr:`lattice` attribute,
+        by default None
+    delc : sequence of floats, optional
+        Cell spacings along a column (in the y-direction), by default None
+    xvertices : 2D array, optional
+        x-coordinates of the cell corners, of shape (nrow + 1, ncol + 1)
+        (as in :attr:`flopy.discretization.StructuredGrid.xvertices`).
+        If xvertices and yvertices are supplied, the DataFrame ``df`` doesn't
+        need a geometry column; cell polygons are instead created on demand
+        (see :meth:`~Grid.get_cell_polygons`). By default None
+    yvertices : 2D array, optional
+        y-coordinates of the cell corners, of shape (nrow + 1, ncol + 1),
+        by default None
     uniform : bool, optional
         Optional flag indicating the grid is uniform, 
         by default None
@@ -279,6 +337,7 @@ class StructuredGrid(Grid):
 
     def __init__(self, df,
                  xul=None, yul=None, dx=None, dy=None, rotation=0.,
+                 delr=None, delc=None, xvertices=None, yvertices=None,
                  uniform=None,
                  model_units='undefined', crs_units=None,
                  bounds=None, active_area=None,
@@ -292,33 +351,121 @@ class StructuredGrid(Grid):
         self.xul = xul
         self.yul = yul
         self.rotation = rotation
-        self.nrow = self.df.i.max() + 1
-        self.ncol = self.df.j.max() + 1
 
         # uniform structured grid parameters
         self._uniform = uniform  # whether grid is uniform or not
         self.dx = dx
         self.dy = dy
 
+        # rectilinear structured grid parameters
+        self.delr = np.array(delr, dtype=float) if delr is not None else None
+        self.delc = np.array(delc, dtype=float) if delc is not None else None
+
+        # cell corner coordinates (for creating cell polygons on demand)
+        self.xvertices = np.array(xvertices, dtype=float) if xvertices is not None else None
+        self.yvertices = np.array(yvertices, dtype=float) if yvertices is not None else None
+
         self.nlay = df.k.max() + 1
         self.nrow = df.i.max() + 1
         self.ncol = df.j.max() + 1
 
+        # cached (nrow, ncol) arrays of raster statistics by cell
+        self._raster_statistics = {}
+
         self._set_active_area(active_area)
 
     @property
     def isfr(self):
-        return np.reshape(self.df.isfr.values,
+        return np.reshape(self._df.isfr.values,
                           (self.nrow, self.ncol)).astype(np.int32)
 
     @property
     def uniform(self):
         """Check if cells are uniform by comparing their areas."""
         if self._uniform is None:
-            areas = [g.area for g in self.df.geometry]
+            if self.delr is not None and self.delc is not None:
+                areas = np.outer(self.delc, self.delr).ravel()
+            elif self._lazy_geometry:
+                # shoelace formula, applied to the cell corners
+                x, y = self._get_cell_corners()
+                areas = 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=0) -
+                                            np.roll(x, -1, axis=0) * y, axis=0))
+            else:
+                areas = [g.area for g in self.df.geometry]
             self._uniform = np.allclose(areas, np.mean(areas), rtol=0.01)
         return self._uniform
 
+    @property
+    def _lazy_geometry(self):
+        return self.xvertices is not None and self.yvertices is not None
+
+    def _get_cell_corners(self, nodes=None):
+        """Get the x and y coordinates of the cell corners, from
+        the xvertices and yvertices arrays.
+
+        Returns
+        -------
+        x, y : 2D arrays of shape (4, number of cells)
+            Corners are in the order (i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1),
+            consistent with :meth:`flopy.discretization.StructuredGrid.get_cell_vertices`.
+        """
+        if nodes is None:
+            nodes = np.arange(self.nrow * self.ncol)
+        nodes = np.array(nodes, dtype=int)
+        i, j = nodes // self.ncol, nodes % self.ncol
+        x = np.array([self.xvertices[i, j], self.xvertices[i + 1, j],
+                      self.xvertices[i + 1, j + 1], self.xvertices[i, j + 1]])
+        y = np.array([self.yvertices[i, j], self.yvertices[i + 1, j],
+                      self.yvertices[i + 1, j + 1], self.yvertices[i, j + 1]])
+        return x, y
+
+    def get_cell_polygons(self, nodes=None):
+        """Get shapely Polygons for model cells. If the grid has
+        xvertices and yvertices arrays, the Polygons are created on demand
+        (and are not stored).
+
+        Parameters
+        ----------
+        nodes : sequence of ints, optional
+            Node numbers of the cells to get. By default, None (all cells).
+
+        Returns
+        -------
+        polygons : list of shapely Polygons
+        """
+        if 'geometry' in self._df.columns or not self._lazy_geometry:
+            return Grid.get_cell_polygons(self, nodes)
+        x, y = self._get_cell_corners(nodes)
+        # close each polygon
+        x = np.vstack([x, x[:1]])
+        y = np.vstack([y, y[:1]])
+        return [Polygon(zip(xx, yy)) for xx, yy in zip(x.T, y.T)]
+
+    def _get_bounds(self):
+        if self._lazy_geometry:
+            return (self.xvertices.min(), self.yvertices.min(),
+                    self.xvertices.max(), self.yvertices.max())
+        return Grid._get_bounds(self)
+
+    def _get_intersecting_nodes(self, feature, chunksize=100000):
+        """Get the node numbers of the cells intersecting a polygon feature.
+        For grids with xvertices and yvertices arrays, cells are first
+        screened by their bounding boxes, and Polygons are only created
+        (in chunks) for the remaining cells."""
+        if not self._lazy_geometry:
+            return Grid._get_intersecting_nodes(self, feature)
+        x, y = self._get_cell_corners()
+        left, bottom, right, top = feature.bounds
+        candidates = np.flatnonzero((x.max(axis=0) >= left) & (x.min(axis=0) <= right) &
+                                    (y.max(axis=0) >= bottom) & (y.min(axis=0) <= top))
+        prepared = prep(feature)
+        nodes = []
+        for start in range(0, len(candidates), chunksize):
+            chunk = candidates[start:start + chunksize]
+            polygons = self.get_cell_polygons(chunk)
+            nodes += [n for n, g in zip(chunk, polygons) if prepared.intersects(g)]
+        return nodes
+
     @property
     def transform(self):
         """Rasterio-style affine transform object.
@@ -333,6 +480,65 @@ class StructuredGrid(Grid):
             return Affine(self.dx, 0., self.xul,
                           0., -self.dy, self.yul) * Affine.rotation(self.rotation)
 
+    @property
+    def lattice(self):
+        """Row/column lattice of the grid, for locating cells analytically
+        (without intersecting cell polygons); see
+        :func:`sfrmaker.reaches.create_reaches_structured`.
+
+        Returns
+        -------
+        lattice : tuple
+            (xedges, yedges, xul, yul, rotation), where xedges are
+            the column edges (in the direction along a row) and
+            yedges are the row edges (in the direction down a column),
+            as distances from the upper left corner of the grid,
+            in the grid coordinate system. None if the grid
+            spacing or upper left corner are not known.
+        """
+        if self.xul is None or self.yul is None:
+            return
+        if self.delr is not None and self.delc is not None:
+            delr, delc = self.delr, self.delc
+        elif self.dx is not None and self.dy is not None:
+            delr = np.ones(self.ncol) * self.dx
+            delc = np.ones(self.nrow) * self.dy
+        else:
+            return
+        xedges = np.append(0., np.cumsum(delr))
+        yedges = np.append(0., np.cumsum(delc))
+        return xedges, yedges, self.xul, self.yul, self.rotation
+
+    def get_raster_statistics(self, raster, stat='min'):
+        """Get a statistic of raster values (for example, a DEM) within each
+        model cell, as an (nrow, ncol) array. The array is computed once for
+        the whole grid (see :func:`sfrmaker.elevations.grid_statistics`),
+        and then cached on the grid for subsequent calls with the same
+        raster and statistic (until the raster file is modified).
+
+        Parameters
+        ----------
+        raster : str or pathlike
+            Path to a raster dataset. Must be in the same
+            Coordinate Reference System as the grid.
+        stat : str
+            Statistic to compute ('min', 'max', 'mean', 'std', 'sum',
+            'count', 'median', or 'percentile_<q>'), by default 'min'.
+
+        Returns
+        -------
+        values : 2D numpy array of shape (nrow, ncol)
+            Values are nan for cells that don't contain
+            any valid raster values.
+        """
+        path = os.path.normpath(os.path.abspath(raster))
+        file_stat = os.stat(path)
+        key = (path, file_stat.st_mtime_ns, file_stat.st_size, stat)
+        if key not in self._raster_statistics:
+            results = grid_statistics(raster, self, stats=stat)
+            self._raster_statistics[key] = results[stat]
+        return self._raster_statistics[key]
+
     def create_active_area_polygon_from_isfr(self):
         """Convert 2D numpy array representing active area where
         SFR will be simulated (isfr) to a polygon (if multiple
@@ -348,7 +554,12 @@ class StructuredGrid(Grid):
             areas = [s.area for s in shapes]
             self._active_area = shapes[np.argmax(areas)]
         else:
-            self._active_area = unary_union(self.df.loc[self.df.isfr == 1, 'geometry'])
+            isactive = self._df.isfr.values == 1
+            if self._lazy_geometry:
+                geoms = self.get_cell_polygons(self._df.node.values[isactive])
+            else:
+                geoms = self._df.geometry.values[isactive]
+            self._active_area = unary_union(geoms)
 
     @classmethod
     def from_json(cls, jsonfile, active_area=None, isfr=None,
@@ -368,15 +579,18 @@ class StructuredGrid(Grid):
     def from_modelgrid(cls, mg=None, active_area=None, isfr=None,
                        crs=None, epsg=None, proj_str=None, prjfile=None):
         """Create StructureGrid class instance from a
-        flopy.discretization.StructuredGrid instance."""
+        flopy.discretization.StructuredGrid instance.
+
+        Cell geometries are stored as arrays of the cell corner coordinates
+        (:attr:`~flopy.discretization.StructuredGrid.xvertices` and
+        :attr:`~flopy.discretization.StructuredGrid.yvertices`);
+        shapely Polygons are only created on demand.
+        """
         i, j = np.indices((mg.nrow, mg.ncol))
-        vertices = mg._cell_vert_list(i.ravel(), j.ravel())
-        polygons = [Polygon(v) for v in vertices]
-        df = pd.DataFrame({'node': range(0, len(vertices)),
-                           'i': sorted(list(range(mg.nrow)) * mg.ncol),
-                           'j': list(range(mg.ncol)) * mg.nrow,
-                           'geometry': polygons
-                           }, columns=['node', 'i', 'j', 'geometry'])
+        df = pd.DataFrame({'node': np.arange(mg.nrow * mg.ncol),
+                           'i': i.ravel(),
+                           'j': j.ravel(),
+                           }, columns=['node', 'i', 'j'])
         if epsg is None:
             epsg = mg.epsg
         crs = get_crs(prjfile=prjfile, epsg=epsg, proj_str=mg.proj4, crs=crs)
@@ -410,6 +624,8 @@ class StructuredGrid(Grid):
         return cls.from_dataframe(df, uniform=uniform,
                                   xul=xul, yul=yul, dx=dx, dy=dy,
                                   rotation=mg.angrot,
+                                  delr=mg.delr, delc=mg.delc,
+                                  xvertices=mg.xvertices, yvertices=mg.yvertices,
                                   bounds=bounds, active_area=active_area,
                                   crs=crs)
 
@@ -443,8 +659,9 @@ class StructuredGrid(Grid):
                        active_area=None,
                        crs=None, epsg=None, proj_str=None, prjfile=None, **kwargs):
 
-        assert geometry_column in df.columns, \
-            "No feature geometries found in dataframe column '{}'".format(geometry_column)
+        if kwargs.get('xvertices') is None or kwargs.get('yvertices') is None:
+            assert geometry_column in df.columns, \
+                "No feature geometries found in dataframe column '{}'".format(geometry_column)
 
         assert icol in df.columns, "No icol='{}' not found".format(icol)
         assert jcol in df.columns, "No jcol='{}' not found".format(jcol)
@@ -512,7 +729,7 @@ class UnstructuredGrid(Grid):
               'This will take a while for large grids. To avoid this step,'
               'supply a shapefile or shapely polygon of the SFR domain when'
               'instantiating the grid objec.')
-        geoms = self.df.geometry.values[self.df.isfr == 1]
+        geoms = self._df.geometry.values[self._df.isfr == 1]
         self._active_area = unary_union(geoms)
 
     @classmethod
@@ -1,21 +1,26 @@
+import copy
 import os
 import time
 
 import numpy as np
 import pandas as pd
+import shapely.wkb
 from shapely.geometry import box
 import flopy
 from gisutils import shp2df, df2shp, project, get_authority_crs
 import sfrmaker
-from sfrmaker.routing import pick_toids, find_path, make_graph, renumber_segments
+from sfrmaker.routing import (pick_toids, make_graph, renumber_segments, RoutingGraph,
+                              get_routing_digest)
 from sfrmaker.checks import routing_is_circular, is_to_one
-from sfrmaker.gis import read_polygon_feature, get_bbox, get_crs
+from sfrmaker.fileio import is_columnar_file, read_features, filter_features
+from sfrmaker.gis import read_polygon_feature, get_bbox, get_crs, clip_lines_to_polygon
 from sfrmaker.grid import StructuredGrid
 from sfrmaker.nhdplus_utils import load_nhdplus_v2, get_prj_file
 from sfrmaker.sfrdata import SFRData
 from sfrmaker.units import convert_length_units, get_length_units
 from sfrmaker.utils import (width_from_arbolate_sum, arbolate_sum)
-from sfrmaker.reaches import consolidate_reach_conductances, interpolate_to_reaches, setup_reach_data
+from sfrmaker.reaches import (consolidate_reach_conductances, interpolate_to_reaches,
+                              setup_reach_data, setup_reach_data_tiled)
 from sfrmaker.routing import get_previous_ids_in_subset
 
 
@@ -76,7 +81,9 @@ class Lines:
         self._geometry_length_units = None
 
         self._routing = None  # dictionary of routing connections
+        self._routing_graph = None  # RoutingGraph instance for traversing routing
         self._paths = None  # routing sequence from each segment to outlet
+        self._routing_digest = None  # digest of the id and toid columns for the routing
 
         # dictionary of elevations at the upstream ends of flowlines
         self.elevup = dict(zip(self.df.id, self.df.elevup))
@@ -126,14 +133,31 @@ class Lines:
             else:
                 routing = {self.df.id.values[0]: 0}
             self._routing = routing
+            self._routing_digest = get_routing_digest(self.df, ['id', 'toid'])
+            # paths from the previous routing are no longer valid
+            self._routing_graph = None
+            self._paths = None
         return self._routing
 
+    @property
+    def routing_graph(self):
+        """:class:`sfrmaker.routing.RoutingGraph` instance
+        for traversing the routing connections.
+        """
+        if self._routing_graph is None:
+            self._set_paths()
+            return self._routing_graph
+        if self._routing_changed():
+            self._routing = None
+            self._set_paths()
+        return self._routing_graph
+
     @property
     def paths(self):
-        """Dictionary of paths, where each value is a list
+        """Read-only mapping of paths, where each value is a list
         of downstream lines constituting a flow path to an outlet
-        for a given line (key).
-        """        
+        for a given line (key). Paths are generated as they are accessed.
+        """
         if self._paths is None:
             self._set_paths()
             return self._paths
@@ -143,15 +167,23 @@ class Lines:
         return self._paths
 
     def _set_paths(self):
-        routing = self.routing
-        self._paths = {seg: find_path(routing, seg) for seg in routing.keys()}
+        self._routing_graph = RoutingGraph(self.routing)
+        self._paths = self._routing_graph.paths
 
     def _routing_changed(self):
-        # check to see if routing in segment data was changed
+        # check to see if routing in segment data was changed;
+        # first compare a digest of the id and toid columns
+        # to the digest when the routing was last made or checked
+        digest = get_routing_digest(self.df, ['id', 'toid'])
+        if digest == self._routing_digest:
+            return False
         # compare the private routing attribute
         # to current values in reach data
         df_routing = dict(zip(self.df.id, self.df.toid))
-        return df_routing != self._routing
+        changed = df_routing != self._routing
+        if not changed:
+            self._routing_digest = digest
+        return changed
 
     def cull(self, feature, simplify=False, tol=None,
              feature_crs=None, inplace=False):
@@ -164,8 +196,10 @@ class Lines:
             Polygons must be in same CRS as linework; shapefile
             features will be reprojected if their crs is different.
         simplify : bool
-            Option to simplify the polygon, which can speed intersection 
-            with the lines.
+            Option to simplify the polygon used to select the lines that
+            intersect the feature (the lines are still clipped to the
+            original feature). Usually not needed, as the lines
+            are clipped in bulk (see :func:`sfrmaker.gis.clip_lines_to_polygon`).
         tol: float
             Simplification tolerance (distance), in the units of the LineStrings
             (usually meters).
@@ -208,20 +242,16 @@ class Lines:
 
         lines = df.geometry.tolist()
         print('starting lines: {:,d}'.format(len(lines)))
-        # isn = np.array([g.intersection(feature_s) for g in lines])
-        # df['geometry'] = isn
-        # drop = np.array([g.is_empty for g in isn])
-        # df = df.loc[~drop]
-        intersects = [g.intersects(feature_s) for g in lines]
-        if not np.any(intersects):
+        # clip the lines in bulk; only lines crossing
+        # the feature boundary are intersected with it
+        keep, clipped = clip_lines_to_polygon(lines, feature,
+                                              intersects_polygon=feature_s)
+        if not np.any(keep):
             print('No lines in active area. Check CRS.')
             quit()
 
-        df = df.loc[intersects]
-        df['geometry'] = [g.intersection(feature) for g in df.geometry]
-        drop = np.array([g.is_empty for g in df.geometry.tolist()])
-        if len(drop) > 0:
-            df = df.loc[~drop]
+        df = df.loc[keep]
+        df['geometry'] = clipped
         print('remaining lines: {:,d}'.format(len(df)))
         if inplace:
             self.df = df
@@ -229,7 +259,8 @@ class Lines:
             return df
         print("finished in {:.2f}s\n".format(time.time() - ta))
 
-    def intersect(self, grid, size_thresh=1e5):
+    def intersect(self, grid, size_thresh=1e5, engine='auto', n_workers=None,
+                  tile_size=None):
         """Intersect linework with a model grid.
 
         Parameters
@@ -240,7 +271,40 @@ class Lines:
             Determines whether spatial indexing will be used. If
             number of grid cells x number of flowlines > size_thresh,
             a spatial index (rtree package) will be used to speed
-            up the intersections.
+            up the intersections. Only used with ``engine='auto'``.
+        engine : str, {'auto', 'simple', 'rtree', 'strtree', 'structured'}
+            Method for finding the grid cells intersected by each flowline.
+
+            * 'auto': use 'simple' for small problems (see ``size_thresh``),
+              otherwise 'rtree'
+            * 'simple': test every flowline against every grid cell
+              (:func:`sfrmaker.gis.intersect`)
+            * 'rtree': query an rtree index of the grid cells
+              one flowline at a time (:func:`sfrmaker.gis.intersect_rtree`)
+            * 'strtree': bulk query of a packed STR tree index of the
+              grid cells (:func:`sfrmaker.gis.intersect_strtree`); usually
+              the fastest option for large grids.
+            * 'structured': walk each flowline through the row/column
+              lattice of a :class:`~sfrmaker.grid.StructuredGrid`
+              (:func:`sfrmaker.reaches.create_reaches_structured`),
+              without intersecting any cell polygons. Requires a structured
+              grid with a valid :attr:`~sfrmaker.grid.StructuredGrid.lattice`
+              (for example, created with
+              :meth:`~sfrmaker.grid.StructuredGrid.from_modelgrid`).
+
+            By default, 'auto'.
+        n_workers : int, optional
+            Number of worker processes to use for creating reaches
+            from the intersected flowlines (see :func:`sfrmaker.reaches.setup_reach_data`).
+            By default, None (serial processing).
+        tile_size : int or tuple of ints, optional
+            Option to intersect the flowlines with a
+            :class:`~sfrmaker.grid.StructuredGrid` in tiles of
+            tile_size rows and columns (or (rows, columns)), so that cell
+            Polygons are only created for one tile (per worker) at a time
+            (see :func:`sfrmaker.reaches.setup_reach_data_tiled`). Results
+            are the same as with ``engine='strtree'``, which is used
+            within each tile. By default, None (no tiling).
 
         Returns
         -------
@@ -248,32 +312,113 @@ class Lines:
             DataFrame containing intersected reaches with grid cell information
             and original linework IDs.
         """
-        from .gis import intersect, intersect_rtree
+        from .gis import intersect, intersect_rtree, intersect_strtree
 
         # to_crs the flowlines if they aren't in same CRS as grid
         if self.crs != grid.crs:
             self.to_crs(grid.crs)
 
-        grid_polygons = grid.df.geometry.tolist()
         stream_linework = self.df.geometry.tolist()
         id_list = self.df.id.tolist()
 
-        ncells, nlines = len(grid_polygons), len(stream_linework)
+        ncells, nlines = grid.size, len(stream_linework)
         print("\nIntersecting {:,d} flowlines with {:,d} grid cells...".format(nlines, ncells))
-        # building the spatial index takes a while
-        # only use spatial index if number of tests exceeds size_thresh
-        size = ncells * nlines
-        # don't spend time on a spatial index if it isn't created and problem is small
-        if size < size_thresh and grid._idx is None:
+        if engine == 'auto':
+            # building the spatial index takes a while
+            # only use spatial index if number of tests exceeds size_thresh
+            size = ncells * nlines
+            # don't spend time on a spatial index if it isn't created and problem is small
+            if size < size_thresh and grid._idx is None:
+                engine = 'simple'
+            else:
+                engine = 'rtree'
+        if tile_size is not None:
+            if not isinstance(grid, StructuredGrid):
+                raise ValueError("tile_size requires a StructuredGrid")
+            if engine == 'structured':
+                raise ValueError("engine='structured' doesn't intersect cell polygons; "
+                                 "use it without tile_size")
+            reach_data = setup_reach_data_tiled(stream_linework, id_list, grid,
+                                                tile_size=tile_size, n_workers=n_workers)
+            return self._finish_reach_data(reach_data, grid)
+
+        lattice = None
+        grid_polygons = None
+        grid_intersections = None
+        if engine == 'structured':
+            if isinstance(grid, StructuredGrid):
+                lattice = grid.lattice
+            if lattice is None:
+                raise ValueError("engine='structured' requires a StructuredGrid with "
+                                 "xul, yul and row/column spacings (see StructuredGrid.lattice)")
+        elif engine == 'simple':
+            grid_polygons = grid.get_cell_polygons()
             grid_intersections = intersect(grid_polygons, stream_linework)
-        else:
+        elif engine == 'rtree':
+            grid_polygons = grid.get_cell_polygons()
             idx = grid.spatial_index
             grid_intersections = intersect_rtree(grid_polygons, stream_linework, index=idx)
+        elif engine == 'strtree':
+            grid_polygons = grid.get_cell_polygons()
+            grid_intersections = intersect_strtree(grid_polygons, stream_linework)
+        else:
+            raise ValueError('Unrecognized intersection engine: {}'.format(engine))
 
         # create preliminary reaches
         reach_data = setup_reach_data(stream_linework, id_list,
-                                      grid_intersections, grid_polygons, tol=.001)
+                                      grid_intersections, grid_polygons, tol=.001,
+                                      lattice=lattice, n_workers=n_workers)
+        return self._finish_reach_data(reach_data, grid)
+
+    def _update_reach_data(self, sfrdata, changed_ids, grid, **kwargs):
+        """Update the preliminary reaches (from :meth:`intersect`) retained by
+        an SFRData instance created with :meth:`to_sfr`, by only intersecting
+        lines that changed (changed_ids) or weren't in the previous lines.
+        Reaches for lines that are no longer in the lines are dropped.
 
+        Parameters
+        ----------
+        sfrdata : SFRData
+            SFR dataset previously created with :meth:`to_sfr`.
+        changed_ids : sequence
+            IDs of lines with modified geometries.
+        grid : instance of sfrmaker.grid
+        kwargs : keyword arguments to :meth:`intersect`
+
+        Returns
+        -------
+        reach_data : DataFrame
+            Same as the output of :meth:`intersect` for all of the lines.
+        """
+        if sfrdata._lines_reach_data is None:
+            raise ValueError("Incremental updates require an SFRData instance "
+                             "created with Lines.to_sfr")
+        if changed_ids is None:
+            changed_ids = []
+        ids = self.df.id.tolist()
+        intersect_ids = set(changed_ids).union(set(ids).difference(sfrdata._lines_ids))
+        is_changed = self.df.id.isin(intersect_ids)
+        print('\nReusing reaches for {:,d} unchanged lines...'.format(np.sum(~is_changed)))
+        previous = sfrdata._lines_reach_data
+        reach_data = previous.loc[previous.line_id.isin(ids) &
+                                  ~previous.line_id.isin(intersect_ids)].copy()
+        if np.any(is_changed):
+            changed = copy.copy(self)
+            changed.df = self.df.loc[is_changed]
+            reach_data = pd.concat([reach_data, changed.intersect(grid, **kwargs)])
+
+        # renumber the segments and reaches,
+        # in the same order as the lines (as in intersect)
+        segment = dict(zip(ids, range(1, len(ids) + 1)))
+        reach_data['iseg'] = reach_data.line_id.map(segment).values
+        reach_data = reach_data.sort_values(by=['iseg', 'ireach'])
+        reach_data.index = range(len(reach_data))
+        reach_data['rno'] = np.arange(len(reach_data)) + 1
+        return self._finish_reach_data(reach_data, grid)
+
+    def _finish_reach_data(self, reach_data, grid):
+        """Add names and row, column information to the preliminary
+        reaches from :meth:`intersect`."""
         column_order = ['node', 'k', 'i', 'j', 'rno',
                         'ireach', 'iseg', 'line_id', 'name', 'geometry']
 
@@ -350,12 +495,16 @@ class Lines:
                        attr_length_units='meters', attr_height_units='meters',
                        filter=None,
                        crs=None, epsg=None, proj_str=None, prjfile=None):
-        """Create a Lines instance from a shapefile.
+        """Create a Lines instance from a shapefile, or from a
+        GeoParquet (.parquet) or Feather (.feather) file written by
+        :func:`sfrmaker.fileio.write_table`.
 
         Parameters
         ----------
         shapefile : str
-            Input shapefile
+            Input shapefile, or GeoParquet or Feather file. The CRS of
+            GeoParquet and Feather files is read from the file metadata
+            (unless a CRS is specified with one of the arguments below).
         id_column : str, optional
             Attribute field with line identifiers, 
             by default 'id'
@@ -406,7 +555,12 @@ class Lines:
         """        
         
 
-        if prjfile is None:
+        columnar = is_columnar_file(shapefile)
+        if columnar:
+            df = read_features(shapefile)
+            if all(arg is None for arg in (crs, epsg, proj_str, prjfile)):
+                crs = df.attrs.get('crs')
+        elif prjfile is None:
             prjfile = shapefile.replace('.shp', '.prj')
             prjfile = prjfile if os.path.exists(prjfile) else None
 
@@ -416,7 +570,10 @@ class Lines:
         if filter is not None and not isinstance(filter, tuple):
             filter = get_bbox(filter, shpfile_crs)
 
-        df = shp2df(shapefile, filter=filter)
+        if not columnar:
+            df = shp2df(shapefile, filter=filter)
+        elif filter is not None:
+            df = filter_features(df, filter)
         assert 'geometry' in df.columns, "No feature geometries found in {}.".format(shapefile)
 
         return cls.from_dataframe(df,
@@ -430,7 +587,7 @@ class Lines:
                                   name_column=name_column,
                                   attr_length_units=attr_length_units,
                                   attr_height_units=attr_height_units,
-                                  epsg=epsg, proj_str=proj_str, prjfile=prjfile)
+                                  crs=crs, epsg=epsg, proj_str=proj_str, prjfile=prjfile)
 
     @classmethod
     def from_dataframe(cls, df,
@@ -445,7 +602,7 @@ class Lines:
                        name_column='name',
                        attr_length_units='meters',
                        attr_height_units='meters',
-                       epsg=None, proj_str=None, prjfile=None):
+                       crs=None, epsg=None, proj_str=None, prjfile=None):
         """[summary]
 
         Parameters
@@ -453,6 +610,8 @@ class Lines:
         df : DataFrame
             Pandas DataFrame with flowline information, including
             shapely :class:`LineStrings <LineString>` in a `'geometry'` column.
+            Geometries can also be in well-known binary (WKB) format
+            (for example, from a GeoParquet file read with :func:`pandas.read_parquet`).
         id_column : str, optional
             Attribute field with line identifiers, 
             by default 'id'
@@ -486,6 +645,9 @@ class Lines:
         filter : tuple, optional
             (xmin, ymin, xmax, ymax) bounding box to filter which records 
             are read from the shapefile. By default None.
+        crs : obj, optional
+            Coordinate reference system for features in the DataFrame;
+            anything accepted by :meth:`pyproj.crs.CRS.from_user_input`.
         epsg: int, optional
             EPSG code identifying Coordinate Reference System (CRS)
             for features in the input shapefile.
@@ -536,10 +698,12 @@ class Lines:
             else:
                 assert isinstance(df[c], pd.Series)
         df = df[column_order].copy()
+        if len(df) > 0 and isinstance(df['geometry'].iloc[0], bytes):
+            df['geometry'] = [shapely.wkb.loads(g) for g in df['geometry']]
 
         return cls(df, attr_length_units=attr_length_units,
                    attr_height_units=attr_height_units,
-                   epsg=epsg, proj_str=proj_str, prjfile=prjfile)
+                   crs=crs, epsg=epsg, proj_str=proj_str, prjfile=prjfile)
 
 
     @classmethod
@@ -630,6 +794,8 @@ class Lines:
                consolidate_conductance=False, one_reach_per_cell=False,
                add_outlets=None,
                package_name=None,
+               engine='auto', n_workers=None, tile_size=None,
+               previous_sfrdata=None, changed_ids=None,
                **kwargs):
         """Create a streamflow routing dataset from the information
         in sfrmaker.lines class instance and a supplied sfrmaker.grid class instance.
@@ -687,6 +853,26 @@ class Lines:
             prevent double-counting of flow. By default, None
         package_name : str
             Base name for writing sfr output.
+        engine : str, {'auto', 'simple', 'rtree', 'strtree', 'structured'}
+            Method for intersecting the flowlines with the model grid.
+            See :meth:`Lines.intersect`. By default, 'auto'.
+        n_workers : int, optional
+            Number of worker processes to use for creating reaches.
+            See :meth:`Lines.intersect`. By default, None (serial processing).
+        tile_size : int or tuple of ints, optional
+            Option to intersect the flowlines with the model grid in tiles of
+            tile_size rows and columns, to limit memory use with very large grids.
+            See :meth:`Lines.intersect`. By default, None (no tiling).
+        previous_sfrdata : SFRData, optional
+            SFR dataset previously created from an earlier version of
+            these lines with this method. If supplied, the preliminary reaches
+            from previous_sfrdata are reused for the lines that haven't changed,
+            and only the lines in changed_ids (and any new lines) are intersected
+            with the model grid. Usually called via
+            :meth:`SFRData.update_from_lines`. By default, None.
+        changed_ids : sequence, optional
+            IDs of lines with modified geometries, for use with ``previous_sfrdata``.
+            By default, None.
         kwargs : keyword arguments to :class:`SFRData`
 
         Returns
@@ -716,6 +902,20 @@ class Lines:
         # print grid information to screen
         print(grid)
 
+        # arguments for incremental updates (see SFRData.update_from_lines)
+        to_sfr_kwargs = dict(grid=grid, model=model,
+                             model_length_units=model_length_units,
+                             model_time_units=model_time_units,
+                             minimum_reach_length=minimum_reach_length,
+                             width_from_asum_a_param=width_from_asum_a_param,
+                             width_from_asum_b_param=width_from_asum_b_param,
+                             minimum_reach_width=minimum_reach_width,
+                             consolidate_conductance=consolidate_conductance,
+                             one_reach_per_cell=one_reach_per_cell,
+                             add_outlets=add_outlets, package_name=package_name,
+                             engine=engine, n_workers=n_workers, tile_size=tile_size,
+                             **kwargs)
+
         # print model information to screen
         print(model)
 
@@ -729,7 +929,7 @@ class Lines:
             self.to_crs(grid.crs)
         # cull the flowlines to the active part of the model grid
         if grid.active_area is not None:
-            self.cull(grid.active_area, inplace=True, simplify=True, tol=2000)
+            self.cull(grid.active_area, inplace=True)
         elif grid._bounds is not None:  # cull to grid bounding box if already computed
             self.cull(box(*grid._bounds), inplace=True)
         if package_name is None:
@@ -757,7 +957,14 @@ class Lines:
                         for i in self.df.id.tolist()]
 
         # intersect lines with model grid to get preliminary reaches
-        rd = self.intersect(grid)
+        if previous_sfrdata is None:
+            rd = self.intersect(grid, engine=engine, n_workers=n_workers,
+                                tile_size=tile_size)
+        else:
+            rd = self._update_reach_data(previous_sfrdata, changed_ids, grid,
+                                         engine=engine, n_workers=n_workers,
+                                         tile_size=tile_size)
+        lines_reach_data = rd.copy()
 
         # length of intersected line fragments (in model units)
         rd['rchlen'] = np.array([g.length for g in rd.geometry]) * gis_mult
@@ -842,7 +1049,7 @@ class Lines:
         # set minimum reach length based on cell size
         thresh = 0.05  # fraction of cell length (based on square root of area)
         if minimum_reach_length is None:
-            cellgeoms = grid.df.loc[rd.node.values, 'geometry']
+            cellgeoms = grid.get_cell_polygons(rd.node.values)
             mean_area = np.mean([g.area for g in cellgeoms])
             minimum_reach_length = np.sqrt(mean_area) * thresh * gis_mult
 
@@ -869,19 +1076,13 @@ class Lines:
         # routing and paths properties should update automatically
         # when id and toid columns are changed in self.df
         # but only rd (reach_data) has been changed
-        new_routing = {}
-        paths = self.paths.copy()
-        # for each segment
-        for k in remaining_ids:
-            # interate through successive downstream segments
-            for s in paths[k][1:]:
-                # assign the first segment that still exists as the outseg
-                if s in remaining_ids:
-                    new_routing[k] = s
-                    break
-            # if no segments are left downstream, assign outlet
-            if k not in new_routing.keys():
-                new_routing[k] = 0
+        # for each segment, assign the first downstream segment
+        # that still exists as the outseg
+        new_routing = self.routing_graph.get_next_in_subset(remaining_ids,
+                                                            ids=remaining_ids)
+        # if no segments are left downstream, assign outlet
+        new_routing = {k: v if v is not None else 0
+                       for k, v in new_routing.items()}
 
         # add any outlets to the stream network
         # for now handle int or str ids
@@ -961,5 +1162,9 @@ class Lines:
                        model=model, model_length_units=model_length_units,
                        model_time_units=model_time_units,
                        package_name=package_name, **kwargs)
+        # retain the preliminary reaches, for incremental updates
+        sfrd._lines_reach_data = lines_reach_data
+        sfrd._lines_ids = set(self.df.id)
+        sfrd._to_sfr_kwargs = to_sfr_kwargs
         print("\nTime to create sfr dataset: {:.2f}s\n".format(time.time() - totim))
         return sfrd
@@ -118,10 +118,8 @@ class Mf6SFR:
         self._package_data = None
 
         # connection info (doesn't support diversions)
+        # (setting the graph resets the connections, which are filled by properties)
         self.graph = dict(zip(self.rd.rno, self.rd.outreach))
-        self._graph_r = None  # filled by properties
-        self.outlets = None
-        self._connections = None
 
         # diversions
         self.diversions = None
@@ -130,12 +128,30 @@ class Mf6SFR:
 
         self.dimensions_block = '\nBEGIN Dimensions\n  NREACHES {:d}\nEND Dimensions\n'.format(self.nreaches)
 
+    @property
+    def graph(self):
+        """Dictionary of routing connections {rno: outreach}."""
+        return self._graph
+
+    @graph.setter
+    def graph(self, graph):
+        self._graph = graph
+        self._graph_r = None
+        self.outlets = None
+        self._connections = None
+        self._connection_arrays = None
+
     @property
     def graph_r(self):
         if self._graph_r is None:
-            outreaches = np.unique(self.rd.outreach)
-            self._graph_r = {o: self.rd.rno[self.rd.outreach == o].tolist()
-                             for o in outreaches}
+            # group the reach numbers by outreach (in reach_data order)
+            outreach = self.rd.outreach.values
+            order = np.argsort(outreach, kind='stable')
+            outreaches, start = np.unique(outreach[order], return_index=True)
+            end = np.append(start[1:], len(order)).tolist()
+            rnos = self.rd.rno.values[order].tolist()
+            self._graph_r = {o: rnos[i0:i1] for o, i0, i1 in
+                             zip(outreaches.tolist(), start.tolist(), end)}
             self.outlets = self._graph_r[0]
             del self._graph_r[0]
         return self._graph_r
@@ -166,22 +182,53 @@ class Mf6SFR:
 
     @property
     def connections(self):
+        """Dictionary of connections (downstream reach as a negative
+        number, followed by any upstream reaches) for each reach."""
         if self._connections is None:
-            connections = {}
-            for rno in np.arange(self.nreaches) + 1:
-                outreach = self.graph.get(rno)
-                #for rno, v in self.graph.items():
-                cnk = []
-                # downstream reach
-                if outreach not in {0, None}:  # outlets aren't explicit in MF6
-                    cnk += [-outreach]
-                # upstream reaches
-                if rno in self.graph_r.keys():
-                    cnk += list(self.graph_r[rno])
-                connections[rno] = cnk
-            self._connections = connections
+            self._connection_arrays = self._get_connection_arrays()
+            offsets, values = self._connection_arrays
+            values = values.tolist()
+            self._connections = {rno: values[offsets[rno - 1]:offsets[rno]]
+                                 for rno in range(1, len(offsets))}
         return self._connections
 
+    @property
+    def connection_arrays(self):
+        """Connections for reaches 1 through nreaches, in compressed
+        sparse row format: a 1D array of offsets into a 1D array of
+        connection values, so that the connections for reach rno are
+        values[offsets[rno - 1]:offsets[rno]]."""
+        if self._connection_arrays is None:
+            self._connection_arrays = self._get_connection_arrays()
+        return self._connection_arrays
+
+    def _get_connection_arrays(self):
+        n = self.nreaches
+        # downstream reaches (from the routing graph)
+        rno = np.array(list(self.graph.keys()), dtype=int)
+        outreach = np.array(list(self.graph.values()), dtype=int)
+        valid = (rno >= 1) & (rno <= n)
+        downstream = np.zeros(n, dtype=int)
+        downstream[rno[valid] - 1] = outreach[valid]
+        has_downstream = downstream != 0  # outlets aren't explicit in MF6
+
+        # upstream reaches, grouped by the reach they route to
+        rno, outreach = self.rd.rno.values, self.rd.outreach.values
+        valid = (outreach >= 1) & (outreach <= n)
+        order = np.argsort(outreach[valid], kind='stable')
+        upstream = rno[valid][order]
+        upstream_of = outreach[valid][order]
+        nupstream = np.bincount(upstream_of - 1, minlength=n)
+
+        offsets = np.zeros(n + 1, dtype=int)
+        offsets[1:] = np.cumsum(has_downstream + nupstream)
+        values = np.zeros(offsets[-1], dtype=int)
+        values[offsets[:-1][has_downstream]] = -downstream[has_downstream]
+        rank = np.arange(len(upstream)) - np.searchsorted(upstream_of, upstream_of)
+        positions = offsets[upstream_of - 1] + has_downstream[upstream_of - 1] + rank
+        values[positions] = upstream
+        return offsets, values
+
     @property
     def period_data(self):
         if self._period_data is None:
@@ -228,7 +275,11 @@ class Mf6SFR:
 
         packagedata['rwid'] = rwid
         packagedata['man'] = man
-        packagedata['ncon'] = [len(self.connections.get(k, [])) for k in packagedata.rno]
+        offsets, _ = self.connection_arrays
+        ncon = np.zeros(len(offsets) + 1, dtype=int)
+        ncon[1:-1] = np.diff(offsets)
+        rno = packagedata.rno.values
+        packagedata['ncon'] = ncon[np.where((rno >= 1) & (rno < len(offsets)), rno, 0)]
         packagedata['ustrf'] = 1.
         packagedata['ndv'] = 0
 
@@ -256,7 +307,8 @@ class Mf6SFR:
         return segment_data_to_period_data(self.sd, self.rd)
 
     def write_file(self, filename=None, outpath='', options=None,
-                   external_files_path=None):
+                   external_files_path=None, external_period_data=None,
+                   skip_unchanged_periods=False):
         """Write a MODFLOW-6 format SFR package file.
 
         Parameters
@@ -283,12 +335,38 @@ class Mf6SFR:
             Path for writing an external file for packagedata, relative to the location of the SFR package file.
             If specified, an open/close statement referencing the file is written to the packagedata block.
             By default, None (packagedata table is written to the SFR package file)
+        external_period_data : str, {None, 'period', 'variable'}
+            Option to write the period data to external files
+            (in external_files_path, or with the SFR package file), referenced by
+            open/close statements in the period blocks.
+
+            * None: period data are written to the SFR package file (default)
+            * 'period': one file for each stress period
+            * 'variable': one file for each variable (e.g. inflow or runoff)
+              in each stress period
+
+        skip_unchanged_periods : bool, optional
+            Option to omit period blocks that are the same as the
+            previous period block. In MODFLOW 6, SFR settings
+            are carried forward until they are changed, so the omitted
+            blocks are implied. By default, False.
 
         Raises
         ------
         OSError
             If an invalid external_files_path is specified.
+        ValueError
+            If an invalid external_period_data option is specified.
+
+        Notes
+        -----
+        The period data are written one stress period at a time,
+        so that only one period block is held in memory (as text)
+        at a time.
         """        
+        if external_period_data not in {None, 'period', 'variable'}:
+            raise ValueError("Invalid external_period_data option: {}; "
+                             "options are None, 'period' or 'variable'".format(external_period_data))
         if filename is not None:
             outfile = filename
             outpath = os.path.split(filename)[0]
@@ -347,28 +425,70 @@ class Mf6SFR:
             output.write('END Packagedata\n')
 
             output.write('\nBEGIN Connectiondata\n')
-            #for i in range(1, self.nreaches + 1):
-            #    if i in self.connections.keys():
-            #        output.write('  {} {}\n'.format(i, ' '.join(map(str, self.connections[i]))))
-            for rno, connections in self.connections.items():
-                connections = ' '.join(map(str, self.connections[rno]))
-                output.write(f'  {rno} {connections}\n')
+            output.write(connectiondata_to_text(*self.connection_arrays))
             output.write('END Connectiondata\n')
 
             # skip the diversions block for now
             if self.period_data is not None:
-                periods = self.period_data.groupby('per')
-                for per, group in periods:
+                basename = os.path.splitext(os.path.split(outfile)[-1])[0]
+                if external_files_path:
+                    rel_path, full_path = external_files_path, full_external_files_path
+                else:
+                    rel_path, full_path = '', outpath
+                last_block = None
+                for per, block in self._get_period_blocks():
+                    # write each block to a text buffer, to compare with the last block
+                    if external_period_data == 'variable':
+                        # a separate external file for each variable
+                        text = {var: block.loc[block['var'] == var].to_csv(
+                                sep=' ', index=False, header=False)
+                                for var in block['var'].unique()}
+                    else:
+                        text = {None: block.to_csv(sep=' ', index=False, header=False)}
+                    if skip_unchanged_periods and text == last_block:
+                        continue
+                    last_block = text
                     output.write('\nBEGIN Period {}\n'.format(per + 1))
-                    group = group.replace('ACTIVE', np.nan)
-                    assert np.array_equal(group.index.values, group.rno.values)
-                    datacols = {'inflow', 'manning', 'rainfall', 'evaporation', 'runoff', 'stage'}
-                    datacols = datacols.intersection(group.columns)
-                    group = group.loc[:, datacols]
-                    group.stack().to_csv(output, sep=' ', index=True, header=False)
+                    for var, lines in text.items():
+                        if external_period_data is None:
+                            output.write(lines)
+                            continue
+                        if var is None:
+                            period_outfile = '{}_period_{}.dat'.format(basename, per + 1)
+                        else:
+                            period_outfile = '{}_{}_period_{}.dat'.format(basename, var, per + 1)
+                        output.write('  open/close {}\n'.format(os.path.join(rel_path, period_outfile)))
+                        with open(os.path.join(full_path, period_outfile), 'w', newline="") as dest:
+                            dest.write(lines)
                     output.write('END Period {}\n'.format(per + 1))
         print('wrote {}'.format(outfile))
 
+    def _get_period_blocks(self):
+        """Generator yielding the period data for each stress period,
+        in long format (rno, var, value; as written to the period blocks).
+        Periods are sliced from the period_data table one at a time,
+        and variables without values (nans) are dropped.
+        """
+        period_data = self.period_data
+        if len(period_data) == 0:
+            return
+        datacols = [c for c in ['inflow', 'manning', 'rainfall', 'evaporation', 'runoff', 'stage']
+                    if c in period_data.columns]
+        if not period_data.per.is_monotonic_increasing:
+            period_data = period_data.sort_values(by='per', kind='mergesort')
+        pers = period_data.per.values
+        starts = np.flatnonzero(np.r_[True, np.diff(pers) != 0])
+        ends = np.r_[starts[1:], len(pers)]
+        for start, end in zip(starts, ends):
+            group = period_data.iloc[start:end]
+            assert np.array_equal(group.index.values, group.rno.values)
+            values = group[datacols].values.astype(float)
+            valid = ~np.isnan(values)
+            block = pd.DataFrame({'rno': np.repeat(group.index.values, len(datacols)),
+                                  'var': np.tile(datacols, len(group)),
+                                  'value': values.ravel()})
+            yield int(pers[start]), block.loc[valid.ravel()]
+
 
 class mf6sfr(Mf6SFR):
     def __init__(self, *args, **kwargs):
@@ -377,8 +497,31 @@ class mf6sfr(Mf6SFR):
         Mf6SFR.__init__(self, *args, **kwargs)
 
 
+def connectiondata_to_text(offsets, values):
+    """Format connections in compressed sparse row format
+    (see :attr:`Mf6SFR.connection_arrays`) as MODFLOW 6
+    SFR Connectiondata block entries (one line per reach).
+    """
+    nreaches = len(offsets) - 1
+    counts = np.diff(offsets)
+    row = np.arange(nreaches)
+    # sequence of text fragments: a reach number, its connections, then a line end
+    fragments = np.empty(len(values) + 2 * nreaches, dtype=object)
+    heads = np.char.add('  ', (row + 1).astype(str))
+    # (unconnected reaches are written with a trailing space)
+    heads[counts == 0] = np.char.add(heads[counts == 0], ' ')
+    fragments[offsets[:-1] + 2 * row] = heads
+    fragments[np.arange(len(values)) + 2 * np.repeat(row, counts) + 1] = \
+        np.char.add(' ', values.astype(str))
+    fragments[offsets[1:] + 2 * row + 1] = '\n'
+    return ''.join(fragments)
+
+
 def segment_data_to_period_data(segment_data, reach_data):
     """Convert modflow-2005 style segment data to modflow-6 period data.
+    Segment values for all stress periods are broadcast to the reaches
+    in each segment at once, using reach length fractions
+    (and distances along each segment) that are computed once.
     """
     idx_cols = ['per', 'iseg', 'ireach', 'rno', 'icalc']
     variable_cols = ['status', 'evaporation', 'inflow', 'rainfall', 'runoff', 'stage']
@@ -405,64 +548,92 @@ def segment_data_to_period_data(segment_data, reach_data):
     if len(prd) == 0:
         return pd.DataFrame(columns=idx_cols + variable_cols)
 
-    # get rno for reach 1s
-    segroups = rd.groupby('iseg')
-    reach1IDs = segroups.first()['rno'].to_dict()
-    prd['rno'] = [reach1IDs[i + 1] for i in prd.index]
-    # prd['rainfall'] = np.random.randn(len(prd))
-
     #  distribute other variables to all reaches
     cols = {'inflow', 'manning', 'rainfall', 'evaporation', 'runoff',
             'depth1', 'depth2'}
     cols = set(prd.columns).intersection(cols)
-    icalc = dict(zip(zip(sd.nseg, sd.per), sd.icalc))
+    # icalc values by segment and stress period
+    # (the last value, for any duplicate segment/period entries)
+    icalc = sd.drop_duplicates(subset=['nseg', 'per'], keep='last').set_index(['nseg', 'per'])['icalc']
     if len(cols) == 0:
         return None
-    elif len(cols) > 0:
-        print('distributing values to reaches:\n')
-        for c in cols.difference({'depth1', 'depth2'}):
-            print('{} -> {}...'.format(Mf6SFR.mf5names[c], c))
-        if np.min(list(icalc.values())) < 1:
-            print('strtop, depth1 & depth2 -> stage for icalc<1...')
-        reaches = []
-        # iterate through segments in prd (multiple periods)
-        for i, r in prd.iterrows():
-            seg, per = int(r.nseg), int(r.per)
-            df = pd.DataFrame(segroups.get_group(seg)[['rno', 'rchlen', 'ireach']])
-            df.rename(columns={'reachID': 'rno'}, inplace=True)
-            df['iseg'] = seg
-            df['lenfrac'] = df.rchlen / df.rchlen.sum()
-            df['per'] = per
-            df['icalc'] = icalc[(seg, per)]
-            for c in cols:
-                if c == 'runoff':
-                    df[c] = r[c] * df.lenfrac  # length-weighted mean
-                elif c == 'inflow':  # only assign to reach1
-                    inflow = np.zeros(len(df)) * np.nan
-                    inflow[0] = r.inflow
-                    df['inflow'] = inflow
-                elif c in {'manning', 'rainfall', 'evaporation'}:
-                    df[c] = r[c]  # values already normalized to area
-
-            # distribute depth values from stress period data
-            # this will only populate stages where depth1/depth2 were >0
-            if icalc[(seg, per)] < 1 and 'depth1' in cols:
-                df['status'] = 'SIMPLE'
-
-                # interpolate depth1 and depth2 to reaches
-                dist = (np.cumsum(df.rchlen) - 0.5 * df.rchlen).values
-                fp = [r.depth1, r.depth2]
-                xp = [dist[0], dist[-1]]
-                depth = np.interp(dist, xp, fp)
-                strtop = segroups.get_group(r.nseg).strtop.values
-                df['stage'] = strtop + depth
-            else:
-                df['status'] = 'ACTIVE'
-
-            # drop out rows that didn't have any data
-            df.dropna(subset=cols.difference({'depth1', 'depth2'}), inplace=True)
-            reaches.append(df)
-        distributed = pd.concat(reaches)
+    print('distributing values to reaches:\n')
+    for c in cols.difference({'depth1', 'depth2'}):
+        print('{} -> {}...'.format(Mf6SFR.mf5names[c], c))
+    if sd.icalc.min() < 1:
+        print('strtop, depth1 & depth2 -> stage for icalc<1...')
+
+    # reach information, grouped by segment (in reach_data order within each segment);
+    # length fractions and distances along each segment are computed once
+    reaches = rd.iloc[np.argsort(rd.iseg.values, kind='stable')]
+    reach_iseg = reaches.iseg.values
+    rchlen = reaches.rchlen.values
+    is_reach1 = np.r_[True, np.diff(reach_iseg) != 0]
+    lenfrac = np.zeros(len(reaches))
+    dist = np.zeros(len(reaches))
+    first_dist = np.zeros(len(reaches))
+    last_dist = np.zeros(len(reaches))
+    start = np.flatnonzero(is_reach1)
+    for i0, i1 in zip(start, np.r_[start[1:], len(reaches)]):
+        seg_rchlen = rchlen[i0:i1]
+        lenfrac[i0:i1] = seg_rchlen / seg_rchlen.sum()
+        seg_dist = np.cumsum(seg_rchlen) - 0.5 * seg_rchlen
+        dist[i0:i1] = seg_dist
+        first_dist[i0:i1] = seg_dist[0]
+        last_dist[i0:i1] = seg_dist[-1]
+
+    # broadcast each segment/period record in prd to the reaches in the segment
+    seg = prd.nseg.values.astype(int)
+    per = prd.per.values.astype(int)
+    seg_per = pd.DataFrame({'nseg': prd.nseg.values, 'per': prd.per.values})
+    seg_icalc = seg_per.merge(icalc.reset_index(), how='left',
+                              on=['nseg', 'per'])['icalc'].values
+    start = np.searchsorted(reach_iseg, seg, side='left')
+    counts = np.searchsorted(reach_iseg, seg, side='right') - start
+    offsets = np.repeat(start - np.cumsum(counts) + counts, counts)
+    ridx = offsets + np.arange(counts.sum())  # positions in reaches
+    pidx = np.repeat(np.arange(len(prd)), counts)  # positions in prd
+
+    distributed = pd.DataFrame({'rno': reaches.rno.values[ridx],
+                                'rchlen': rchlen[ridx],
+                                'ireach': reaches.ireach.values[ridx],
+                                'iseg': seg[pidx],
+                                'lenfrac': lenfrac[ridx],
+                                'per': per[pidx],
+                                'icalc': seg_icalc[pidx]})
+    for c in cols:
+        values = prd[c].values.astype(float)[pidx]
+        if c == 'runoff':
+            distributed[c] = values * distributed.lenfrac.values  # length-weighted mean
+        elif c == 'inflow':  # only assign to reach1
+            distributed[c] = np.where(is_reach1[ridx], values, np.nan)
+        elif c in {'manning', 'rainfall', 'evaporation'}:
+            distributed[c] = values  # values already normalized to area
+
+    # distribute depth values from stress period data
+    # this will only populate stages where depth1/depth2 were >0
+    simple = np.zeros(len(distributed), dtype=bool)
+    if 'depth1' in cols:
+        simple = distributed.icalc.values < 1
+    distributed['status'] = np.where(simple, 'SIMPLE', 'ACTIVE')
+    if np.any(simple):
+        # interpolate depth1 and depth2 to reaches
+        # (linearly between the first and last reach midpoints, as in np.interp)
+        depth1 = prd.depth1.values.astype(float)[pidx]
+        depth2 = prd.depth2.values.astype(float)[pidx]
+        x, x0, x1 = dist[ridx], first_dist[ridx], last_dist[ridx]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (depth2 - depth1) / (x1 - x0)
+            depth = slope * (x - x0) + depth1
+            # (with the same handling of the end points and non-finite values)
+            depth = np.where(np.isnan(depth), slope * (x - x1) + depth2, depth)
+        depth = np.where(np.isnan(depth) & (depth1 == depth2), depth1, depth)
+        depth = np.where(x == x0, depth1, depth)
+        depth = np.where(x >= x1, depth2, depth)
+        distributed['stage'] = np.where(simple, reaches.strtop.values[ridx] + depth, np.nan)
+
+    # drop out rows that didn't have any data
+    distributed.dropna(subset=sorted(cols.difference({'depth1', 'depth2'})), inplace=True)
     distributed['per'] = distributed.per.astype(int)
     distributed.index = distributed.rno
     distributed.index.name = 'rno_idx'
@@ -473,7 +644,7 @@ def segment_data_to_period_data(segment_data, reach_data):
     strtop = rd[['rno', 'strtop', 'iseg', 'ireach']].copy()
     strtop.rename(columns={  # 'reachID': 'rno',
         'strtop': 'stage'}, inplace=True)
-    strtop['icalc'] = [icalc[(s, 0)] for s in rd.iseg]
+    strtop['icalc'] = icalc.xs(0, level='per').loc[rd.iseg].values
     strtop.index = strtop.rno
     # cull to only include per=0 reaches where icalc=0 and depth wasn't specified
     per0reaches = distributed.loc[distributed.per == 0, 'rno']
@@ -482,7 +653,7 @@ def segment_data_to_period_data(segment_data, reach_data):
     strtop['status'] = 'SIMPLE'
 
     if len(strtop) > 0:
-        distributed = distributed.append(strtop)
+        distributed = pd.concat([distributed, strtop])
     distributed.sort_values(by=['per', 'rno'], inplace=True)
 
     # rearrange the columns
@@ -1,8 +1,11 @@
 import os
 import time
 import warnings
+import fiona
+import numpy as np
 import pandas as pd
 from gisutils import shp2df, get_shapefile_crs
+from .fileio import is_columnar_file, read_table
 from .gis import get_bbox, get_crs
 
 
@@ -131,11 +134,17 @@ def load_nhdplus_v2(NHDPlus_paths=None,
                   ]
     elevs_cols = ['MAXELEVSMO', 'MINELEVSMO']
 
-    # read flowlines and attribute tables into dataframes
+    # read flowlines into a dataframe, then read only the needed columns
+    # from the attribute tables for the flowlines within the filter
+    # (one basin at a time)
     fl = read_nhdplus(NHDFlowlines, bbox_filter=filter)
-    pfvaa = read_nhdplus(PlusFlowlineVAA)
-    pf = shp2df(PlusFlow)
-    elevs = read_nhdplus(elevslope)
+    comids = fl.index
+    pfvaa = read_nhdplus_table(PlusFlowlineVAA, comids, columns=pfvaa_cols,
+                               index_col='comid')
+    pf = read_nhdplus_table(PlusFlow, comids, columns=['FROMCOMID', 'TOCOMID'],
+                            comid_columns=['FROMCOMID', 'TOCOMID'])
+    elevs = read_nhdplus_table(elevslope, comids, columns=elevs_cols,
+                               index_col='comid')
 
     # join flowline and attribute dataframes
     fl.columns = [c.upper() for c in list(fl)]  # added this, switch all to upper case
@@ -163,39 +172,104 @@ def get_tocomids(pf, fromcomid_list):
     # comids may be missing because they are outside of the model
     # or if the fromcomid_list dataset was edited (resulting in breaks in the routing)
     missing_tocomids = ~pf.TOCOMID.isin(comids) & (pf.TOCOMID != 0)
-    missing = pf.loc[missing_tocomids, ['FROMCOMID', 'TOCOMID']].copy()
-    # recursively crawl the PlusFlow table
+    # crawl the PlusFlow table (for all missing comids at once)
     # to try to find a downstream comid that is in fromcomid_list
-    missing['nextCOMID'] = [find_next_comid(tc, pf, comids)
-                            for tc in missing.TOCOMID]
-    pf.loc[missing_tocomids, 'TOCOMID'] = missing.nextCOMID
+    nextcomids = find_next_comids(pf.loc[missing_tocomids, 'TOCOMID'].values,
+                                  pf, comids)
+    pf.loc[missing_tocomids, 'TOCOMID'] = nextcomids
 
     # set any remaining comids not in fromcomid_list to zero
     # (outlets or inlets from outside model)
     pf.loc[~pf.FROMCOMID.isin(comids), 'FROMCOMID'] = 0
-    tocomid = pf.TOCOMID.values
-    fromcomid = pf.FROMCOMID.values
-    tocomids = [tocomid[fromcomid == c].tolist() for c in comids]
+
+    # group the to-comids by from-comid (in compressed sparse row format)
+    # and then slice out the list for each comid
+    fromcomid, tocomid = _sort_by_fromcomid(pf)
+    comids = np.asarray(comids)
+    start = np.searchsorted(fromcomid, comids, side='left')
+    end = np.searchsorted(fromcomid, comids, side='right')
+    tocomid = tocomid.tolist()
+    tocomids = [tocomid[s:e] for s, e in zip(start, end)]
     print("finished in {:.2f}s\n".format(time.time() - ta))
     return tocomids
 
 
-def find_next_comid(comid, pftable, comids, max_levels=10):
+def _sort_by_fromcomid(pftable):
+    """Return the FROMCOMID and TOCOMID columns of a PlusFlow table,
+    (stable) sorted by FROMCOMID, so that the TOCOMIDs for each FROMCOMID
+    are contiguous and can be located with :func:`numpy.searchsorted`.
+    """
+    fromcomid = pftable.FROMCOMID.values
+    order = np.argsort(fromcomid, kind='stable')
+    return fromcomid[order], pftable.TOCOMID.values[order]
+
+
+def find_next_comids(comids_to_find, pftable, comids, max_levels=10):
     """Crawls the PlusFlow table to find the next downstream comid that
-    is in the set comids. Looks up subsequent downstream comids to a
-    maximum number of iterations, specified by max_levels (default 10).
+    is in the set comids, for each comid in comids_to_find.
+    Looks up subsequent downstream comids to a maximum number of
+    iterations, specified by max_levels (default 10). All comids
+    are crawled simultaneously, one level at a time.
+
+    Parameters
+    ----------
+    comids_to_find : sequence of ints
+        Comids to start crawling from.
+    pftable : DataFrame
+        PlusFlow table with FROMCOMID and TOCOMID columns.
+    comids : sequence of ints
+        Comids to search for (e.g. comids included in the model).
+    max_levels : int
+        Maximum number of downstream links to crawl.
+
+    Returns
+    -------
+    nextcomids : 1D numpy array of ints
+        Next downstream comid in comids for each comid in comids_to_find,
+        or 0 if none was found.
     """
-    pftable = pftable.copy()
-    nextocomid = [comid]
-    comids = set(comids)
+    comids_to_find = np.asarray(comids_to_find, dtype=np.int64)
+    comids = np.unique(np.asarray(comids, dtype=np.int64))
+    fromcomid, tocomid = _sort_by_fromcomid(pftable)
+    nextcomids = np.zeros(len(comids_to_find), dtype=np.int64)
+
+    # crawl frontier, as pairs of (position in comids_to_find, current comid)
+    origin = np.arange(len(comids_to_find))
+    current = comids_to_find
     for i in range(max_levels):
-        nextocomid = pftable.loc[pftable.FROMCOMID.isin(nextocomid), 'TOCOMID'].tolist()
-        if len(set(nextocomid).intersection(comids)) > 0:
-            # if more than one comid is found, simply take the first
+        if len(origin) == 0:
+            break
+        # join the frontier to all of its downstream comids
+        start = np.searchsorted(fromcomid, current, side='left')
+        counts = np.searchsorted(fromcomid, current, side='right') - start
+        offsets = np.repeat(start - np.cumsum(counts) + counts, counts)
+        origin = np.repeat(origin, counts)
+        current = tocomid[offsets + np.arange(counts.sum())].astype(np.int64)
+        # drop duplicate paths
+        if len(origin) > 0:
+            origin, current = np.unique(np.stack([origin, current]),
+                                        axis=1)
+        # resolve any starting comids with downstream comids in comids
+        found = np.isin(current, comids)
+        if np.any(found):
+            # if more than one comid is found, simply take the first (lowest)
             # (often these will be in different levelpaths,
             # so there is no way to determine a preferred routing path)
-            return list(set(nextocomid).intersection(comids))[0]
-    return 0
+            found_origin, first = np.unique(origin[found], return_index=True)
+            nextcomids[found_origin] = current[found][first]
+            resolved = np.isin(origin, found_origin)
+            origin, current = origin[~resolved], current[~resolved]
+    return nextcomids
+
+
+def find_next_comid(comid, pftable, comids, max_levels=10):
+    """Crawls the PlusFlow table to find the next downstream comid that
+    is in the set comids. Looks up subsequent downstream comids to a
+    maximum number of iterations, specified by max_levels (default 10).
+    See :func:`find_next_comids` for crawling multiple comids at once.
+    """
+    return find_next_comids([comid], pftable, comids,
+                            max_levels=max_levels)[0]
 
 
 def read_nhdplus(shpfiles, bbox_filter=None,
@@ -212,3 +286,93 @@ def read_nhdplus(shpfiles, bbox_filter=None,
         else:
             df.index = df[index_col[0]]
         return df
+
+
+def read_nhdplus_table(files, comids=None, columns=None,
+                       comid_columns='comid', index_col=None):
+    """Read NHDPlus attribute tables (e.g. PlusFlowlineVAA, PlusFlow
+    or elevslope), one file (drainage basin) at a time, retaining only
+    the specified columns, and only the rows for the specified COMIDs.
+    Records are streamed from each file, so that only the retained
+    rows and columns are held in memory.
+
+    Parameters
+    ----------
+    files : str or list of strings
+        DBF file or list of DBF files.
+    comids : sequence of ints, optional
+        COMIDs to retain. Rows are retained if the value in
+        any of the ``comid_columns`` is in comids.
+        By default None (all rows are retained).
+    columns : list of strings, optional
+        Columns to retain (matched without regard to case).
+        By default None (all columns are retained).
+    comid_columns : str or list of strings
+        Column(s) to match against ``comids``
+        (without regard to case). By default, 'comid'.
+    index_col : str, optional
+        Column to index the DataFrame by (without regard to case).
+        By default None.
+
+    Returns
+    -------
+    df : DataFrame
+        Table with the retained rows and columns, with column
+        names as they are in the files.
+    """
+    if isinstance(files, str):
+        files = [files]
+    if isinstance(comid_columns, str):
+        comid_columns = [comid_columns]
+    if comids is not None:
+        comids = set(comids)
+    dfs = []
+    for f in files:
+        print("\nreading {}...".format(f))
+        ta = time.time()
+        if is_columnar_file(f):
+            # GeoParquet or Feather table from sfrmaker.preprocessing.cull_flowlines
+            df = read_table(f)
+            names = {name.lower(): name for name in df.columns}
+            nrows = len(df)
+            keep_names = list(names) if columns is None else [c.lower() for c in columns]
+            if index_col is not None:
+                keep_names.append(index_col.lower())
+            match_names = [c.lower() for c in comid_columns] if comids is not None else []
+            missing = set(keep_names).union(match_names).difference(names)
+            if len(missing) > 0:
+                raise IndexError('No {} column(s) found in: \n{}'.format(missing, f))
+            if comids is not None:
+                df = df.loc[np.any([df[names[c]].isin(comids) for c in match_names], axis=0)]
+            dfs.append(df[list(dict.fromkeys(names[c] for c in keep_names))])
+            print("--> retained {:,d} of {:,d} rows in {:.2f}s".format(len(dfs[-1]), nrows,
+                                                                       time.time() - ta))
+            continue
+        with fiona.open(f) as src:
+            names = {name.lower(): name for name in src.schema['properties'].keys()}
+            keep_names = list(names) if columns is None else [c.lower() for c in columns]
+            match_names = [c.lower() for c in comid_columns] if comids is not None else []
+            if index_col is not None:
+                keep_names.append(index_col.lower())
+            missing = set(keep_names).union(match_names).difference(names)
+            if len(missing) > 0:
+                raise IndexError('No {} column(s) found in: \n{}'.format(missing, f))
+            keep = list(dict.fromkeys(names[c] for c in keep_names))
+            match = [names[c] for c in match_names]
+            records = {c: [] for c in keep}
+            nrows = len(src)
+            for feature in src:
+                props = feature['properties']
+                if comids is not None and not any(props[c] in comids for c in match):
+                    continue
+                for c in keep:
+                    records[c].append(props[c])
+        dfs.append(pd.DataFrame(records, columns=keep))
+        print("--> retained {:,d} of {:,d} rows in {:.2f}s".format(len(dfs[-1]), nrows,
+                                                                   time.time() - ta))
+    df = pd.concat(dfs)
+    if index_col is not None:
+        df.index = df[names[index_col.lower()]]
+    else:
+        df.reset_index(drop=True, inplace=True)
+    return df
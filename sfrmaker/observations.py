@@ -4,14 +4,14 @@ Functions for handling observations of SFR package output.
 import os
 import numpy as np
 import pandas as pd
-from shapely.geometry import Polygon
+from shapely.geometry import Point, Polygon
 from gisutils import shp2df
 try:
     import flopy
     fm = flopy.modflow
 except:
     flopy = False
-from .gis import get_shapefile_crs, project
+from .gis import get_shapefile_crs, project, nearest_strtree
 from .fileio import read_tables
 from .routing import get_next_id_in_subset
 
@@ -156,8 +156,11 @@ def add_observations(sfrdata, data, flowline_routing=None,
 
 
 def get_closest_reach(x, y, sfrlines,
-                      rno_column='rno'):
+                      rno_column='rno', threshold=None, k=1):
     """Get the SFR reach number closest to a point feature.
+    Sites are located in bulk using a spatial index of the reach lines
+    (see :func:`sfrmaker.gis.nearest_strtree`), and distances are
+    measured to the reach lines (not their vertices).
 
     Parameters
     ----------
@@ -172,13 +175,20 @@ def get_closest_reach(x, y, sfrlines,
         Column with unique number for each reach. default "rno"
     threshold : numeric
         Distance threshold (in CRS units). Only return reaches within
-        this distance.
+        this distance. Sites without any reaches within
+        the threshold are assigned reach numbers of None and
+        distances of NaN.
+    k : int
+        Number of closest reaches to return for each location (default 1).
 
     Returns
     -------
     rno : int or list of ints
         Reach numbers for reaches closest to each location
-        defined by x, y.
+        defined by x, y. If k > 1, a list of (up to) k reach numbers
+        is returned for each location, sorted by distance.
+    distance : float or list of floats
+        Distances to the reaches.
     """
     scalar = False
     if np.isscalar(x):
@@ -187,33 +197,16 @@ def get_closest_reach(x, y, sfrlines,
     if np.isscalar(y):
         y = [y]
 
-    geoms = sfrlines.geometry.values
-    rno = sfrlines[rno_column].values
-
-    allX = []  # all x coordinates in sfrlines
-    allY = []  # all y coordinates in sfrlines
-    all_rno = []  # reach number for each x, y point in sfrlines
-    for i, g in enumerate(geoms):
-        if 'Multi' not in g.type:
-            g = [g]
-        for part in g:
-            gx, gy = part.coords.xy
-            allX += gx
-            allY += gy
-            all_rno += [rno[i]]*len(gx)
-    allX = np.array(allX)
-    allY = np.array(allY)
-    all_rno = np.array(all_rno)
-    assert len(all_rno) == len(allX)
-
-    rno = []
-    distance = []
-    for i in range(len(x)):
-        distances = np.sqrt((allX - x[i]) ** 2 +
-                            (allY - y[i]) ** 2)
-        idx = np.argmin(distances)
-        rno.append(all_rno[idx])
-        distance.append(np.min(distances))
+    points = [Point(xi, yi) for xi, yi in zip(x, y)]
+    inds, distances = nearest_strtree(sfrlines.geometry.values, points,
+                                      k=k, max_distance=threshold)
+    all_rno = sfrlines[rno_column].values
+    rno = [all_rno[i].tolist() for i in inds]
+    if k == 1:
+        rno = [r[0] if len(r) > 0 else None for r in rno]
+        distance = [d[0] if len(d) > 0 else np.nan for d in distances]
+    else:
+        distance = distances
     if scalar:
         return rno[0], distance[0]
     else:
@@ -314,14 +307,17 @@ def locate_sites(site_data,
         y = [p.y for p in locs.geometry]
 
     ids, distances = get_closest_reach(x, y, sfrlines,
-                                       rno_column=reach_id_col)
+                                       rno_column=reach_id_col,
+                                       threshold=distance_threshold)
     reach_id_col = reach_id_col.lower()
     locs[reach_id_col] = ids
     locs['distance'] = distances
+    locs = locs.loc[locs.distance <= distance_threshold].copy()
+    locs[reach_id_col] = locs[reach_id_col].infer_objects()
     if 'iseg' in sfrlines.columns:
+        ids = locs[reach_id_col].values
         locs['segment'] = sfrlines.loc[ids, 'iseg'].values
         locs['reach'] = sfrlines.loc[ids, 'ireach'].values
-    locs = locs.loc[locs.distance <= distance_threshold]
 
     # cull observations at or outside of model perimeter
     # to only those along model perimeter
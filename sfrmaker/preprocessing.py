@@ -1,4 +1,6 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 from pathlib import Path
 import shutil
 import yaml
@@ -6,29 +8,45 @@ import textwrap
 import numpy as np
 import pandas as pd
 import fiona
+from packaging import version
 import rasterio
-from shapely.geometry import shape, MultiLineString, box
+import shapely
+from shapely.geometry import shape, box
+from shapely.ops import linemerge
 from rasterstats import zonal_stats
 from gisutils import get_shapefile_crs
-from sfrmaker.gis import (shp2df, df2shp, project, intersect_rtree,
+from sfrmaker.gis import (shp2df, df2shp, project, intersect_strtree,
                           get_bbox, read_polygon_feature, get_shapefile_crs,
                           get_authority_crs,
-                          get_crs)
-from sfrmaker.elevations import smooth_elevations
+                          get_crs, clip_lines_to_polygon)
+from sfrmaker.elevations import (smooth_elevations, zonal_statistics,
+                                 zonal_statistics_parallel, ZonalStatisticsCache)
+from sfrmaker.fileio import is_columnar_file, read_features, write_features
 from sfrmaker.logger import Logger
-from sfrmaker.nhdplus_utils import get_nhdplus_v2_filepaths, get_prj_file
-from sfrmaker.routing import find_path, make_graph
+from sfrmaker.nhdplus_utils import get_nhdplus_v2_filepaths, get_prj_file, read_nhdplus_table
+from sfrmaker.routing import find_path, make_graph, RoutingGraph
 from sfrmaker.units import convert_length_units
 from sfrmaker.utils import width_from_arbolate_sum, arbolate_sum
 
 
+# file extensions for flowlines and attribute tables, by output format
+output_extensions = {'shapefile': ('.shp', '.dbf'),
+                     'parquet': ('.parquet', '.parquet'),
+                     'feather': ('.feather', '.feather')}
+
+# approximate ratio of the memory used to read an NHDPlus file to its size on disk
+nhdplus_memory_per_byte_on_disk = 3
+
+
 def cull_flowlines(NHDPlus_paths,
                    active_area=None,
                    asum_thresh=None,
                    intermittent_streams_asum_thresh=None,
                    cull_invalid=True,
                    cull_isolated=True,
-                   outfolder='clipped_flowlines', logger=None):
+                   outfolder='clipped_flowlines', logger=None,
+                   output_format='shapefile',
+                   n_workers=None, memory_limit=None):
     """Cull NHDPlus data to an area defined by an ``active_area`` polygon and
     to flowlines with Arbolate sums greater than specified thresholds. Also remove
     lines that are isolated from the stream network or are missing attribute information.
@@ -69,7 +87,26 @@ def cull_flowlines(NHDPlus_paths,
     logger : sfrmaker.logger instance, optional
         Pass an existing sfrmaker.logger instance to logger the preprocessing operations,
         by default None
+    output_format : str, {'shapefile', 'parquet', 'feather'}
+        Format for the output files. 'shapefile' (default) writes a shapefile
+        of the culled flowlines and dbf files of the attribute tables.
+        'parquet' or 'feather' write GeoParquet or Feather files
+        (see :func:`sfrmaker.fileio.write_table`), which are
+        much faster to read and write for large datasets,
+        and preserve the column names and data types.
+    n_workers : int, optional
+        Number of worker processes for reading the NHDPlus files, with
+        each drainage basin (in ``NHDPlus_paths``) read in a separate process
+        (see :func:`read_nhdplus_regions`). Routing connections between basins
+        are retained, as the PlusFlow tables are read for all of the flowlines
+        in the basins. By default, None (the basins are read in serial).
+    memory_limit : float, optional
+        Approximate limit on the total memory (in bytes) used by the worker processes
+        (see :func:`read_nhdplus_regions`). By default, None (no limit).
     """
+    if output_format not in output_extensions:
+        raise ValueError("Unrecognized output_format: {}; "
+                         "use 'shapefile', 'parquet' or 'feather'".format(output_format))
     if logger is None:
         logger = Logger()
     logger.log('Culling NHDPlus dataset')
@@ -106,13 +143,18 @@ def cull_flowlines(NHDPlus_paths,
         filter = None
 
     # read NHDPlus files into pandas dataframes
-    fl = shp2df(flowlines_files, filter=filter)
+    # (only the attribute table rows for the flowlines within the filter)
+    if n_workers is not None and n_workers > 1:
+        fl, pfvaa, pf, elevslope = read_nhdplus_regions(
+            flowlines_files, pfvaa_files, pf_files, elevslope_files,
+            filter=filter, n_workers=n_workers, memory_limit=memory_limit)
+    else:
+        fl = shp2df(flowlines_files, filter=filter)
+        pfvaa = read_nhdplus_table(pfvaa_files, fl.COMID)
+        pf = read_nhdplus_table(pf_files, fl.COMID, comid_columns='FROMCOMID')
+        elevslope = read_nhdplus_table(elevslope_files, fl.COMID)
     fl_all = fl.copy()
 
-    pfvaa = shp2df(pfvaa_files)
-    pf = shp2df(pf_files)
-    elevslope = shp2df(elevslope_files)
-
     logger.log('Reading raw NHDPlus files')
 
     # index dataframes by common-identifier numbers
@@ -201,23 +243,114 @@ def cull_flowlines(NHDPlus_paths,
 
     # write output files
     logger.statement('writing output')
-    results = {'flowlines_file': '{}/flowlines{}.shp'.format(outfolder, version),
-               'pfvaa_file': '{}/PlusFlowlineVAA{}.dbf'.format(outfolder, version),
-               'pf_file': '{}/PlusFlow{}.dbf'.format(outfolder, version),
-               'elevslope_file': '{}/elevslope{}.dbf'.format(outfolder, version)
+    shp_ext, dbf_ext = output_extensions[output_format]
+    results = {'flowlines_file': '{}/flowlines{}{}'.format(outfolder, version, shp_ext),
+               'pfvaa_file': '{}/PlusFlowlineVAA{}{}'.format(outfolder, version, dbf_ext),
+               'pf_file': '{}/PlusFlow{}{}'.format(outfolder, version, dbf_ext),
+               'elevslope_file': '{}/elevslope{}{}'.format(outfolder, version, dbf_ext)
                }
-    df2shp(fl, results['flowlines_file'], crs=4269)
-    df2shp(pfvaa, results['pfvaa_file'])
-    df2shp(pf, results['pf_file'])
-    df2shp(elevslope, results['elevslope_file'])
+    write_features(fl, results['flowlines_file'], crs=4269)
+    write_features(pfvaa, results['pfvaa_file'])
+    write_features(pf, results['pf_file'])
+    write_features(elevslope, results['elevslope_file'])
     logger.log('Culling NHDPlus dataset')
     return results
 
 
+def read_nhdplus_regions(flowlines_files, pfvaa_files, pf_files, elevslope_files,
+                         filter=None, n_workers=None, memory_limit=None):
+    """Read NHDPlus flowlines and attribute tables for multiple drainage
+    basins (regions), with each file read in a worker process. The flowlines
+    are read first; the attribute tables are then read for all of the flowlines
+    in all of the regions, so that the PlusFlow routing connections between regions
+    are retained. Results are the same as reading the files in serial.
+
+    Parameters
+    ----------
+    flowlines_files, pfvaa_files, pf_files, elevslope_files : lists of strings
+        NHDFlowline shapefiles and PlusFlowlineVAA, PlusFlow and elevslope
+        tables for each region (see :func:`sfrmaker.nhdplus_utils.get_nhdplus_v2_filepaths`).
+    filter : tuple, optional
+        Bounding box (left, bottom, right, top) for filtering the flowlines
+        that are read in (in the NHDPlus CRS). By default, None.
+    n_workers : int, optional
+        Maximum number of worker processes. By default, None (``os.cpu_count()``).
+    memory_limit : float, optional
+        Approximate limit on the total memory (in bytes) used by the
+        files being read at any one time. Memory use for each file is estimated
+        at a few times its size on disk; files are only submitted to the workers
+        while the total estimate for the files being read is within the limit
+        (one file is always read at a time). By default, None (no limit).
+
+    Returns
+    -------
+    flowlines, pfvaa, pf, elevslope : DataFrames
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    def estimated_memory(files):
+        return [nhdplus_memory_per_byte_on_disk * os.path.getsize(f) for f in files]
+
+    print('\nReading {} NHDPlus regions with {} workers...'.format(len(flowlines_files),
+                                                                     n_workers))
+    tasks = [partial(shp2df, f, filter=filter) for f in flowlines_files]
+    # include the dbf files of the flowline shapefiles in the estimates
+    sizes = np.sum([estimated_memory(flowlines_files),
+                    estimated_memory([os.path.splitext(f)[0] + '.dbf' for f in flowlines_files])],
+                   axis=0)
+    fl = pd.concat(_run_tasks(tasks, sizes, n_workers, memory_limit))
+
+    comids = set(fl.COMID)
+    tasks = []
+    sizes = []
+    for files, comid_columns in ((pfvaa_files, 'comid'),
+                                 (pf_files, 'FROMCOMID'),
+                                 (elevslope_files, 'comid')):
+        tasks += [partial(read_nhdplus_table, f, comids, comid_columns=comid_columns)
+                  for f in files]
+        sizes += estimated_memory(files)
+    results = _run_tasks(tasks, sizes, n_workers, memory_limit)
+    nfiles = len(flowlines_files)
+    tables = [pd.concat(results[start:start + nfiles]).reset_index(drop=True)
+              for start in range(0, len(results), nfiles)]
+    pfvaa, pf, elevslope = tables
+    return fl, pfvaa, pf, elevslope
+
+
+def _run_tasks(tasks, sizes, n_workers, memory_limit=None):
+    """Call each function in tasks in a pool of worker processes,
+    with no more than n_workers tasks running at a time, and
+    (if memory_limit is specified) the total of the sizes of the
+    running tasks within memory_limit. Results are returned in
+    the same order as tasks."""
+    results = [None] * len(tasks)
+    pending = {}
+    running_size = 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i, task in enumerate(tasks):
+            # wait for running tasks to finish if the pool or memory limit is full
+            while len(pending) > 0 and \
+                    (len(pending) >= n_workers or
+                     (memory_limit is not None and running_size + sizes[i] > memory_limit)):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    j = pending.pop(future)
+                    results[j] = future.result()
+                    running_size -= sizes[j]
+            pending[executor.submit(task)] = i
+            running_size += sizes[i]
+        for future, j in pending.items():
+            results[j] = future.result()
+    return results
+
+
 def preprocess_nhdplus(flowlines_file, pfvaa_file,
                        pf_file, elevslope_file,
                        demfile=None,
                        run_zonal_statistics=True,
+                       zonal_statistics_engine='rasterstats',
+                       zonal_statistics_cache=None,
                        dem_length_units='meters',
                        flowline_elevations_file=None,
                        active_area=None,
@@ -232,6 +365,7 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
                        output_length_units='meters',
                        logger=None, outfolder='output/',
                        project_epsg=None, flowline_crs=None, dest_crs=None,
+                       output_format='shapefile', n_workers=None
                        ):
     """Preprocess NHDPlus data to a single DataFrame of flowlines
     that each route to no more than one flowline, with width, elevation
@@ -245,7 +379,9 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         must be in a valid projected coorinate reference system (CRS; i.e., with units of meters),
         or a valid projected CRS must be specified with ``project_epsg``.
     pfvaa_file : str
-        Path to NHDPlus PlusFlowlineVAA database (.dbf file). May or maybe not have been
+        Path to NHDPlus PlusFlowlineVAA database (.dbf file). The flowlines and attribute
+        tables can also be GeoParquet or Feather files written by
+        :func:`~sfrmaker.preprocessing.cull_flowlines`. May or maybe not have been
         preprocessed by :func:`~sfrmaker.preprocessing.cull_flowlines`. ``ArbolateSu``
         values within this file are assumed to be in km.
     pf_file : str
@@ -256,6 +392,22 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         preprocessed by :func:`~sfrmaker.preprocessing.cull_flowlines`
     demfile : str
         Path to DEM raster for project area.
+    run_zonal_statistics : bool
+        Option to sample the ``demfile`` within buffers around the flowlines.
+        If False, elevations from a ``flowline_elevations_file``
+        produced by a previous run are used instead. By default, True.
+    zonal_statistics_engine : str; 'rasterstats' or 'native'
+        Method for sampling the ``demfile``. 'rasterstats' (default)
+        uses rasterstats.zonal_stats; 'native' uses
+        :func:`sfrmaker.elevations.zonal_statistics`, which reads the DEM
+        once (in blocks of rows) and rasterizes the buffers together.
+    zonal_statistics_cache : str, optional
+        SQLite database file for caching the sampled DEM values between runs
+        (see :class:`sfrmaker.elevations.ZonalStatisticsCache`). Only flowline buffers
+        that are new or have changed since a previous run (for example, because
+        the flowlines were culled differently, or ``buffersize_meters`` was changed),
+        or that were sampled from a different version of the ``demfile``, are sampled.
+        By default, None (no caching).
     dem_length_units : str, any length unit; e.g. {'m', 'meters', 'ft', etc.}
         Length units of values in ``demfile``. By default, 'meters'.
     active_area : str, optional
@@ -323,6 +475,17 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         Output Coordinate reference system. Same input types
         as ``flowline_crs``.
         By default, epsg:5070
+    output_format : str, {'shapefile', 'parquet', 'feather'}
+        Format for the output flowlines (and buffers) files. 'shapefile' (default)
+        writes shapefiles; 'parquet' or 'feather' write GeoParquet or Feather files
+        (see :func:`sfrmaker.fileio.write_table`), which preserve
+        the column names and data types. The output flowlines
+        can be read with :meth:`sfrmaker.Lines.from_shapefile`.
+    n_workers : int, optional
+        Number of worker processes for sampling the ``demfile``. The flowline
+        buffers are split into spatially contiguous chunks that are sampled
+        in parallel (see :func:`sfrmaker.elevations.zonal_statistics_parallel`).
+        By default, None (the buffers are sampled in one process).
 
     Returns
     -------
@@ -385,6 +548,9 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
     If a shapefile is specified for the ``narwidth_shapefile`` argument, the :func:`~sfrmaker.preprocessing.sample_narwidth` function is called.
 
     """    
+    if output_format not in output_extensions:
+        raise ValueError("Unrecognized output_format: {}; "
+                         "use 'shapefile', 'parquet' or 'feather'".format(output_format))
     # check that all the input files exist
     files_list = [flowlines_file,
                   pfvaa_file,
@@ -416,7 +582,12 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
     # get the flowline CRS, if geographic,
     # verify that project_crs is specified
     prjfile = os.path.splitext(flowlines_file)[0] + '.prj'
-    if os.path.exists(prjfile):
+    if is_columnar_file(flowlines_file):
+        fl = read_features(flowlines_file)
+        flowline_crs = fl.attrs.get('crs')
+        if flowline_crs is None:
+            logger.lraise("{} has no CRS information.".format(flowlines_file))
+    elif os.path.exists(prjfile):
         flowline_crs = get_shapefile_crs(prjfile)
     else:
         msg = ("{} not found; flowlines must have a valid projection file."
@@ -432,13 +603,17 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
             logger.lraise(msg)
 
     # get bounds of flowlines
-    with fiona.open(flowlines_file) as src:
-        flowline_bounds = src.bounds
-
-    fl = shp2df(flowlines_file) # flowlines clipped to model area
-    pfvaa = shp2df(pfvaa_file)
-    pf = shp2df(pf_file)
-    elevslope = shp2df(elevslope_file)
+    if is_columnar_file(flowlines_file):
+        bounds = np.array([g.bounds for g in fl.geometry])
+        flowline_bounds = (bounds[:, 0].min(), bounds[:, 1].min(),
+                           bounds[:, 2].max(), bounds[:, 3].max())
+    else:
+        with fiona.open(flowlines_file) as src:
+            flowline_bounds = src.bounds
+        fl = shp2df(flowlines_file) # flowlines clipped to model area
+    pfvaa = read_nhdplus_table(pfvaa_file, fl.COMID)
+    pf = read_nhdplus_table(pf_file, fl.COMID, comid_columns='FROMCOMID')
+    elevslope = read_nhdplus_table(elevslope_file, fl.COMID)
 
     # index dataframes by common-identifier numbers
     pfvaa.index = pfvaa.ComID
@@ -467,7 +642,8 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         # Create buffer around flowlines with flat cap, so that ends are flush with ends of lines
         # compute zonal statistics on buffer
         logger.log('Creating buffers and running zonal statistics')
-        logger.log_package_version('rasterstats')
+        if zonal_statistics_engine == 'rasterstats':
+            logger.log_package_version('rasterstats')
         logger.statement('buffersize: {} m'.format(buffersize_meters), log_time=False)
         logger.log_file_and_date_modified(demfile, prefix='DEM file: ')
 
@@ -487,12 +663,33 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         all_touched = False
         if buffersize_meters < dem_res:
             all_touched = True
-        results = zonal_stats(flbuffers_pr,
-                              demfile,
-                              stats=['min', 'mean', 'std',
-                                     'percentile_1', 'percentile_10',
-                                     'percentile_20', 'percentile_80'],
-                              all_touched=all_touched)
+        stats = ['min', 'mean', 'std',
+                 'percentile_1', 'percentile_10',
+                 'percentile_20', 'percentile_80']
+        if zonal_statistics_engine == 'rasterstats':
+            function = zonal_stats
+        elif zonal_statistics_engine == 'native':
+            function = zonal_statistics
+        else:
+            raise ValueError("Unrecognized zonal_statistics_engine: {}; "
+                             "use 'rasterstats' or 'native'".format(zonal_statistics_engine))
+        if n_workers is not None and n_workers > 1:
+            function = partial(zonal_statistics_parallel, function=function,
+                               n_workers=n_workers)
+        if zonal_statistics_cache is not None:
+            cache = ZonalStatisticsCache(zonal_statistics_cache)
+            results = cache.zonal_statistics(flbuffers_pr,
+                                             demfile,
+                                             stats=stats,
+                                             all_touched=all_touched,
+                                             function=function)
+            logger.statement('zonal statistics cache: {}; {:,d} hits, {:,d} misses'.format(
+                zonal_statistics_cache, cache.hits, cache.misses), log_time=False)
+        else:
+            results = function(flbuffers_pr,
+                               demfile,
+                               stats=stats,
+                               all_touched=all_touched)
         #results = {'mean': np.zeros(len(fl)),
         #           'min': np.zeros(len(fl)),
         #           'percentile_10': np.zeros(len(fl)),
@@ -522,15 +719,16 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         logger.statement('Writing shapefile of buffers used to determine distributary routing...')
         flccb = fl.copy()
         flccb['geometry'] = flccb.buffpoly
-        df2shp(flccb.drop('buffpoly', axis=1),
-               os.path.join(outfolder, 'flowlines_gt{:.0f}km_buffers.shp'.format(asum_thresh)),
-               index=False, epsg=project_epsg)
+        write_features(flccb.drop('buffpoly', axis=1),
+                       os.path.join(outfolder, 'flowlines_gt{:.0f}km_buffers{}'.format(
+                           asum_thresh, output_extensions[output_format][0])),
+                       index=False, epsg=project_epsg)
     else:
         assert Path(flowline_elevations_file).exists(), \
             ("If run_zonal_statistics=False a flowline_elevations_file produced by"
              "a previous run of the sfrmaker.preprocessing.preprocess_nhdplus() "
              "function is needed.")
-        flccb = shp2df(flowline_elevations_file)
+        flccb = read_features(flowline_elevations_file)
         flccb.index = flccb['COMID']
         flccb['buffpoly'] = flccb['geometry']
         merge_cols = [c for c in flccb.columns if c not in fl.columns]
@@ -696,7 +894,8 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
     asum_calc.update(new_minor_distrib_asums)
     # recompute arbolate sums at and downstream of places where it decreases
     # decreases are caused by routing connections that were not in NHDPlus
-    fixed_invalid_asums = fix_invalid_asums(asum_calc, fl_lengths, graph, graph_r)
+    fixed_invalid_asums = fix_invalid_asums(asum_calc, fl_lengths, graph, graph_r,
+                                            logger=logger)
     asum_calc.update(fixed_invalid_asums)
     flcc['asum_calc'] = [asum_calc[c] for c in flcc.index]
     logger.log('Recomputing arbolate sums')
@@ -753,9 +952,10 @@ def preprocess_nhdplus(flowlines_file, pfvaa_file,
         
     # write output files; record timestamps in logger
     logger.statement('writing output')
-    df2shp(flcc.drop('buffpoly', axis=1),
-           '{}/flowlines_gt{:.0f}km_edited.shp'.format(outfolder, asum_thresh),
-           index=False, epsg=project_epsg)
+    write_features(flcc.drop('buffpoly', axis=1),
+                   '{}/flowlines_gt{:.0f}km_edited{}'.format(outfolder, asum_thresh,
+                                                           output_extensions[output_format][0]),
+                   index=False, epsg=project_epsg)
     logger.log('Preprocessing Flowlines')
 
     return flcc
@@ -819,12 +1019,11 @@ def clip_flowlines_to_polygon(flowlines, polygon,
     logger.log('Culling flowlines outside of {}'.format(polygon))
     lines = flowlines.geometry.tolist()
     print('starting lines: {:,d}'.format(len(lines)))
-    intersects = [g.intersects(active_area_polygon) for g in lines]
-    flc = flowlines.loc[intersects].copy()
-    flc['geometry'] = [g.intersection(active_area_polygon) for g in flc.geometry]
-    drop = np.array([g.is_empty for g in flc.geometry.tolist()])
-    if len(drop) > 0:
-        flc = flc.loc[~drop]
+    # clip the lines in bulk; only lines crossing
+    # the polygon boundary are intersected with it
+    keep, clipped = clip_lines_to_polygon(lines, active_area_polygon)
+    flc = flowlines.loc[keep].copy()
+    flc['geometry'] = clipped
     print('remaining lines: {:,d}'.format(len(flc)))
     logger.log('Culling flowlines outside of {}'.format(polygon))
     return flc
@@ -907,58 +1106,17 @@ def sample_NARWidth(flowlines, narwidth_shapefile, waterbodies,
     flbuff['geometry'] = buffers
     df2shp(flbuff, '{}/flowlines_edited_buffers_{}.shp'.format(outpath, buffdist), epsg=flowlines_epsg)
 
-    # determine which narwidth segments intersect the flowline buffers
-    results = intersect_rtree(nw.geometry.tolist(), flbuff.geometry.tolist())
-
-    # weed out tribs that might have picked up narwidths for main stem
-    asum_thresh = 500  # threshold for evaluating whether flowline is a minor distributary
-    # (will have small calculated asum)
-    overlap_thresh = 0.5  # require lines with small calculated asum to be at least 50% with buffered NARWidth points
-
     # compile statistics on sampled narwidths
-    n = []
-    widths_mean = []
-    widths_std = []
-    widths_min = []
-    widths_max = []
-
-    for i, r in enumerate(results):
-        fl_info = flowlines.iloc[i]
-        # if the calculated asum is less than the threshold
-        # do another test to see how much overlap there is
-        # between flowling and narwidth
-        # goal is to prevent small tribs or distribs from being assigned huge widths
-        append_narwidth = False
-        if len(r) > 0:
-            if fl_info['asum_calc'] < asum_thresh:
-                narwidth_line_buffered = MultiLineString(nw.loc[r, 'geometry'].tolist()).buffer(buffdist)
-                fl_g = fl_info['geometry']
-                fl_overlap = fl_g.intersection(narwidth_line_buffered).length / fl_g.length
-                if fl_overlap > overlap_thresh:
-                    append_narwidth = True
-            else:
-                append_narwidth = True
-
-        if append_narwidth:
-            n.append(len(r))
-            sampled_widths = nw.loc[r, 'width']  # convert from meters to feet
-            widths_mean.append(sampled_widths.mean())
-            widths_std.append(sampled_widths.std())
-            widths_min.append(sampled_widths.min())
-            widths_max.append(sampled_widths.max())
-        else:
-            n.append(np.nan)
-            widths_mean.append(np.nan)
-            widths_std.append(np.nan)
-            widths_min.append(np.nan)
-            widths_max.append(np.nan)
+    stats = get_narwidth_statistics(flowlines.geometry, flowlines.asum_calc,
+                                     nw.geometry, nw.width,
+                                     buffdist=buffdist, flowline_buffers=buffers)
 
     unit_conversion = convert_length_units('meters', output_width_units)
-    flowlines['narwd_n'] = n
-    flowlines['narwd_mean'] = np.array(widths_mean) * unit_conversion
-    flowlines['narwd_std'] = np.array(widths_std) * unit_conversion
-    flowlines['narwd_min'] = np.array(widths_min) * unit_conversion
-    flowlines['narwd_max'] = np.array(widths_max) * unit_conversion
+    flowlines['narwd_n'] = stats['n'].values
+    flowlines['narwd_mean'] = stats['mean'].values * unit_conversion
+    flowlines['narwd_std'] = stats['std'].values * unit_conversion
+    flowlines['narwd_min'] = stats['min'].values * unit_conversion
+    flowlines['narwd_max'] = stats['max'].values * unit_conversion
     waterbodies = set(wb.COMID)
     flowlines['is_wb'] = [True if c in waterbodies else False for c in flowlines.WBAREACOMI]
 
@@ -974,6 +1132,105 @@ def sample_NARWidth(flowlines, narwidth_shapefile, waterbodies,
            epsg=flowlines_epsg)
 
 
+def get_narwidth_statistics(flowline_geoms, asum_calc, narwidth_geoms, narwidth_widths,
+                            buffdist=1000, asum_thresh=500, overlap_thresh=0.5,
+                            flowline_buffers=None):
+    """Compile statistics on the NARWidth widths sampled by each flowline
+    (see :func:`sample_NARWidth`). Candidate NARWidth lines within buffdist of
+    the flowlines are found in bulk with a single spatial index
+    (:func:`sfrmaker.gis.intersect_strtree`), and the statistics are
+    computed for all of the flowlines together. Only flowlines with
+    small arbolate sums (that might be tributaries picking up widths
+    for a main stem) are checked for overlap with the buffered NARWidth lines.
+    The NARWidth segments are merged into continuous lines before buffering,
+    so overlaps may differ slightly (by round-off in the buffer
+    approximation) from buffering the segments individually.
+
+    Parameters
+    ----------
+    flowline_geoms : sequence of LineStrings
+        Flowlines, in a projected CRS (with units of meters).
+    asum_calc : sequence of floats
+        Calculated arbolate sums for the flowlines, in km.
+    narwidth_geoms : sequence of LineStrings
+        NARWidth lines, in the same CRS as the flowlines.
+    narwidth_widths : sequence of floats
+        NARWidth widths, in meters.
+    buffdist : float
+        Distance around the flowlines for sampling the NARWidth lines,
+        in meters. By default, 1000.
+    asum_thresh : float
+        Flowlines with calculated arbolate sums less than this value (in km)
+        only receive widths if they overlap the NARWidth lines
+        (buffered by buffdist) by more than overlap_thresh.
+        By default, 500.
+    overlap_thresh : float
+        Minimum fraction of a flowline (with a small arbolate sum)
+        within the buffered NARWidth lines. By default, 0.5.
+    flowline_buffers : sequence of Polygons, optional
+        Flowlines buffered by buffdist, if they were already created.
+        By default, None.
+
+    Returns
+    -------
+    stats : DataFrame
+        Number of sampled NARWidth lines (n) and the mean, std, min
+        and max of their widths (in meters) for each flowline
+        (in the same order as flowline_geoms). Values are NaN for
+        flowlines that didn't receive widths.
+    """
+    flowline_geoms = np.array(list(flowline_geoms), dtype=object)
+    narwidth_geoms = np.array(list(narwidth_geoms), dtype=object)
+    narwidth_widths = np.array(narwidth_widths, dtype=float)
+    asum_calc = np.array(asum_calc, dtype=float)
+    nlines = len(flowline_geoms)
+    if flowline_buffers is None:
+        flowline_buffers = [g.buffer(buffdist) for g in flowline_geoms]
+
+    # candidate (flowline, narwidth line) pairs
+    intersections = intersect_strtree(narwidth_geoms, flowline_buffers)
+    counts = np.array([len(r) for r in intersections], dtype=int)
+    fl_inds = np.repeat(np.arange(nlines), counts)
+    nw_inds = np.array([i for r in intersections for i in r], dtype=int)
+
+    # weed out tribs that might have picked up narwidths for main stem;
+    # flowlines with small calculated asums (less than asum_thresh)
+    # need to overlap the buffered narwidth lines by at least overlap_thresh
+    has_narwidth = counts > 0
+    check_overlap = np.flatnonzero(has_narwidth & (asum_calc < asum_thresh))
+    if len(check_overlap) > 0:
+        in_check = np.isin(fl_inds, check_overlap)
+        fl_geoms = flowline_geoms[check_overlap]
+        if version.parse(shapely.__version__) >= version.parse('2.0'):
+            narwidth_lines = shapely.multilinestrings(
+                narwidth_geoms[nw_inds[in_check]],
+                indices=np.searchsorted(check_overlap, fl_inds[in_check]))
+            # merge the (short) narwidth segments into continuous lines
+            # before buffering; buffering the merged lines is much faster
+            # than unioning the overlapping buffers of the individual segments
+            narwidth_lines = shapely.line_merge(narwidth_lines)
+            # same resolution as the buffer method
+            narwidth_buffered = shapely.buffer(narwidth_lines, buffdist, quad_segs=16)
+            fl_overlap = shapely.length(shapely.intersection(fl_geoms, narwidth_buffered)) / \
+                         shapely.length(fl_geoms)
+        else:
+            fl_overlap = []
+            for i, fl_g in zip(check_overlap, fl_geoms):
+                r = nw_inds[fl_inds == i]
+                narwidth_line_buffered = linemerge(narwidth_geoms[r].tolist()).buffer(buffdist)
+                fl_overlap.append(fl_g.intersection(narwidth_line_buffered).length / fl_g.length)
+            fl_overlap = np.array(fl_overlap)
+        has_narwidth[check_overlap[fl_overlap <= overlap_thresh]] = False
+
+    # statistics for the flowlines that received widths
+    sampled = pd.DataFrame({'fl': fl_inds, 'width': narwidth_widths[nw_inds]})
+    sampled = sampled.loc[has_narwidth[fl_inds]]
+    stats = sampled.groupby('fl').width.agg(['size', 'mean', 'std', 'min', 'max'])
+    stats = stats.rename(columns={'size': 'n'}).reindex(np.arange(nlines)).astype(float)
+    stats.index.name = None
+    return stats
+
+
 def edit_flowlines(flowlines, config_file,
                    id_column='COMID', toid_column='tocomid',
                    logger=None):
@@ -1100,12 +1357,13 @@ def recompute_asums_for_minor_distribs(minor_distrib_comids, fl_lengths, graph,
     new_asums : dict
         Dictionary of recomputed arbolate sums {comid: asum value}
     """
+    routing_graph = RoutingGraph(graph)
     new_asums = {}
     for c in minor_distrib_comids:
-        path = find_path(graph, c)
         asum_c = 0  # current asum
         # for each comid going downstream
-        for cp in path:
+        # (only as far as the next confluence)
+        for cp in routing_graph.iter_path(c):
             tribs = graph_r[cp]
             # end condition is an outlet or confluence
             if cp == 0 or len(tribs) > 1:
@@ -1116,7 +1374,7 @@ def recompute_asums_for_minor_distribs(minor_distrib_comids, fl_lengths, graph,
     return new_asums
 
 
-def fix_invalid_asums(asums, fl_lengths, graph, graph_r):
+def fix_invalid_asums(asums, fl_lengths, graph, graph_r, logger=None):
     """Recompute arbolate sum at any places in the network
     where it decreases going downstream, and then for all lines
     downstream of those locations. Decreases may be caused by
@@ -1134,6 +1392,9 @@ def fix_invalid_asums(asums, fl_lengths, graph, graph_r):
         Dictionary of downstream routing connections {fromcomid: tocomid}
     graph_r : dict
         Dictionary of upstream routing connections {tocomid: {fromcomid1, fromcomid2,...}}
+    logger : sfrmaker.logger instance, optional
+        Pass an existing sfrmaker.logger instance to log the lines
+        on or downstream of any circular routing, by default None
 
     Returns
     -------
@@ -1149,9 +1410,25 @@ def fix_invalid_asums(asums, fl_lengths, graph, graph_r):
     drainages (if the tribs are distributaries coming from the same divergence,
     there asums will reflect the same upstream drainage, and therefore would
     be duplicative if summed).
+
+    Lines are checked in topological order (each line after all of the lines
+    upstream), so that increases in arbolate sum only need to be passed
+    to the next line downstream, and every line is only visited once.
+    Lines on or downstream of circular routing (which have no topological
+    order) are checked afterwards, with any increases applied along the
+    (length-limited) path downstream of each line.
     """
+    routing_graph = RoutingGraph(graph)
+    comids = [c for c in routing_graph.acyclic_order.tolist() if c in asums]
+    comids += [c for c in asums if c not in routing_graph]
+    circular_ids = set(routing_graph.circular_ids.tolist())
+    circular = [c for c in asums if c in circular_ids]
+
     new_asums = asums.copy()
-    for comid, asum in new_asums.items():
+    increments = {}  # increases in asum from breaks upstream
+    for comid in comids:
+        increment = increments.get(comid, 0.)
+        asum = new_asums[comid] + increment
 
         # get the asum at the line start
         # (tribs themselves might be distributaries,
@@ -1168,21 +1445,55 @@ def fix_invalid_asums(asums, fl_lengths, graph, graph_r):
         # if the asum is less than expected
         # assume a break in asum continuity
         if expected_asum > asum:
-            path = find_path(graph, comid)
-
             # set the current asum to the max of the tribs + it's line length
             # (current asum is at end of line)
-            asum_c = expected_asum  # current asum
-            new_asums[comid] = asum_c
-
-            # increment each downstream line by the increase in asum
-            increment = asum_c - asum
-            # for each comid going downstream
-            for cp in path[1:]:
-                # end condition is an outlet
-                if cp == 0:
-                    break
-                old_asum = new_asums[cp]
-                asum_c = old_asum + increment
-                new_asums[cp] = asum_c
-    return new_asums
\ No newline at end of file
+            # and increment each downstream line by the increase in asum
+            increment += expected_asum - asum
+            asum = expected_asum
+        new_asums[comid] = asum
+
+        # end condition is an outlet
+        next_comid = graph.get(comid, 0)
+        if increment != 0 and next_comid != 0:
+            increments[next_comid] = increments.get(next_comid, 0.) + increment
+
+    if len(circular) > 0:
+        msg = 'Routing is circular; {} lines are on or downstream of loops'.format(len(circular))
+        print(msg)
+        if logger is not None:
+            logger.statement('{}: {}'.format(msg, circular))
+    circular_set = set(circular)
+    # pass increases from upstream on to the circular routing
+    for comid, increment in increments.items():
+        if comid in circular_set:
+            _increment_asums_downstream(new_asums, graph, comid, increment,
+                                        include_start=True)
+    for comid in circular:
+        asum = new_asums[comid]
+        tribs = graph_r[comid]
+        max_trib_asum = 0.
+        if len(tribs) > 0:
+            max_trib_asum = np.max([new_asums[trib] for trib in tribs])
+        expected_asum = max_trib_asum + fl_lengths[comid]
+        if expected_asum > asum:
+            new_asums[comid] = expected_asum
+            _increment_asums_downstream(new_asums, graph, comid,
+                                        expected_asum - asum)
+    return new_asums
+
+
+def _increment_asums_downstream(asums, graph, comid, increment,
+                                include_start=False):
+    """Add increment to the arbolate sums along the routing path
+    downstream of comid (limited to the number of lines in graph,
+    in case the routing is circular).
+    """
+    path = find_path(graph, comid)
+    if not include_start:
+        path = path[1:]
+    # for each comid going downstream
+    for cp in path:
+        # end condition is an outlet
+        if cp == 0:
+            break
+        asums[cp] = asums[cp] + increment
\ No newline at end of file
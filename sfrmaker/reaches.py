@@ -1,9 +1,14 @@
-import operator
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
 import pandas as pd
-from shapely.geometry import Point
+from packaging import version
+import shapely
+from shapely import wkb
+from shapely.geometry import LineString, Polygon, box
+from shapely.strtree import STRtree
 
 
 def consolidate_reach_conductances(rd, keep_only_dominant=False):
@@ -108,10 +113,12 @@ def interpolate_to_reaches(reach_data, segment_data,
     return np.array(reach_values)
 
 
-def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
-                     grid_geoms, tol=0.01):
+def setup_reach_data(flowline_geoms, fl_comids, grid_intersections=None,
+                     grid_geoms=None, tol=0.01, lattice=None,
+                     n_workers=None, executor=None):
     """Create prelimnary stream reaches from lists of grid cell intersections
-    for each flowline.
+    for each flowline, or by walking each flowline through the
+    row/column lattice of a structured grid (if ``lattice`` is supplied).
 
     Parameters
     ----------
@@ -131,6 +138,22 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
         not occur to reaches beyond this distance. This number should be small,
         because the ends of consecutive reaches should be touching if they were
         created via intersection with the model grid. (default 0.01)
+    lattice : tuple, optional
+        (xedges, yedges, xul, yul, rotation) of a structured grid
+        (see :attr:`sfrmaker.grid.StructuredGrid.lattice`). If supplied,
+        reaches are created with :func:`create_reaches_structured`, and
+        grid_intersections and grid_geoms aren't needed. By default, None.
+    n_workers : int, optional
+        Number of worker processes for creating the reaches. Flowlines
+        are split into chunks, which are sent to the workers
+        along with the (WKB-encoded) geometries of the grid cells that
+        they intersect. Results are reassembled in the original flowline
+        order, so that the reach numbering is the same as with a single process.
+        By default, None (flowlines are processed in serial).
+    executor : concurrent.futures.Executor, optional
+        Executor instance (with a ``submit`` method) to use instead of
+        creating a :class:`concurrent.futures.ProcessPoolExecutor`
+        with ``n_workers``. By default, None.
 
     Returns
     -------
@@ -155,27 +178,22 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
     geometry = []
     comids = []
 
-    for i in range(len(flowline_geoms)):
-        segment_geom = flowline_geoms[i]
-        segment_nodes = grid_intersections[i]
-        if segment_geom.type != 'MultiLineString' and segment_geom.type != 'GeometryCollection':
-            ordered_reach_geoms, ordered_node_numbers = create_reaches(segment_geom, segment_nodes, grid_geoms, tol=tol)
-            reach += list(np.arange(len(ordered_reach_geoms)) + 1)
-            geometry += ordered_reach_geoms
-            node += ordered_node_numbers
-            segment += [fl_segments[i]] * len(ordered_reach_geoms)
-            comids += [fl_comids[i]] * len(ordered_reach_geoms)
-        else:
-            start_reach = 0
-            for j, part in enumerate(list(segment_geom.geoms)):
-                geoms, node_numbers = create_reaches(part, segment_nodes, grid_geoms)
-                if j > 0:
-                    start_reach = reach[-1]
-                reach += list(np.arange(start_reach, start_reach + len(geoms)) + 1)
-                geometry += geoms
-                node += node_numbers
-                segment += [fl_segments[i]] * len(geoms)
-                comids += [fl_comids[i]] * len(geoms)
+    if (n_workers is not None and n_workers > 1) or executor is not None:
+        results = _create_reaches_parallel(flowline_geoms, grid_intersections,
+                                           grid_geoms, tol=tol, lattice=lattice,
+                                           n_workers=n_workers, executor=executor)
+    else:
+        results = (_create_flowline_reaches(flowline_geoms[i],
+                                            grid_intersections[i] if lattice is None else None,
+                                            grid_geoms, tol=tol, lattice=lattice)
+                   for i in range(len(flowline_geoms)))
+
+    for i, (ordered_reach_geoms, ordered_node_numbers, reach_numbers) in enumerate(results):
+        reach += reach_numbers
+        geometry += ordered_reach_geoms
+        node += ordered_node_numbers
+        segment += [fl_segments[i]] * len(ordered_reach_geoms)
+        comids += [fl_comids[i]] * len(ordered_reach_geoms)
         if len(reach) != len(segment):
             print('bad reach assignment!')
             break
@@ -188,10 +206,318 @@ def setup_reach_data(flowline_geoms, fl_comids, grid_intersections,
     return m1
 
 
+def _create_flowline_reaches(segment_geom, segment_nodes, grid_geoms,
+                             tol=0.01, lattice=None):
+    """Create the reaches for a single flowline (see :func:`setup_reach_data`).
+
+    Returns
+    -------
+    ordered_reach_geoms : list of LineStrings
+    ordered_node_numbers : list of ints
+    reach_numbers : list of ints
+        Reach numbers (ireach) within the flowline.
+    """
+    if segment_geom.type != 'MultiLineString' and segment_geom.type != 'GeometryCollection':
+        if lattice is not None:
+            ordered_reach_geoms, ordered_node_numbers = create_reaches_structured(segment_geom,
+                                                                                 *lattice)
+        else:
+            ordered_reach_geoms, ordered_node_numbers = create_reaches(segment_geom, segment_nodes,
+                                                                       grid_geoms, tol=tol)
+        reach_numbers = list(np.arange(len(ordered_reach_geoms)) + 1)
+    else:
+        ordered_reach_geoms = []
+        ordered_node_numbers = []
+        reach_numbers = []
+        start_reach = 0
+        for j, part in enumerate(list(segment_geom.geoms)):
+            if lattice is not None:
+                geoms, node_numbers = create_reaches_structured(part, *lattice)
+            else:
+                geoms, node_numbers = create_reaches(part, segment_nodes, grid_geoms)
+            if j > 0 and len(reach_numbers) > 0:
+                start_reach = reach_numbers[-1]
+            reach_numbers += list(np.arange(start_reach, start_reach + len(geoms)) + 1)
+            ordered_reach_geoms += geoms
+            ordered_node_numbers += node_numbers
+    return ordered_reach_geoms, ordered_node_numbers, reach_numbers
+
+
+def _create_reaches_chunk(flowline_wkbs, grid_intersections, grid_geom_wkbs,
+                          tol=0.01, lattice=None):
+    """Worker function for creating reaches for a chunk of flowlines,
+    with geometries passed as WKB. Cell geometries are only needed for
+    the nodes in grid_intersections."""
+    grid_geoms = {n: wkb.loads(g) for n, g in grid_geom_wkbs.items()}
+    results = []
+    for i, fl_wkb in enumerate(flowline_wkbs):
+        segment_nodes = grid_intersections[i] if lattice is None else None
+        geoms, nodes, reach_numbers = _create_flowline_reaches(wkb.loads(fl_wkb), segment_nodes,
+                                                               grid_geoms, tol=tol, lattice=lattice)
+        results.append(([g.wkb for g in geoms], nodes, reach_numbers))
+    return results
+
+
+def _create_reaches_parallel(flowline_geoms, grid_intersections, grid_geoms,
+                             tol=0.01, lattice=None, n_workers=None, executor=None):
+    """Create reaches for each flowline in chunks, using a pool of
+    worker processes. Results are returned in the same order as flowline_geoms."""
+    nlines = len(flowline_geoms)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    # a few chunks per worker, to even out the load
+    chunksize = int(np.ceil(nlines / (n_workers * 4))) or 1
+    chunks = [range(start, min(start + chunksize, nlines))
+              for start in range(0, nlines, chunksize)]
+    print('creating reaches for {:,d} flowlines in {} chunks...'.format(nlines, len(chunks)))
+
+    shutdown = False
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        shutdown = True
+    try:
+        futures = []
+        for chunk in chunks:
+            fl_wkbs = [flowline_geoms[i].wkb for i in chunk]
+            if lattice is None:
+                intersections = [grid_intersections[i] for i in chunk]
+                nodes = set().union(*intersections)
+                grid_geom_wkbs = {n: grid_geoms[n].wkb for n in nodes}
+            else:
+                intersections = None
+                grid_geom_wkbs = {}
+            futures.append(executor.submit(_create_reaches_chunk, fl_wkbs, intersections,
+                                           grid_geom_wkbs, tol, lattice))
+        # reassemble in the original order
+        for future in futures:
+            for geoms, nodes, reach_numbers in future.result():
+                yield [wkb.loads(g) for g in geoms], nodes, reach_numbers
+    finally:
+        if shutdown:
+            executor.shutdown()
+
+
+def setup_reach_data_tiled(flowline_geoms, fl_comids, grid, tile_size=1000,
+                           n_workers=None, executor=None):
+    """Create prelimnary stream reaches for a structured grid one
+    block of rows and columns (tile) at a time, so that cell Polygons
+    only need to exist for one tile (per worker) at a time. Within each
+    tile, the flowlines overlapping the tile are intersected with the cells
+    (:func:`sfrmaker.gis.intersect_strtree`), and reaches are created for the
+    intersected cells. The reaches from all of the tiles are then stitched
+    together for each flowline by their distance along the flowline (part),
+    so that the results are the same as with :func:`setup_reach_data`.
+
+    Parameters
+    ----------
+    flowline_geoms : list of shapely LineStrings
+        LineStrings representing streams (e.g. read from a shapefile).
+    fl_comids : list of integers
+        List of unique ID numbers, one for each feature in
+        flowline_geoms.
+    grid : sfrmaker.grid.StructuredGrid
+        Model grid, with nrow and ncol attributes and a
+        :meth:`~sfrmaker.grid.StructuredGrid.get_cell_polygons` method.
+        The extent of each tile is taken from the grid vertices
+        (xvertices and yvertices) or row and column spacing
+        (:attr:`~sfrmaker.grid.StructuredGrid.lattice`) if available,
+        so that cell Polygons are only created for tiles with flowlines.
+        With xvertices and yvertices, the Polygons are created
+        by the worker processes.
+    tile_size : int or tuple of ints
+        Number of rows and columns in each tile, or
+        (number of rows, number of columns). By default, 1000.
+    n_workers : int, optional
+        Number of worker processes for processing the tiles.
+        To limit memory use, only a few tiles per worker
+        are submitted at a time. By default, None (tiles are processed in serial).
+    executor : concurrent.futures.Executor, optional
+        Executor instance (with a ``submit`` method) to use instead of
+        creating a :class:`concurrent.futures.ProcessPoolExecutor`
+        with ``n_workers``. By default, None.
+
+    Returns
+    -------
+    m1 : DataFrame of reaches (one row per reach); see :func:`setup_reach_data`.
+    """
+    if np.isscalar(tile_size):
+        tile_size = (tile_size, tile_size)
+    print("\nSetting up reach data in tiles of {} rows x {} columns...".format(*tile_size))
+    ta = time.time()
+    flowline_geoms = list(flowline_geoms)
+    line_tree = STRtree(flowline_geoms)
+    if version.parse(shapely.__version__) < version.parse('2.0'):
+        # shapely < 2 returns the geometries themselves from tree queries
+        line_positions = {id(g): i for i, g in enumerate(flowline_geoms)}
+
+    parallel = (n_workers is not None and n_workers > 1) or executor is not None
+    if parallel:
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        shutdown = False
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+            shutdown = True
+    lattice = grid.lattice
+    results = []
+    pending = set()
+    try:
+        for i0, i1, j0, j1 in _get_tiles(grid.nrow, grid.ncol, *tile_size):
+            tile_nodes = (np.arange(i0, i1)[:, None] * grid.ncol + np.arange(j0, j1)).ravel()
+            # get the tile extent from the grid vertices or row/column spacing,
+            # without creating the cell polygons
+            xvertices = yvertices = cell_geoms = None
+            if grid._lazy_geometry:
+                xvertices = grid.xvertices[i0:i1 + 1, j0:j1 + 1]
+                yvertices = grid.yvertices[i0:i1 + 1, j0:j1 + 1]
+                tile_box = box(xvertices.min(), yvertices.min(),
+                               xvertices.max(), yvertices.max())
+            elif lattice is not None:
+                xedges, yedges, xul, yul, rotation = lattice
+                x = xedges[[j0, j1, j1, j0]]
+                y = yedges[[i0, i0, i1, i1]]
+                theta = np.radians(rotation)
+                x, y = (xul + x * np.cos(theta) + y * np.sin(theta),
+                        yul + x * np.sin(theta) - y * np.cos(theta))
+                tile_box = box(x.min(), y.min(), x.max(), y.max())
+            else:
+                cell_geoms = grid.get_cell_polygons(tile_nodes)
+                bounds = np.array([g.bounds for g in cell_geoms])
+                tile_box = box(bounds[:, 0].min(), bounds[:, 1].min(),
+                               bounds[:, 2].max(), bounds[:, 3].max())
+            if version.parse(shapely.__version__) >= version.parse('2.0'):
+                line_inds = np.sort(line_tree.query(tile_box))
+            else:
+                line_inds = np.sort([line_positions[id(g)] for g in line_tree.query(tile_box)])
+            if len(line_inds) == 0:
+                continue
+            tile_lines = [flowline_geoms[i] for i in line_inds]
+            if parallel:
+                # cell polygons are created by the workers from the tile vertices
+                if xvertices is not None:
+                    cells = xvertices, yvertices
+                else:
+                    if cell_geoms is None:
+                        cell_geoms = grid.get_cell_polygons(tile_nodes)
+                    cells = [g.wkb for g in cell_geoms]
+                pending.add(executor.submit(_create_tile_reaches_chunk,
+                                            [g.wkb for g in tile_lines], line_inds,
+                                            cells, tile_nodes))
+                # only keep a few tiles per worker in flight
+                if len(pending) >= 2 * n_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    results += [future.result() for future in done]
+            else:
+                if cell_geoms is None:
+                    cell_geoms = grid.get_cell_polygons(tile_nodes)
+                results.append(_create_tile_reaches(tile_lines, line_inds,
+                                                    cell_geoms, tile_nodes))
+        if parallel:
+            results += [future.result() for future in pending]
+    finally:
+        if parallel and shutdown:
+            executor.shutdown()
+
+    # stitch the reaches from the tiles together,
+    # in order along each flowline (part)
+    line = np.concatenate([r[0] for r in results] + [np.array([], dtype=int)]).astype(int)
+    part = np.concatenate([r[1] for r in results] + [np.array([], dtype=int)]).astype(int)
+    position = np.concatenate([r[2] for r in results] + [np.array([])]).astype(float)
+    node = np.concatenate([r[3] for r in results] + [np.array([], dtype=int)]).astype(int)
+    geometry = [g for r in results for g in r[4]]
+    if parallel:
+        geometry = [wkb.loads(g) for g in geometry]
+    order = np.lexsort((np.arange(len(line)), node, position, part, line))
+    line, node = line[order], node[order]
+    starts = np.flatnonzero(np.diff(line, prepend=-1) != 0)
+    counts = np.diff(np.append(starts, len(line)))
+    reach = np.arange(len(line)) - np.repeat(starts, counts) + 1
+
+    m1 = pd.DataFrame({'ireach': reach, 'iseg': line + 1, 'node': node,
+                       'geometry': [geometry[r] for r in order],
+                       'line_id': [fl_comids[i] for i in line]})
+    m1.sort_values(by=['iseg', 'ireach'], inplace=True)
+    m1['rno'] = np.arange(len(m1)) + 1
+    print("finished in {:.2f}s\n".format(time.time() - ta))
+    return m1
+
+
+def _get_tiles(nrow, ncol, tile_nrow, tile_ncol):
+    """Generate the first and last (exclusive) row and column of each
+    block of tile_nrow rows x tile_ncol columns in a structured grid."""
+    for i0 in range(0, nrow, tile_nrow):
+        for j0 in range(0, ncol, tile_ncol):
+            yield i0, min(i0 + tile_nrow, nrow), j0, min(j0 + tile_ncol, ncol)
+
+
+def _get_tile_polygons(xvertices, yvertices):
+    """Create Polygons for the cells in a tile of a structured grid,
+    from (nrow + 1, ncol + 1) arrays of the tile vertices, in the
+    same way as :meth:`sfrmaker.grid.StructuredGrid.get_cell_polygons`."""
+    corners = []
+    for v in xvertices, yvertices:
+        # corners (i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1), (i, j)
+        v = np.array([v[:-1, :-1], v[1:, :-1], v[1:, 1:], v[:-1, 1:], v[:-1, :-1]])
+        corners.append(v.reshape(5, -1))
+    return [Polygon(zip(xx, yy)) for xx, yy in zip(corners[0].T, corners[1].T)]
+
+
+def _create_tile_reaches(flowline_geoms, line_inds, cell_geoms, nodes):
+    """Create reaches for the flowlines overlapping a tile of grid cells,
+    without ordering them (see :func:`setup_reach_data_tiled`).
+
+    Returns
+    -------
+    line : 1D array
+        Index of the flowline (in line_inds) for each reach.
+    part : 1D array
+        Part of the flowline (for multipart flowlines) for each reach.
+    position : 1D array
+        Distance along the flowline part to the reach midpoint.
+    node : 1D array
+        Grid cell number for each reach.
+    geometry : list of LineStrings
+    """
+    from sfrmaker.gis import intersect_strtree
+
+    grid_intersections = intersect_strtree(cell_geoms, flowline_geoms)
+    grid_geoms = dict(zip(nodes, cell_geoms))
+    line, part, position, node, geometry = [], [], [], [], []
+    for line_ind, geom, cells in zip(line_inds, flowline_geoms, grid_intersections):
+        if len(cells) == 0:
+            continue
+        segment_nodes = [nodes[c] for c in cells]
+        if geom.geom_type in {'MultiLineString', 'GeometryCollection'}:
+            parts = list(geom.geoms)
+        else:
+            parts = [geom]
+        for i, geom_part in enumerate(parts):
+            geoms, reach_nodes, pos = _intersect_part(geom_part, segment_nodes, grid_geoms)
+            line += [line_ind] * len(geoms)
+            part += [i] * len(geoms)
+            position += pos
+            node += reach_nodes
+            geometry += geoms
+    return np.array(line), np.array(part), np.array(position), np.array(node), geometry
+
+
+def _create_tile_reaches_chunk(flowline_wkbs, line_inds, cells, nodes):
+    """Worker function for :func:`_create_tile_reaches`,
+    with geometries passed as WKB, and the cells as either WKB
+    or a tuple of (xvertices, yvertices) arrays for the tile."""
+    if isinstance(cells, tuple):
+        cell_geoms = _get_tile_polygons(*cells)
+    else:
+        cell_geoms = [wkb.loads(g) for g in cells]
+    line, part, position, node, geometry = _create_tile_reaches(
+        [wkb.loads(g) for g in flowline_wkbs], line_inds, cell_geoms, nodes)
+    return line, part, position, node, [g.wkb for g in geometry]
+
+
 def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     """Creates SFR reaches for a segment by ordering model cells
     intersected by a LineString part. Reaches within a part are
-    ordered by proximity.
+    ordered by their distance along the part (linear referencing).
 
     Parameters
     ----------
@@ -202,10 +528,8 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     grid_geoms: list of Polygons
         List of shapely Polygon objects for the model grid cells, sorted by node number
     tol : float
-        Maximum distance for identifying a connecting reach. Routing will
-        not occur to reaches beyond this distance. This number should be small,
-        because the ends of consecutive reaches should be touching if they were
-        created via intersection with the model grid. (default 0.01)
+        No longer used; reaches are ordered by linear referencing
+        instead of by connecting their ends. (default 0.01)
 
     Returns
     -------
@@ -214,49 +538,189 @@ def create_reaches(part, segment_nodes, grid_geoms, tol=0.01):
     ordered_node_numbers: list of ints
         List of model cells containing the SFR reaches for the segment
     """
-    reach_nodes = {}
-    reach_geoms = {}
-    # interesct flowline part with grid nodes
-    reach_intersections = {c: part.intersection(grid_geoms[c]) for c in segment_nodes}
-    reach_intersections = {c: g for c, g in reach_intersections.items() if
-                           g.length > 0}  # drops points and empty geometries
-    # empty geometries are created when segment_nodes variable includes nodes intersected by
-    # other parts of a multipart line. Not sure what causes points besides duplicate vertices.
-
-    # "flatten" all grid cell intersections to single part geometries
-    n = 1
-    for node, g in reach_intersections.items():
-        if g.type == 'LineString':
-            reach_nodes[n] = node
-            reach_geoms[n] = g
-            n += 1
-        else:
-            geoms = [gg for gg in g.geoms if gg.type == 'LineString']
-            reach_nodes.update({n + nn: node for nn, gg in enumerate(geoms)})
-            reach_geoms.update({n + nn: gg for nn, gg in enumerate(geoms)})
-            n += len(geoms)
+    reach_geoms, reach_nodes, position = _intersect_part(part, segment_nodes, grid_geoms)
+
+    # order the reaches by their distance along the flowline part
+    order = np.argsort(position, kind='stable')
+    ordered_reach_geoms = [reach_geoms[r] for r in order]
+    ordered_node_numbers = [reach_nodes[r] for r in order]
+    return ordered_reach_geoms, ordered_node_numbers
+
+
+def _intersect_part(part, segment_nodes, grid_geoms):
+    """Intersect a LineString part with the grid cells in segment_nodes
+    (see :func:`create_reaches`).
+
+    Returns
+    -------
+    reach_geoms : list of LineStrings
+    reach_nodes : list of ints
+    position : list of floats
+        Distance along the part to the midpoint of each reach.
+    """
+    # vertices and bounding boxes of the line segments in the part
+    coords = np.array(part.coords)
+    x, y = coords[:, 0], coords[:, 1]
+    seg_xmin, seg_xmax = np.minimum(x[:-1], x[1:]), np.maximum(x[:-1], x[1:])
+    seg_ymin, seg_ymax = np.minimum(y[:-1], y[1:]), np.maximum(y[:-1], y[1:])
+    # distance along the part to each vertex
+    distance = np.append(0., np.cumsum(np.hypot(np.diff(x), np.diff(y))))
+
+    # intersect the flowline part with each grid cell;
+    # to avoid intersecting the whole part with every cell,
+    # only the runs of consecutive line segments with bounding boxes
+    # overlapping the cell are intersected
+    reach_nodes = []
+    reach_geoms = []
+    position = []
+    for node in segment_nodes:
+        cell = grid_geoms[node]
+        left, bottom, right, top = cell.bounds
+        overlaps = np.flatnonzero((seg_xmax >= left) & (seg_xmin <= right) &
+                                  (seg_ymax >= bottom) & (seg_ymin <= top))
+        if len(overlaps) == 0:
+            # empty geometries are created when segment_nodes variable includes nodes intersected by
+            # other parts of a multipart line.
+            continue
+        runs = np.split(overlaps, np.flatnonzero(np.diff(overlaps) > 1) + 1)
+        for run in runs:
+            run_line = LineString(coords[run[0]:run[-1] + 2])
+            g = run_line.intersection(cell)
+            if g.length == 0:  # drops points and empty geometries
+                continue
+            # "flatten" all grid cell intersections to single part geometries
+            if g.type == 'LineString':
+                geoms = [g]
+            else:
+                geoms = [gg for gg in g.geoms if gg.type == 'LineString']
+            for gg in geoms:
+                reach_nodes.append(node)
+                reach_geoms.append(gg)
+                # distance along the part to the reach midpoint (linear referencing);
+                # midpoints are used instead of start points in case the line
+                # crosses itself at a cell edge
+                midpoint = gg.interpolate(0.5, normalized=True)
+                position.append(distance[run[0]] + run_line.project(midpoint))
+    return reach_geoms, reach_nodes, position
+
+
+def _edge_crossings(x0, x1, edges):
+    """For line segments spanning x0 to x1, get the fractional distances
+    (from 0 to 1) along each segment where it crosses the values in edges
+    (not including the segment ends).
+
+    Returns
+    -------
+    seg : 1D array of segment indices (one for each crossing)
+    t : 1D array of fractional distances along the segment
+    """
+    lo = np.searchsorted(edges, np.minimum(x0, x1), side='right')
+    hi = np.searchsorted(edges, np.maximum(x0, x1), side='left')
+    counts = np.maximum(hi - lo, 0)
+    seg = np.repeat(np.arange(len(x0)), counts)
+    offsets = np.cumsum(counts) - counts
+    idx = lo[seg] + np.arange(counts.sum()) - offsets[seg]
+    t = (edges[idx] - x0[seg]) / (x1[seg] - x0[seg])
+    return seg, t
+
 
-    # make point features for start and end of flowline part
-    start = Point(part.coords[0])
-    end = Point(part.coords[-1])
+def create_reaches_structured(part, xedges, yedges, xul, yul, rotation=0.):
+    """Creates SFR reaches for a segment by walking a LineString part
+    through the row/column lattice of a structured grid. The points
+    where each line segment crosses a row or column edge are computed
+    directly from the line vertices and the grid spacing,
+    so no cell polygons are needed (or intersected).
+
+    Parameters
+    ----------
+    part: LineString
+        Shapely LineString object (or a part of a MultiLineString)
+    xedges : 1D array
+        Column edges along a row, as distances from the upper left corner
+        of the grid (length ncol + 1).
+    yedges : 1D array
+        Row edges down a column, as distances from the upper left corner
+        of the grid (length nrow + 1).
+    xul : float
+        Upper left corner of the grid x-coordinate.
+    yul : float
+        Upper left corner of the grid y-coordinate.
+    rotation : float
+        Grid rotation angle in degrees, counter-clockwise
+        about the upper left corner, by default 0.
+
+    Returns
+    -------
+    ordered_reach_geoms: list of LineStrings
+        List of LineString objects representing the SFR reaches for the segment,
+        in order from the start to the end of the part.
+    ordered_node_numbers: list of ints
+        List of model cells containing the SFR reaches for the segment
+
+    Notes
+    -----
+    Results are the same as :func:`create_reaches`, except where a line
+    runs exactly along a row or column edge (in which case the line is
+    only assigned to the cell below or to the right of the edge), or where
+    a line vertex falls exactly on an edge (in which case polygon intersection
+    can split the line within a cell into more than one reach).
+    """
+    coords = np.array(part.coords)[:, :2]
+    if len(coords) < 2:
+        return [], []
+    ncol, nrow = len(xedges) - 1, len(yedges) - 1
+
+    # convert the vertices to grid coordinates
+    # (x along the rows, y down the columns, from the upper left corner)
+    theta = np.radians(rotation)
+    dx = coords[:, 0] - xul
+    dy = coords[:, 1] - yul
+    x = dx * np.cos(theta) + dy * np.sin(theta)
+    y = dx * np.sin(theta) - dy * np.cos(theta)
+
+    # fractional distances along each line segment
+    # of the segment start and any row or column crossings
+    nseg = len(coords) - 1
+    xseg, xt = _edge_crossings(x[:-1], x[1:], xedges)
+    yseg, yt = _edge_crossings(y[:-1], y[1:], yedges)
+    seg = np.concatenate([np.arange(nseg), xseg, yseg])
+    t = np.concatenate([np.zeros(nseg), xt, yt])
+    order = np.lexsort((t, seg))
+    seg, t = seg[order], t[order]
+
+    # points along the line where it crosses into a new cell
+    # (interpolated in both the grid and the original coordinates)
+    def interp(v):
+        return np.append(v[seg] + t * (v[seg + 1] - v[seg]), v[-1])
+
+    px, py = interp(x), interp(y)
+    wx, wy = interp(coords[:, 0]), interp(coords[:, 1])
+
+    # locate the midpoint of each line fragment between crossings;
+    # drop zero-length fragments (duplicate vertices or crossings at cell corners)
+    lengths = np.hypot(np.diff(wx), np.diff(wy))
+    keep = lengths > 0
+    j = np.searchsorted(xedges, 0.5 * (px[:-1] + px[1:]), side='right') - 1
+    i = np.searchsorted(yedges, 0.5 * (py[:-1] + py[1:]), side='right') - 1
+    inside = (i >= 0) & (i < nrow) & (j >= 0) & (j < ncol)
+    nodes = np.where(inside, i * ncol + j, -1)
+    frag = np.arange(len(nodes))[keep]
+    nodes = nodes[keep]
+
+    # consolidate consecutive fragments in the same cell into reaches
+    if len(nodes) == 0:
+        return [], []
+    breaks = np.flatnonzero(np.diff(nodes) != 0) + 1
+    starts = np.append(0, breaks)
+    ends = np.append(breaks, len(nodes))
 
     ordered_reach_geoms = []
     ordered_node_numbers = []
-    current_reach = start
-    nreaches = len(reach_geoms)  # length before entries are popped
-
-    # for each flowline part (reach)
-    for i in range(nreaches):
-        # find the next flowline part (reach) that touches the current reach
-        dist = {j: g.distance(current_reach) for j, g in reach_geoms.items()}
-        dist_sorted = sorted(dist.items(), key=operator.itemgetter(1))
-        r = dist_sorted[0][0]
-        next_reach = reach_geoms.pop(r)
-        ordered_reach_geoms.append(next_reach)
-        ordered_node_numbers.append(reach_nodes[r])
-        current_reach = next_reach
-
-        if current_reach.touches(end.buffer(tol)) and len(ordered_node_numbers) == nreaches:
-            break
-    assert len(ordered_node_numbers) == nreaches  # new list of ordered node numbers must include all flowline parts
-    return ordered_reach_geoms, ordered_node_numbers
\ No newline at end of file
+    for s, e in zip(starts, ends):
+        if nodes[s] < 0:
+            continue
+        # vertices are the start of each fragment, plus the end of the last one
+        inds = np.append(frag[s:e], frag[e - 1] + 1)
+        ordered_reach_geoms.append(LineString(zip(wx[inds], wy[inds])))
+        ordered_node_numbers.append(int(nodes[s]))
+    return ordered_reach_geoms, ordered_node_numbers
@@ -1,8 +1,39 @@
+import hashlib
 import time
+from collections.abc import Mapping
 
 import numpy as np
 
 
+def get_routing_digest(df, columns):
+    """Get a digest (hash) of the values in the routing columns
+    of a DataFrame (e.g. nseg and outseg), for cheaply detecting
+    changes to the routing. Numeric columns are hashed from the
+    underlying array bytes; other columns (for example, lists of
+    downstream IDs) are hashed from their text representation.
+
+    Parameters
+    ----------
+    df : DataFrame
+    columns : sequence of str
+        Columns in df to include in the digest.
+
+    Returns
+    -------
+    digest : str
+        sha1 hex digest of the column values.
+    """
+    digest = hashlib.sha1()
+    for column in columns:
+        values = df[column].values
+        digest.update('{}:{}:{}'.format(column, values.dtype, len(values)).encode())
+        if values.dtype.kind in 'biuf':
+            digest.update(np.ascontiguousarray(values).tobytes())
+        else:
+            digest.update(repr(values.tolist()).encode())
+    return digest.hexdigest()
+
+
 def pick_toids(routing, elevations):
     """Reduce routing connections to one per ID (no divergences).
     Select the downstream ID based on elevation, or first position in
@@ -222,6 +253,414 @@ def make_reverse_graph(graph):
     return graph_r
 
 
+class RoutingGraph:
+    """Compact, integer-indexed representation of a one-to-one
+    routing network, for traversing the network without
+    building a path for every node.
+
+    Downstream connections are stored as an array of positions;
+    upstream connections are stored in compressed sparse row (CSR) form,
+    with the tributaries to each node listed in their original order.
+    The topological order of the nodes is computed on first access and cached.
+
+    Parameters
+    ----------
+    routing : dict
+        {id: to_id} connections. to_ids that are 0 or
+        not in routing.keys() are treated as outlets.
+
+    Examples
+    --------
+    >>> graph = RoutingGraph({1: 2, 2: 4, 3: 4, 4: 0})
+    >>> list(graph.iter_path(1))
+    [1, 2, 4, 0]
+    >>> graph.get_upstream(4)
+    {1, 2, 3}
+    """
+    def __init__(self, routing):
+        self._ids = list(routing.keys())
+        self._toids = list(routing.values())
+        self._id_array = np.array(self._ids)
+        self._index = {id: i for i, id in enumerate(self._ids)}
+        n = len(self._ids)
+        self._to_index = np.array([self._index.get(toid, -1) if toid != 0 else -1
+                                   for toid in self._toids], dtype=np.int64)
+
+        # upstream connections (CSR)
+        routed = self._to_index >= 0
+        counts = np.bincount(self._to_index[routed], minlength=n)
+        self._up_ptr = np.zeros(n + 1, dtype=np.int64)
+        self._up_ptr[1:] = np.cumsum(counts)
+        # stable sort keeps tributaries in their original order
+        order = np.argsort(self._to_index, kind='stable')
+        self._up_index = order[routed[order]]
+        self._indegree = counts
+
+        # lines that route to the same to_id outside of the network
+        self._external_upstream = {}
+        for i in np.flatnonzero(~routed):
+            self._external_upstream.setdefault(self._toids[i], []).append(i)
+
+        self._topological_order = None
+        self._topological_levels = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id):
+        return id in self._index
+
+    @property
+    def ids(self):
+        """Array of ids in the network, in their original order."""
+        return self._id_array
+
+    @property
+    def outlets(self):
+        """Array of ids that route to 0, or to an id
+        outside of the network."""
+        return self._id_array[self._to_index < 0]
+
+    @property
+    def headwaters(self):
+        """Array of ids with no upstream connections."""
+        return self._id_array[self._indegree == 0]
+
+    @property
+    def is_circular(self):
+        """True if any ids route back to themselves."""
+        return len(self._get_topological_order()) < len(self)
+
+    @property
+    def topological_order(self):
+        """Array of ids ordered so that each id comes
+        before the id it routes to (upstream to downstream).
+        """
+        if self.is_circular:
+            raise ValueError('Routing is circular; '
+                             'no topological order exists.')
+        return self.acyclic_order
+
+    @property
+    def acyclic_order(self):
+        """Array of the ids that aren't on or downstream of circular
+        routing, in topological order (same as :attr:`topological_order`
+        if the routing isn't circular).
+        """
+        return self._id_array[self._get_topological_order()]
+
+    @property
+    def circular_ids(self):
+        """Array of ids on or downstream of circular routing
+        (that aren't in :attr:`acyclic_order`), in their original order.
+        """
+        in_order = np.zeros(len(self), dtype=bool)
+        in_order[self._get_topological_order()] = True
+        return self._id_array[~in_order]
+
+    @property
+    def paths(self):
+        """Read-only mapping of routing sequences from each id to an outlet,
+        similar to ``{id: find_path(routing, id) for id in routing}``,
+        except that each path is only generated when it is accessed.
+        """
+        return RoutingPaths(self)
+
+    def _get_topological_order(self):
+        """Positions of the nodes in topological order
+        (Kahn's algorithm, processing all nodes with no
+        remaining upstream connections at once). Nodes on or
+        downstream of a cycle are not included.
+        """
+        if self._topological_order is None:
+            indegree = self._indegree.copy()
+            order = []
+            frontier = np.flatnonzero(indegree == 0)
+            while len(frontier) > 0:
+                order.append(frontier)
+                downstream = self._to_index[frontier]
+                downstream, counts = np.unique(downstream[downstream >= 0],
+                                               return_counts=True)
+                indegree[downstream] -= counts
+                frontier = downstream[indegree[downstream] == 0]
+            self._topological_levels = order
+            if len(order) > 0:
+                self._topological_order = np.concatenate(order)
+            else:
+                self._topological_order = np.array([], dtype=np.int64)
+        return self._topological_order
+
+    def _upstream_of(self, positions):
+        """Positions of the nodes immediately upstream of positions,
+        concatenated in the order of positions."""
+        starts = self._up_ptr[positions]
+        lengths = self._up_ptr[positions + 1] - starts
+        total = lengths.sum()
+        if total == 0:
+            return np.array([], dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        gather = np.repeat(starts - offsets, lengths) + np.arange(total)
+        return self._up_index[gather]
+
+    def _positions(self, ids):
+        """Positions of ids in the network. ids that aren't in the network
+        (e.g. 0) are replaced by the outlets that route to them."""
+        positions = []
+        for id in ids:
+            if id in self._index:
+                positions.append(self._index[id])
+            else:
+                positions.extend(self._external_upstream.get(id, []))
+        return positions
+
+    def iter_path(self, start):
+        """Iterate through the routing sequence from start
+        to an outlet. Yields the same sequence as :func:`find_path`,
+        including the to_id of the outlet (usually 0).
+
+        Parameters
+        ----------
+        start : int or str
+            Starting id (must be in the network).
+
+        Yields
+        ------
+        id : int or str
+        """
+        i = self._index[start]
+        yield start
+        # limit the path length in case the routing is circular
+        for _ in range(len(self)):
+            next_i = self._to_index[i]
+            if next_i < 0:
+                yield self._toids[i]
+                return
+            yield self._ids[next_i]
+            i = next_i
+
+    def iter_upstream_levels(self, ids=None):
+        """Iterate upstream through the network in a breadth-first search,
+        starting at ids (the outlets by default).
+
+        Parameters
+        ----------
+        ids : sequence, optional
+            Starting ids. ids not in the network are
+            replaced by the outlets that route to them.
+
+        Yields
+        ------
+        level : 1D array
+            ids at each successive distance upstream of ids,
+            starting with ids. Tributaries to each id
+            are listed in their original order.
+        """
+        if ids is None:
+            positions = np.flatnonzero(self._to_index < 0)
+        else:
+            positions = np.array(self._positions(ids), dtype=np.int64)
+        while len(positions) > 0:
+            yield self._id_array[positions]
+            positions = self._upstream_of(positions)
+
+    def get_upstream(self, id):
+        """Get all ids upstream of id as a single flat set.
+
+        Parameters
+        ----------
+        id : int or str
+            Starting id. If id isn't in the network (e.g. 0),
+            the outlets that route to it and all ids upstream
+            of those outlets are returned.
+
+        Returns
+        -------
+        upstream : set
+        """
+        levels = self.iter_upstream_levels([id])
+        if id in self._index:
+            next(levels)
+        upstream = set()
+        for level in levels:
+            upstream.update(level.tolist())
+        return upstream
+
+    def accumulate(self, values, ids=None, ufunc=np.add):
+        """Accumulate values going downstream through the network,
+        so that the result for each id reflects that id and all ids
+        upstream (for example, arbolate sums from line lengths,
+        or drainage areas from catchment areas). Results are computed
+        for the whole network in one pass, in topological order.
+
+        Parameters
+        ----------
+        values : dict or 1D array
+            Values to accumulate, either as a dictionary keyed by id,
+            or an array aligned with :attr:`ids`. ids that aren't
+            in a dictionary of values are assigned 0.
+        ids : sequence, optional
+            ids to return results for. ids not in the network (e.g. 0)
+            get the accumulated values of the outlets that route to them,
+            combined with their own value (if values is a dictionary).
+            By default, all ids in the network.
+        ufunc : numpy ufunc
+            Function for combining values, e.g. numpy.add (default) for
+            a sum, or numpy.minimum or numpy.maximum for the lowest or
+            highest value upstream.
+
+        Returns
+        -------
+        accumulated : dict
+            Accumulated values keyed by id.
+
+        Examples
+        --------
+        >>> graph = RoutingGraph({1: 2, 2: 4, 3: 4, 4: 0})
+        >>> graph.accumulate({1: 1., 2: 1., 3: 2., 4: 1.})
+        {1: 1.0, 2: 2.0, 3: 2.0, 4: 5.0}
+        """
+        if self.is_circular:
+            raise ValueError('Routing is circular; '
+                             'values can\'t be accumulated.')
+        if isinstance(values, dict):
+            array = np.array([values.get(id, 0.) for id in self._ids], dtype=float)
+        else:
+            array = np.array(values, dtype=float)
+            values = {}
+        for level in self._topological_levels:
+            downstream = self._to_index[level]
+            routed = downstream >= 0
+            ufunc.at(array, downstream[routed], array[level[routed]])
+        if ids is None:
+            return dict(zip(self._ids, array.tolist()))
+        accumulated = {}
+        for id in ids:
+            if id in self._index:
+                accumulated[id] = float(array[self._index[id]])
+            else:
+                outlets = self._external_upstream.get(id, [])
+                accumulated[id] = float(ufunc.reduce(np.append(array[outlets],
+                                                               values.get(id, 0.))))
+        return accumulated
+
+    def get_next_in_subset(self, subset, ids=None, include_start=False):
+        """Get the first id in each routing path that is also in subset.
+        Results for each id are reused for all ids upstream,
+        so that each connection in the network is only visited once.
+
+        Parameters
+        ----------
+        subset : iterable
+            ids to look for; may include the to_ids
+            of outlets (e.g. 0).
+        ids : iterable, optional
+            ids to get results for. By default, all ids in the network.
+        include_start : bool
+            If True, ids that are in subset are returned as themselves.
+            By default False (only ids downstream are considered).
+
+        Returns
+        -------
+        next_ids : dict
+            {id: first id downstream in subset}. Values are None
+            for ids that have no downstream ids in subset.
+        """
+        subset = set(subset)
+        n = len(self)
+        result = [None] * n
+        resolved = np.zeros(n, dtype=bool)
+        if ids is None:
+            ids = self._ids
+        positions = [self._index[id] for id in ids]
+        for i in positions:
+            chain = []
+            in_chain = set()
+            j = i
+            next_id = None
+            while not resolved[j] and j not in in_chain:
+                chain.append(j)
+                in_chain.add(j)
+                next_j = self._to_index[j]
+                next_value = self._ids[next_j] if next_j >= 0 else self._toids[j]
+                if next_value in subset:
+                    next_id = next_value
+                    break
+                if next_j < 0:
+                    break
+                j = next_j
+            else:
+                if resolved[j]:
+                    next_id = result[j]
+            for c in chain:
+                result[c] = next_id
+                resolved[c] = True
+        next_ids = {}
+        for id, i in zip(ids, positions):
+            if include_start and id in subset:
+                next_ids[id] = id
+            else:
+                next_ids[id] = result[i]
+        return next_ids
+
+    def get_previous_in_subset(self, subset, ids):
+        """Get the first ids upstream of ids that are also in subset.
+        ids in subset are returned as themselves.
+
+        Parameters
+        ----------
+        subset : iterable
+            ids to look for.
+        ids : iterable
+            Starting ids. ids not in the network (e.g. 0) are
+            replaced by the outlets that route to them.
+
+        Returns
+        -------
+        previous_ids : set
+        """
+        subset = set(subset)
+        in_subset = np.array([id in subset for id in self._ids], dtype=bool)
+        visited = np.zeros(len(self), dtype=bool)
+        previous_ids = {id for id in ids if id in subset}
+        starts = [id for id in ids if id not in subset]
+        positions = np.array(self._positions(starts), dtype=np.int64)
+        while len(positions) > 0:
+            positions = positions[~visited[positions]]
+            visited[positions] = True
+            found = in_subset[positions]
+            previous_ids.update(self._id_array[positions[found]].tolist())
+            positions = self._upstream_of(positions[~found])
+        return previous_ids
+
+
+class RoutingPaths(Mapping):
+    """Read-only mapping of routing paths, where each value is a list
+    of downstream ids constituting a flow path to an outlet
+    for a given id (key). Paths are generated on access
+    and not stored.
+
+    Parameters
+    ----------
+    graph : RoutingGraph instance
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, id):
+        if id not in self.graph:
+            raise KeyError(id)
+        return list(self.graph.iter_path(id))
+
+    def __contains__(self, id):
+        return id in self.graph
+
+    def __iter__(self):
+        return iter(self.graph._ids)
+
+    def __len__(self):
+        return len(self.graph)
+
+
 def renumber_segments(nseg, outseg):
     """Renumber segments so that segment numbering is continuous, starts at 1, and always increases
         in the downstream direction. Experience suggests that this can substantially speed
@@ -245,33 +684,29 @@ def renumber_segments(nseg, outseg):
     if not isinstance(outseg, np.ndarray):
         outseg = np.array(outseg)
 
-    def reassign_upsegs(r, nexts, upsegs):
-        nextupsegs = []
-        for u in upsegs:
-            r[u] = nexts if u > 0 else u  # handle lakes
-            nexts -= 1
-            nextupsegs += list(nseg[outseg == u])
-        return r, nexts, nextupsegs
-
     print('enforcing best segment numbering...')
     # enforce that all outsegs not listed in nseg are converted to 0
     # but leave lakes alone
     r = {0: 0}
-    r.update({o: 0 for o in outseg if o > 0 and o not in nseg})
-    outseg = np.array([o if o in nseg or o < 0 else 0 for o in outseg])
+    in_nseg = np.isin(outseg, nseg)
+    r.update({o: 0 for o in outseg[(outseg > 0) & ~in_nseg]})
+    outseg = np.where(in_nseg | (outseg < 0), outseg, 0)
 
     # if reach data are supplied, segment/outseg pairs may be listed more than once
-    if len(nseg) != len(np.unique(nseg)):
-        d = dict(zip(nseg, outseg))
-        nseg, outseg = np.array(list(d.keys())), np.array(list(d.values()))
-    ns = len(nseg)
+    routing = dict(zip(nseg, outseg))
+    graph = RoutingGraph(routing)
+    ns = len(graph)
 
+    # number segments in order of decreasing distance upstream of the outlets
+    # (breadth-first search of the routing graph going upstream;
+    # upstream connections are only looked up once for each segment)
     nexts = ns
-    nextupsegs = nseg[outseg == 0]
-    for i in range(ns):
-        r, nexts, nextupsegs = reassign_upsegs(r, nexts, nextupsegs)
-        if len(nextupsegs) == 0:
-            break
+    outlets = [s for s, o in routing.items() if o == 0]
+    for upsegs in graph.iter_upstream_levels(outlets):
+        newsegs = nexts - np.arange(len(upsegs))
+        r.update(zip(upsegs.tolist(),
+                     np.where(upsegs > 0, newsegs, upsegs).tolist()))  # handle lakes
+        nexts -= len(upsegs)
     return r
 
 
@@ -296,17 +731,12 @@ def get_next_id_in_subset(subset, routing, ids):
         that are also in subset.
     """
     subset = set(subset).union({0})
-    routing = routing.copy()
     if np.isscalar(ids):
         ids = [ids]
-    paths = [find_path(routing, i) for i in ids]
-    new_ids = []
-    for p in paths:
-        for id in p:
-            if id in subset:
-                new_ids.append(id)
-                break
-    assert len(new_ids) == len(ids)
+    graph = RoutingGraph(routing)
+    next_ids = graph.get_next_in_subset(subset, ids=set(ids), include_start=True)
+    new_ids = [next_ids[id] for id in ids]
+    assert None not in new_ids
     return new_ids
 
 
@@ -331,22 +761,7 @@ def get_previous_ids_in_subset(subset, routing, ids):
         that are also in subset.
     """
     subset = set(subset).union({0})
-    routing = routing.copy()
     if np.isscalar(ids):
         ids = [ids]
-    else:
-        ids = ids.copy()
-    graph_r = make_reverse_graph(routing)
-
-    new_ids = set()
-    nextupsegs = ids
-    for i in range(len(graph_r)):
-        for upseg in nextupsegs:
-            if upseg in subset:
-                new_ids.add(upseg)
-        if len(new_ids) == len(nextupsegs):
-            break
-        nextupsegs = set(nextupsegs).difference(new_ids)
-        if len(nextupsegs) > 0:
-            nextupsegs = get_nextupsegs(graph_r, nextupsegs)
-    return new_ids
+    graph = RoutingGraph(routing)
+    return graph.get_previous_in_subset(subset, ids)
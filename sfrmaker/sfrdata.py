@@ -9,9 +9,11 @@ import rasterio
 from rasterstats import zonal_stats
 from shapely.geometry import LineString
 from gisutils import df2shp, get_authority_crs
-from sfrmaker.routing import find_path, renumber_segments
+from sfrmaker.routing import RoutingGraph, renumber_segments, get_routing_digest
 from sfrmaker.checks import valid_rnos, valid_nsegs, rno_nseg_routing_consistent
-from sfrmaker.elevations import smooth_elevations
+from sfrmaker.elevations import (smooth_reach_elevations, zonal_statistics,
+                                 ZonalStatisticsCache)
+from sfrmaker.fileio import read_table, write_table
 from sfrmaker.flows import add_to_perioddata, add_to_segment_data
 from sfrmaker.gis import export_reach_data, project
 from sfrmaker.observations import write_gage_package, write_mf6_sfr_obsfile, add_observations
@@ -162,6 +164,16 @@ class SFRData(DataPackage):
         self._rno_routing = None  # dictionary of rno routing connections
         self._paths = None  # routing sequence from each segment to outlet
         self._reach_paths = None  # routing sequence from each reach number to outlet
+        self._routing = None  # segment routing dictionary (from segment data)
+        # digests (hashes) of the routing columns in segment_data and reach_data,
+        # for cheaply checking whether the routing has changed
+        self._segment_routing_digest = None
+        self._routing_digest = None
+        # preliminary reaches, line ids and arguments from Lines.to_sfr,
+        # for incremental updates (see update_from_lines)
+        self._lines_reach_data = None
+        self._lines_ids = None
+        self._to_sfr_kwargs = None
 
         if not self._valid_nsegs(increasing=enforce_increasing_nsegs):
             self.reset_segments()
@@ -242,7 +254,10 @@ class SFRData(DataPackage):
 
     @property
     def segment_routing(self):
-        if self._segment_routing is None or self._routing_changed():
+        # only rebuild the routing if the segment data routing columns changed
+        digest = get_routing_digest(self.segment_data, ['per', 'nseg', 'outseg'])
+        if self._routing is None or digest != self._segment_routing_digest:
+            self._segment_routing_digest = digest
             sd = self.segment_data.groupby('per').get_group(0)
             graph = dict(
                 zip(sd.nseg, sd.outseg))
@@ -250,6 +265,8 @@ class SFRData(DataPackage):
                 set(graph.keys()))  # including lakes
             graph.update({o: 0 for o in outlets})
             self._routing = graph
+            # paths from the previous routing are no longer valid
+            self._paths = None
         return self._routing
 
     @property
@@ -265,6 +282,8 @@ class SFRData(DataPackage):
                 set(graph.keys()))  # including lakes
             graph.update({o: 0 for o in outlets})
             self._rno_routing = graph
+            self._routing_digest = None
+            self._reach_paths = None
         return self._rno_routing
 
     @property
@@ -418,8 +437,9 @@ class SFRData(DataPackage):
                                    data_column=data_column)
     @property
     def paths(self):
-        """Dict listing routing sequence for each segment
-        in SFR network."""
+        """Read-only mapping of the routing sequence for each segment
+        in SFR network (see :class:`sfrmaker.routing.RoutingPaths`).
+        Paths are generated as they are accessed."""
         if self._paths is None:
             self._set_paths()
             return self._paths
@@ -429,9 +449,10 @@ class SFRData(DataPackage):
 
     @property
     def reach_paths(self):
-        """Dict listing routing sequence for each segment
-        in SFR network."""
-        if self._paths is None:
+        """Read-only mapping of the routing sequence for each reach
+        in SFR network (see :class:`sfrmaker.routing.RoutingPaths`).
+        Paths are generated as they are accessed."""
+        if self._reach_paths is None:
             self._set_reach_paths()
             return self._reach_paths
         if self._routing_changed():
@@ -439,12 +460,10 @@ class SFRData(DataPackage):
         return self._reach_paths
 
     def _set_paths(self):
-        routing = self.segment_routing
-        self._paths = {seg: find_path(routing, seg) for seg in routing.keys()}
+        self._paths = RoutingGraph(self.segment_routing).paths
 
     def _set_reach_paths(self):
-        routing = self.rno_routing
-        self._reach_paths = {rno: find_path(routing, rno) for rno in routing.keys()}
+        self._reach_paths = RoutingGraph(self.rno_routing).paths
 
     def _reset_routing(self):
         self.reset_reaches()
@@ -453,8 +472,17 @@ class SFRData(DataPackage):
         self._set_paths()
         self._rno_routing = None
         self._set_reach_paths()
+        self._routing_digest = None
 
     def _routing_changed(self):
+        # first compare a digest of the routing columns in segment_data and
+        # reach_data to the digest when the routing was last found to be unchanged
+        # (so that checking unchanged routing is cheap)
+        digest = get_routing_digest(self.segment_data, ['per', 'nseg', 'outseg']) + \
+                 get_routing_digest(self.reach_data, ['rno', 'outreach', 'iseg', 'ireach'])
+        if digest == self._routing_digest:
+            return False
+
         sd = self.segment_data.groupby('per').get_group(0)
         rd = self.reach_data
         # check if segment routing in dataframe is consistent with routing dict
@@ -471,7 +499,10 @@ class SFRData(DataPackage):
                                                  rd.rno, rd.outreach)
         # return True if the dataframes changed,
         # or are inconsistent between segments and reach numbers
-        return segment_routing_changed & reach_routing_changed & ~consistent
+        changed = segment_routing_changed & reach_routing_changed & ~consistent
+        if not changed:
+            self._routing_digest = digest
+        return changed
 
     def repair_outsegs(self):
         """Set any outsegs that are not nsegs or lakes to 0 (outlet status)"""
@@ -863,7 +894,9 @@ class SFRData(DataPackage):
     def sample_reach_elevations(self, dem,
                                 method='buffers',
                                 buffer_distance=100,
-                                smooth=True
+                                smooth=True,
+                                engine='rasterstats',
+                                cache_file=None
                                 ):
         """Computes zonal statistics on a raster for SFR reaches, using
         either buffer polygons around the reach LineStrings, or the model
@@ -882,6 +915,25 @@ class SFRData(DataPackage):
             Run sfrmaker.elevations.smooth_elevations on sampled elevations
             to ensure that they decrease monotonically in the downstream direction
             (default=True).
+        engine : str; 'rasterstats', 'native' or 'grid'
+            Method for computing the zonal statistics. 'rasterstats' (default)
+            uses rasterstats.zonal_stats, which reads and rasterizes the DEM
+            separately for each feature. 'native' uses
+            :func:`sfrmaker.elevations.zonal_statistics`, which reads the DEM
+            once (in blocks of rows) and rasterizes the features together;
+            this is much faster for large numbers of reaches. 'grid'
+            (``method='cell polygons'`` with a :class:`~sfrmaker.grid.StructuredGrid`
+            only) computes the minimum DEM elevation for every cell in the grid
+            at once (see :meth:`~sfrmaker.grid.StructuredGrid.get_raster_statistics`),
+            and looks up the reach values by row and column. The array of cell
+            elevations is cached on the grid. The DEM must be in the same CRS
+            as the grid.
+        cache_file : str or pathlike, optional
+            SQLite database file for caching the sampled elevations between runs
+            (see :class:`sfrmaker.elevations.ZonalStatisticsCache`). Only features
+            that are new or have changed since a previous run (or that were sampled
+            from a different version of the DEM) are sampled. Not used with
+            ``engine='grid'``. By default, None (no caching).
 
         Returns
         -------
@@ -897,7 +949,21 @@ class SFRData(DataPackage):
                                               src.res[1]) * 1.01,
                                       buffer_distance])
 
-        if method == 'buffers':
+        if engine == 'grid':
+            if method != 'cell polygons' or not isinstance(self.grid, sfrmaker.StructuredGrid):
+                raise ValueError("engine='grid' requires method='cell polygons' "
+                                 "and an attached sfrmaker.StructuredGrid")
+            if raster_crs != self.crs:
+                raise ValueError("engine='grid' requires a DEM in the same CRS "
+                                 "as the model grid ({})".format(self.crs))
+            print('computing minimum elevations for model cells...')
+            t0 = time.time()
+            cell_elevs = self.grid.get_raster_statistics(dem, stat='min')
+            elevs = cell_elevs[self.reach_data.i.values, self.reach_data.j.values]
+            elevs = [None if np.isnan(v) else v for v in elevs]
+            print("finished in {:.2f}s\n".format(time.time() - t0))
+            txt = method
+        elif method == 'buffers':
             assert isinstance(self.reach_data.geometry[0], LineString), \
                 "Need LineString geometries in reach_data.geometry column to use buffer option."
             features = [g.buffer(buffer_distance) for g in self.reach_data.geometry]
@@ -905,22 +971,38 @@ class SFRData(DataPackage):
         elif method == 'cell polygons':
             assert self.grid is not None, \
                 "Need an attached sfrmaker.Grid instance to use cell polygons option."
-            features = self.grid.df.loc[self.reach_data.node, 'geometry'].tolist()
+            features = self.grid.get_cell_polygons(self.reach_data.node.values)
             txt = method
 
-        # to_crs features if they're not in the same crs
-        if raster_crs != self.crs:
-            features = project(features,
-                               self.crs,
-                               raster_crs)
-
-        print('running rasterstats.zonal_stats on {}...'.format(txt))
-        t0 = time.time()
-        results = zonal_stats(features,
-                              dem,
-                              stats='min')
-        elevs = [r['min'] for r in results]
-        print("finished in {:.2f}s\n".format(time.time() - t0))
+        if engine != 'grid':
+            # to_crs features if they're not in the same crs
+            if raster_crs != self.crs:
+                features = project(features,
+                                   self.crs,
+                                   raster_crs)
+
+            t0 = time.time()
+            if engine == 'rasterstats':
+                print('running rasterstats.zonal_stats on {}...'.format(txt))
+                function = zonal_stats
+            elif engine == 'native':
+                print('running sfrmaker.elevations.zonal_statistics on {}...'.format(txt))
+                function = zonal_statistics
+            else:
+                raise ValueError("Unrecognized engine: {}; "
+                                 "use 'rasterstats', 'native' or 'grid'".format(engine))
+            if cache_file is not None:
+                cache = ZonalStatisticsCache(cache_file)
+                results = cache.zonal_statistics(features,
+                                                 dem,
+                                                 stats='min',
+                                                 function=function)
+            else:
+                results = function(features,
+                                   dem,
+                                   stats='min')
+            elevs = [r['min'] for r in results]
+            print("finished in {:.2f}s\n".format(time.time() - t0))
 
         if all(v is None for v in elevs):
             raise Exception('No {} intersected with {}. Check projections.'.format(txt, dem))
@@ -930,9 +1012,10 @@ class SFRData(DataPackage):
                             '.'.format(txt, dem))
 
         if smooth:
-            elevs = smooth_elevations(self.reach_data.rno.tolist(),
-                                      self.reach_data.outreach.tolist(),
-                                      elevs)
+            elevs = smooth_reach_elevations(self.reach_data.rno.values,
+                                            self.reach_data.outreach.values,
+                                            elevs)
+            elevs = dict(zip(self.reach_data.rno, elevs))
         else:
             elevs = dict(zip(self.reach_data.rno, elevs))
         return elevs
@@ -1012,6 +1095,41 @@ class SFRData(DataPackage):
         slopes[slopes > maximum_slope] = maximum_slope
         self.reach_data['slope'] = slopes
 
+    def update_from_lines(self, lines, changed_ids=None):
+        """Create an updated SFR dataset from an edited version of the
+        :class:`~sfrmaker.lines.Lines` instance that this dataset was created
+        from (with :meth:`Lines.to_sfr <sfrmaker.lines.Lines.to_sfr>`).
+        Only the lines in changed_ids (and any lines that were added) are
+        intersected with the model grid; the preliminary reaches for the
+        other lines are reused, and reaches for lines that were removed are dropped.
+        Routing, numbering, outreaches and slopes are then set up in the same
+        way as :meth:`Lines.to_sfr <sfrmaker.lines.Lines.to_sfr>`,
+        so that the results are the same as a full rebuild.
+
+        Parameters
+        ----------
+        lines : sfrmaker.lines.Lines
+            Edited lines.
+        changed_ids : sequence, optional
+            IDs of lines with modified geometries. Lines with only
+            changes to their routing or other attributes don't need
+            to be included. By default, None.
+
+        Returns
+        -------
+        sfrdata : SFRData
+            New SFR dataset, created with the same
+            :meth:`Lines.to_sfr <sfrmaker.lines.Lines.to_sfr>` arguments
+            as this one. Any subsequent modifications to this dataset
+            (for example, streambed elevations sampled from a DEM)
+            need to be repeated.
+        """
+        if self._to_sfr_kwargs is None:
+            raise ValueError("update_from_lines requires an SFRData instance "
+                             "created with Lines.to_sfr")
+        return lines.to_sfr(previous_sfrdata=self, changed_ids=changed_ids,
+                            **self._to_sfr_kwargs)
+
     @classmethod
     def from_package(cls, sfrpackagefile, grid, namefile=None,
                      sim_name=None, model_ws='.',
@@ -1075,8 +1193,13 @@ class SFRData(DataPackage):
     @classmethod
     def from_tables(cls, reach_data, segment_data,
                     grid=None, isfr=None):
-        reach_data = pd.read_csv(reach_data)
-        segment_data = pd.read_csv(segment_data)
+        """Create an SFRData instance from reach and segment data tables
+        written by :meth:`SFRData.write_tables`, in the csv, Parquet (.parquet)
+        or Feather (.feather) format (depending on the file extensions).
+        Reach geometries in Parquet or Feather tables are retained.
+        """
+        reach_data = read_table(reach_data)
+        segment_data = read_table(segment_data)
         return cls(reach_data=reach_data, segment_data=segment_data,
                    grid=grid, isfr=isfr)
 
@@ -1471,6 +1594,7 @@ class SFRData(DataPackage):
                       options=None, run_diagnostics=True,
                       write_observations_input=True,
                       external_files_path=None, gage_starting_unit_number=None,
+                      external_period_data=None, skip_unchanged_periods=False,
                       **kwargs):
         """Write an SFR package input file.
 
@@ -1517,6 +1641,15 @@ class SFRData(DataPackage):
         gage_starting_unit_number : int, optional
             Starting unit number for gage output files, 
             by default None
+        external_period_data : str, {None, 'period', 'variable'}
+            MODFLOW-6 only. Option to write the period data to external files,
+            one for each stress period ('period'), or for each variable
+            in each stress period ('variable'). See :meth:`Mf6SFR.write_file`.
+            By default None (period data are written to the SFR package file).
+        skip_unchanged_periods : bool, optional
+            MODFLOW-6 only. Option to omit period blocks that are the same
+            as the previous period block (MODFLOW 6 carries the settings forward).
+            By default False.
         """        
         print('SFRmaker v. {}'.format(sfrmaker.__version__))
         # run the flopy SFR diagnostics
@@ -1577,9 +1710,11 @@ class SFRData(DataPackage):
                           options=options)
 
             # write a MODFLOW 6 file
-            sfr6.write_file(filename=filename, external_files_path=external_files_path)
+            sfr6.write_file(filename=filename, external_files_path=external_files_path,
+                            external_period_data=external_period_data,
+                            skip_unchanged_periods=skip_unchanged_periods)
 
-    def write_tables(self, basename=None):
+    def write_tables(self, basename=None, file_format='csv'):
         """Write :py:attr:`~SFRData.reach_data`, :py:attr:`~SFRData.segment_data`,
         and :py:attr:`~SFRData.period_data` (if populated) to csv files. 
 
@@ -1588,6 +1723,11 @@ class SFRData(DataPackage):
         basename : str, optional
             Base name for csv files, by default None, in which case
             :py:attr:`SFRData.package_name` is used.
+        file_format : str, {'csv', 'parquet', 'feather'}
+            Format for the tables. Parquet and Feather (which require pyarrow)
+            preserve the column data types, are faster to read and write,
+            and include the reach geometries (as WKB, with GeoParquet metadata;
+            see :func:`sfrmaker.fileio.write_table`). By default, 'csv'.
         """
         if basename is None:
             output_path = self._tables_path
@@ -1597,17 +1737,23 @@ class SFRData(DataPackage):
         else:
             output_path, basename = os.path.split(basename)
             basename, _ = os.path.splitext(basename)
-        reach_data_file = os.path.normpath('{}/{}_sfr_reach_data.csv'.format(output_path, basename))
-        self.reach_data.drop('geometry', axis=1).to_csv(reach_data_file, index=False)
-        print('wrote {}'.format(reach_data_file))
-        segment_data_file = os.path.normpath('{}/{}_sfr_segment_data.csv'.format(output_path, basename))
-        self.segment_data.to_csv(segment_data_file, index=False)
-        print('wrote {}'.format(segment_data_file))
+        if file_format not in {'csv', 'parquet', 'feather'}:
+            raise ValueError("Unrecognized file_format: {}; "
+                             "use 'csv', 'parquet' or 'feather'".format(file_format))
+        reach_data = self.reach_data
+        if file_format == 'csv':
+            reach_data = reach_data.drop('geometry', axis=1)
+        reach_data_file = os.path.normpath('{}/{}_sfr_reach_data.{}'.format(output_path, basename,
+                                                                            file_format))
+        write_table(reach_data, reach_data_file, crs=self.crs)
+        segment_data_file = os.path.normpath('{}/{}_sfr_segment_data.{}'.format(output_path, basename,
+                                                                                file_format))
+        write_table(self.segment_data, segment_data_file)
 
         if self.period_data is not None and len(self.period_data) > 0:
-            pd_file = os.path.normpath('{}/{}_sfr_period_data.csv'.format(output_path, basename))
-            self.period_data.dropna(axis=1, how='all').to_csv(pd_file, index=False)
-            print('wrote {}'.format(pd_file))
+            pd_file = os.path.normpath('{}/{}_sfr_period_data.{}'.format(output_path, basename,
+                                                                         file_format))
+            write_table(self.period_data.dropna(axis=1, how='all'), pd_file)
 
     def write_gage_package(self, filename=None, gage_package_unit=25,
                            gage_starting_unit_number=None):
@@ -1676,7 +1822,7 @@ class SFRData(DataPackage):
             filename = self.package_name + '_sfr_routing.shp'
         rd = self.reach_data[['node', 'iseg', 'ireach', 'rno', 'outreach']].copy()
         rd.sort_values(by='rno', inplace=True)
-        cellgeoms = self.grid.df.loc[rd.node.values, 'geometry']
+        cellgeoms = self.grid.get_cell_polygons(rd.node.values)
 
         # get the cell centers for each reach
         x0 = [g.centroid.x for g in cellgeoms]
@@ -1,2 +1,156 @@
+import numpy as np
+import pytest
+from sfrmaker.elevations import (smooth_elevations, smooth_reach_elevations,
+                                 _smooth_elevations_by_search)
+from sfrmaker.routing import RoutingGraph
 
 
+def random_network(n, seed=0):
+    """Make a random dendritic network of n lines, numbered in random order,
+    with some lines routing to lakes or to ids outside of the network."""
+    rng = np.random.RandomState(seed)
+    positions = np.arange(n)
+    outpositions = (rng.random_sample(n) * positions).astype(int)
+    ids = rng.permutation(n) + 1
+    toids = ids[outpositions]
+    toids[(rng.random_sample(n) < 0.05) | (positions == 0)] = 0
+    toids[rng.random_sample(n) < 0.02] = -1
+    toids[rng.random_sample(n) < 0.02] = n + 10
+    return ids, toids
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_smooth_elevations(seed):
+    fromids, toids = random_network(200, seed=seed)
+    rng = np.random.RandomState(seed)
+    elevations = rng.random_sample(len(fromids)) * 10
+    results = smooth_elevations(fromids, toids, elevations)
+    expected = _smooth_elevations_by_search(fromids, toids, elevations.copy())
+    assert results.keys() == expected.keys()
+    assert np.allclose([results[k] for k in expected], list(expected.values()))
+
+    # array version
+    results = smooth_reach_elevations(fromids, toids, elevations)
+    assert np.allclose(results, list(expected.values()))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_smooth_elevations_start_elevations(seed):
+    fromids, toids = random_network(200, seed=seed)
+    rng = np.random.RandomState(seed)
+    end_elevations = rng.random_sample(len(fromids)) * 10
+    start_elevations = end_elevations + rng.random_sample(len(fromids))
+    elevdn, elevup = smooth_elevations(fromids, toids, end_elevations, start_elevations)
+    expected_dn, expected_up = _smooth_elevations_by_search(fromids, toids,
+                                                            end_elevations.copy(),
+                                                            start_elevations.copy())
+    assert np.allclose([elevup[k] for k in expected_up], list(expected_up.values()))
+    # the original method only reduces end elevations to the start elevation
+    # of the next line downstream if that start elevation has already
+    # been reduced by another tributary
+    routing = dict(zip(fromids, toids))
+    drains_to_outlet = RoutingGraph(routing).get_upstream(0)
+    for k, v in expected_dn.items():
+        if k in drains_to_outlet and routing[k] != 0:
+            next_elevup = elevup[routing[k]]
+            assert np.allclose(elevdn[k], np.min([v, next_elevup]))
+            # values should never rise going downstream
+            assert next_elevup <= elevdn[k]
+        else:
+            assert np.allclose(elevdn[k], v)
+        assert elevdn[k] <= elevup[k]
+
+
+@pytest.fixture(scope='module')
+def synthetic_dem(tmpdir_factory):
+    rasterio = pytest.importorskip('rasterio')
+    from rasterio.transform import from_origin
+    rng = np.random.RandomState(0)
+    data = (rng.random_sample((120, 90)) * 100).astype('float32')
+    data[rng.random_sample(data.shape) < 0.05] = -9999
+    dem = str(tmpdir_factory.mktemp('zonal_stats').join('dem.tif'))
+    with rasterio.open(dem, 'w', driver='GTiff', height=data.shape[0],
+                       width=data.shape[1], count=1, dtype=data.dtype,
+                       transform=from_origin(1000., 2000., 10., 10.),
+                       nodata=-9999) as dst:
+        dst.write(data, 1)
+    return dem
+
+
+@pytest.mark.parametrize('all_touched', [False, True])
+@pytest.mark.parametrize('block_size', [4096, 17])
+def test_zonal_statistics(synthetic_dem, all_touched, block_size):
+    rasterstats = pytest.importorskip('rasterstats')
+    from shapely.geometry import LineString, Point
+    from sfrmaker.elevations import zonal_statistics
+    rng = np.random.RandomState(1)
+    features = []
+    for i in range(50):
+        x, y = 1000 + rng.random_sample() * 900, 800 + rng.random_sample() * 1200
+        features.append(LineString([(x, y), (x + rng.random_sample() * 200,
+                                             y + rng.random_sample() * 200)]).buffer(15))
+    # overlapping features, a feature smaller than a pixel and one outside of the raster
+    features += [features[0].buffer(30), Point(1455, 1455).buffer(1),
+                 Point(-1000, -1000).buffer(10)]
+    stats = ['min', 'max', 'mean', 'count', 'median', 'percentile_10']
+    results = zonal_statistics(features, synthetic_dem, stats=stats,
+                               all_touched=all_touched, block_size=block_size)
+    expected = rasterstats.zonal_stats(features, synthetic_dem, stats=stats,
+                                       all_touched=all_touched)
+    assert len(results) == len(expected)
+    for result, expected_result in zip(results, expected):
+        for stat in stats:
+            if expected_result[stat] is None:
+                assert result[stat] is None
+            else:
+                assert np.allclose(result[stat], expected_result[stat])
+    with pytest.raises(ValueError):
+        zonal_statistics(features, synthetic_dem, stats=['mode'])
+
+
+@pytest.mark.parametrize('engine', ['native', 'rasterstats'])
+def test_zonal_statistics_parallel(synthetic_dem, engine):
+    from shapely.geometry import Point
+    from sfrmaker.elevations import zonal_statistics, zonal_statistics_parallel
+    if engine == 'rasterstats':
+        rasterstats = pytest.importorskip('rasterstats')
+        function = rasterstats.zonal_stats
+    else:
+        function = zonal_statistics
+    rng = np.random.RandomState(2)
+    features = [Point(1000 + rng.random_sample() * 900,
+                      800 + rng.random_sample() * 1200).buffer(30) for i in range(100)]
+    stats = ['min', 'mean', 'count', 'percentile_10']
+    expected = function(features, synthetic_dem, stats=stats)
+    results = zonal_statistics_parallel(features, synthetic_dem, stats=stats,
+                                        function=function, n_workers=2)
+    assert results == expected
+    assert zonal_statistics_parallel([], synthetic_dem, n_workers=2) == []
+
+
+def test_zonal_statistics_cache(synthetic_dem, tmpdir):
+    from shapely.geometry import Point
+    from sfrmaker.elevations import zonal_statistics, ZonalStatisticsCache
+    features = [Point(1000 + 15 * i, 900 + 20 * i).buffer(25) for i in range(50)]
+    stats = ['min', 'mean', 'count']
+    expected = zonal_statistics(features, synthetic_dem, stats=stats)
+    cache_file = str(tmpdir.join('zonal_stats.sqlite'))
+    cache = ZonalStatisticsCache(cache_file)
+    results = cache.zonal_statistics(features, synthetic_dem, stats=stats)
+    assert (cache.hits, cache.misses) == (0, 50)
+    assert results == expected
+
+    # only new features, and features missing a statistic are sampled
+    cache = ZonalStatisticsCache(cache_file)
+    new_features = features[:10] + [features[0].buffer(10)]
+    results = cache.zonal_statistics(new_features, synthetic_dem, stats=stats)
+    assert (cache.hits, cache.misses) == (10, 1)
+    assert results == zonal_statistics(new_features, synthetic_dem, stats=stats)
+    results = cache.zonal_statistics(features, synthetic_dem, stats=['min', 'max'])
+    assert (cache.hits, cache.misses) == (0, 50)
+    results = cache.zonal_statistics(features, synthetic_dem, stats=['max'])
+    assert (cache.hits, cache.misses) == (50, 0)
+
+    # a different all_touched setting is a different key
+    cache.zonal_statistics(features, synthetic_dem, stats=stats, all_touched=True)
+    assert (cache.hits, cache.misses) == (0, 50)
@@ -1,8 +1,56 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyproj
+import pytest
 from flopy.discretization import StructuredGrid
-from sfrmaker.fileio import load_modelgrid
+from shapely.geometry import LineString
+from sfrmaker.fileio import (load_modelgrid, is_columnar_file, read_features,
+                             read_table, write_table)
 
 
 def test_load_grid():
     gridfile = 'sfrmaker/test/data/shellmound/shellmound/shellmound_grid.json'
     modelgrid = load_modelgrid(gridfile)
-    assert isinstance(modelgrid, StructuredGrid)
\ No newline at end of file
+    assert isinstance(modelgrid, StructuredGrid)
+
+@pytest.mark.parametrize('extension', ['.parquet', '.feather', '.csv'])
+def test_write_read_table(tmpdir, extension):
+    if extension != '.csv':
+        pytest.importorskip('pyarrow')
+    df = pd.DataFrame({'id': np.arange(5, dtype=np.int32),
+                       'toid': [2, 3, 4, 0, 0],
+                       'name': list('abcde'),
+                       'asum': np.arange(5) * 1.5,
+                       'geometry': [LineString([(i, i), (i + 1, i + 2)]) for i in range(4)] + [None]})
+    if extension == '.csv':
+        df.drop('geometry', axis=1, inplace=True)
+    filename = os.path.join(tmpdir, 'lines{}'.format(extension))
+    write_table(df, filename, crs=5070)
+    assert is_columnar_file(filename) == (extension != '.csv')
+    results = read_table(filename)
+    pd.testing.assert_frame_equal(results.drop('geometry', axis=1, errors='ignore'),
+                                  df.drop('geometry', axis=1, errors='ignore'),
+                                  check_dtype=extension != '.csv')
+    if extension != '.csv':
+        # types and geometries are preserved in the columnar formats
+        assert results.id.dtype == np.int32
+        assert results.geometry[4] is None
+        assert all(g1.equals(g2) for g1, g2 in zip(results.geometry[:4], df.geometry[:4]))
+        assert results.attrs['crs'] == pyproj.CRS.from_epsg(5070)
+        features = read_features(filename, filter=(0, 0, 1.5, 1.5))
+        assert features.id.tolist() == [0, 1]
+
+        # an unknown crs is written as null (not omitted)
+        write_table(df, filename)
+        if extension == '.parquet':
+            import pyarrow.parquet
+            metadata = pyarrow.parquet.read_schema(filename).metadata
+        else:
+            import pyarrow.feather
+            metadata = pyarrow.feather.read_table(filename).schema.metadata
+        geo = json.loads(metadata[b'geo'])
+        assert 'crs' in geo['columns']['geometry']
+        assert geo['columns']['geometry']['crs'] is None
+        assert read_table(filename).attrs['crs'] is None
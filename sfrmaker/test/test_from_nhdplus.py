@@ -33,6 +33,31 @@ def test_sample_elevations(dem, tylerforks_sfrdata, datapath, method):
     assert reach_elevations_decrease_downstream(sfr.reach_data)
 
 
+@pytest.mark.parametrize('method', ['cell polygons', 'buffers'])
+def test_sample_elevations_native_engine(dem, tylerforks_sfrdata, method):
+    sfr = tylerforks_sfrdata
+    results = {}
+    for engine in 'rasterstats', 'native':
+        sampled_elevs = sfr.sample_reach_elevations(dem, method=method,
+                                                    smooth=False, engine=engine)
+        results[engine] = np.array([sampled_elevs[rno] for rno in sfr.reach_data['rno']])
+    assert np.allclose(results['native'], results['rasterstats'])
+    with pytest.raises(ValueError):
+        sfr.sample_reach_elevations(dem, method=method, engine='gdal')
+
+
+def test_sample_elevations_grid_engine(dem, tylerforks_sfrdata):
+    sfr = tylerforks_sfrdata
+    results = {}
+    for engine in 'native', 'grid':
+        sampled_elevs = sfr.sample_reach_elevations(dem, method='cell polygons',
+                                                    smooth=False, engine=engine)
+        results[engine] = np.array([sampled_elevs[rno] for rno in sfr.reach_data['rno']])
+    assert np.allclose(results['grid'], results['native'])
+    with pytest.raises(ValueError):
+        sfr.sample_reach_elevations(dem, method='buffers', engine='grid')
+
+
 def test_output_dir(tylerforks_model, outdir):
     assert tylerforks_model.model_ws == os.path.join(outdir, 'tylerforks')
 
@@ -1,8 +1,10 @@
 import os
 import numpy as np
 import pytest
+from shapely.geometry import box
 from gisutils import get_authority_crs
-from sfrmaker.gis import get_bbox
+from sfrmaker.gis import (get_bbox, intersect, intersect_rtree, intersect_strtree,
+                          clip_lines_to_polygon)
 
 
 def test_get_bbox(project_root_path):
@@ -12,14 +14,56 @@ def test_get_bbox(project_root_path):
     assert np.allclose(bbox, (-90.62442575352304, 46.37890212020774, -90.46249896050521, 46.458360301848685))
 
 
-@pytest.mark.skip(reason='still working on faster intersection method')
-@pytest.fixture(scope='module')
+@pytest.fixture(scope='function')
 def intersected(tylerforks_sfrmaker_grid_from_flopy, tylerforks_lines_from_NHDPlus):
-    #results = intersect()
-    pass
+    grid = tylerforks_sfrmaker_grid_from_flopy
+    lines = tylerforks_lines_from_NHDPlus
+    if lines.crs != grid.crs:
+        lines.to_crs(grid.crs)
+    grid_polygons = grid.df.geometry.tolist()
+    stream_linework = lines.df.geometry.tolist()
+    results = intersect_rtree(grid_polygons, stream_linework)
+    return grid_polygons, stream_linework, results
 
 
-@pytest.mark.skip(reason='still working on faster intersection method')
-def test_intersect():
-    from rtree import index
-    pass
\ No newline at end of file
+def test_intersect(intersected):
+    grid_polygons, stream_linework, results = intersected
+    # brute-force intersection of a subset of lines
+    # should produce the same results as the rtree intersection
+    results2 = intersect(grid_polygons, stream_linework[:5])
+    assert [sorted(r) for r in results2] == [sorted(r) for r in results[:5]]
+
+
+def test_intersect_strtree(intersected):
+    grid_polygons, stream_linework, results = intersected
+    results2 = intersect_strtree(grid_polygons, stream_linework)
+    assert len(results2) == len(stream_linework)
+    assert results2 == [sorted(r) for r in results]
+    # no features to intersect
+    assert intersect_strtree(grid_polygons, []) == []
+
+
+def test_clip_lines_to_polygon(intersected):
+    grid_polygons, stream_linework, results = intersected
+    # clip to the middle of the grid,
+    # so that there are lines inside, outside and crossing the boundary
+    x1, y1, x2, y2 = np.array([g.bounds for g in grid_polygons]).T
+    xmin, ymin, xmax, ymax = x1.min(), y1.min(), x2.max(), y2.max()
+    dx, dy = (xmax - xmin) / 4, (ymax - ymin) / 4
+    polygon = box(xmin + dx, ymin + dy, xmax - dx, ymax - dy)
+    keep, clipped = clip_lines_to_polygon(stream_linework, polygon)
+
+    # results should be the same as intersecting each line
+    expected = [g.intersection(polygon) for g in stream_linework]
+    expected_keep = np.array([not g.is_empty for g in expected])
+    assert 0 < expected_keep.sum() < len(stream_linework)
+    assert np.array_equal(keep, expected_keep)
+    expected = [g for g in expected if not g.is_empty]
+    assert len(clipped) == len(expected)
+    assert all([g.equals(g2) for g, g2 in zip(clipped, expected)])
+
+    # use a larger polygon to select the lines
+    keep2, clipped2 = clip_lines_to_polygon(stream_linework, polygon,
+                                            intersects_polygon=polygon.buffer(2000))
+    assert np.array_equal(keep2, keep)
+    assert all([g.equals(g2) for g, g2 in zip(clipped2, clipped)])
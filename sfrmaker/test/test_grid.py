@@ -1,11 +1,17 @@
 # TODO: add unit tests for grid.py
+import os
+import numpy as np
+import pandas as pd
+import rasterio
 from rasterio import Affine
+from shapely.geometry import Polygon
 
 import flopy
 import pytest
 import sfrmaker
 
 fm = flopy.modflow
+from ..elevations import grid_statistics, zonal_statistics
 from ..gis import get_authority_crs
 from ..grid import StructuredGrid
 from ..units import convert_length_units
@@ -74,4 +80,90 @@ def test_unstructuredgrid_from_shapfile(tyler_forks_grid_shapefile,
                                         tylerforks_sfrmaker_grid_from_flopy):
     # TODO: test creating unstructured grid from same shapefile
     # with no row or column information passed
-    pass
\ No newline at end of file
+    pass
+
+@pytest.mark.parametrize('angrot', (0., 15.))
+def test_structuredgrid_lazy_geometry(tylerforks_model_grid, tylerforks_active_area_shapefile,
+                                      angrot):
+    mg = tylerforks_model_grid
+    mg.set_coord_info(xoff=mg.xoffset, yoff=mg.yoffset, angrot=angrot)
+    grid = StructuredGrid.from_modelgrid(mg, active_area=tylerforks_active_area_shapefile)
+    # cell polygons are only created on demand
+    assert grid._lazy_geometry
+    assert 'geometry' not in grid._df.columns
+
+    # same grid, with a Polygon for each cell
+    i, j = np.indices((mg.nrow, mg.ncol))
+    polygons = [Polygon(v) for v in mg._cell_vert_list(i.ravel(), j.ravel())]
+    df = pd.DataFrame({'node': np.arange(mg.nrow * mg.ncol),
+                       'i': i.ravel(), 'j': j.ravel(), 'geometry': polygons})
+    grid2 = StructuredGrid.from_dataframe(df, active_area=tylerforks_active_area_shapefile,
+                                          crs=grid.crs)
+    assert np.allclose(grid._get_bounds(), grid2._get_bounds())
+    assert grid.uniform == grid2.uniform
+    assert np.array_equal(grid.isfr, grid2.isfr)
+    assert grid.isfr.sum() < grid.size
+    nodes = [0, 10, mg.ncol + 1, grid.size - 1]
+    for g1, g2 in zip(grid.get_cell_polygons(nodes), grid2.get_cell_polygons(nodes)):
+        assert g1.equals(g2)
+    assert 'geometry' not in grid._df.columns
+
+    # geometry column is created when the DataFrame is accessed
+    assert grid.df.geometry.tolist()[-1].equals(polygons[-1])
+    assert 'geometry' in grid._df.columns
+
+
+@pytest.mark.parametrize('rotation, xoffset', [(0., 0.),  # grid aligned with the raster
+                                               (0., 3.3),
+                                               (15., 0.)])
+def test_get_raster_statistics(tmpdir, rotation, xoffset):
+    # synthetic DEM with 10 m pixels
+    rng = np.random.RandomState(0)
+    data = (rng.random_sample((120, 170)) * 100).astype('float32')
+    data[10:20, 10:30] = -9999
+    dem = os.path.join(tmpdir, 'dem.tif')
+    with rasterio.open(dem, 'w', driver='GTiff', height=data.shape[0],
+                       width=data.shape[1], count=1, dtype=data.dtype,
+                       transform=Affine(10., 0., 950., 0., -10., 5050.),
+                       nodata=-9999) as dst:
+        dst.write(data, 1)
+
+    # 20 x 30 grid of 50 m cells
+    nrow, ncol = 20, 30
+    xul, yul = 1000. + xoffset, 5000.
+    delr, delc = np.ones(ncol) * 50., np.ones(nrow) * 50.
+    x, y = np.meshgrid(np.append(0., np.cumsum(delr)), np.append(0., np.cumsum(delc)))
+    theta = np.radians(rotation)
+    xvertices = xul + x * np.cos(theta) + y * np.sin(theta)
+    yvertices = yul + x * np.sin(theta) - y * np.cos(theta)
+    i, j = np.indices((nrow, ncol))
+    df = pd.DataFrame({'node': np.arange(nrow * ncol), 'k': 0,
+                       'i': i.ravel(), 'j': j.ravel(), 'isfr': 1})
+    grid = StructuredGrid(df, xul=xul, yul=yul, rotation=rotation,
+                          delr=delr, delc=delc,
+                          xvertices=xvertices, yvertices=yvertices)
+    results = grid.get_raster_statistics(dem, stat='min')
+    assert results.shape == (nrow, ncol)
+    expected = zonal_statistics(grid.get_cell_polygons(), dem, stats='min')
+    expected = np.array([np.nan if r['min'] is None else r['min']
+                         for r in expected]).reshape(nrow, ncol)
+    assert np.allclose(results, expected, equal_nan=True)
+    assert not np.all(np.isnan(results))
+    # array is cached on the grid
+    assert grid.get_raster_statistics(dem, stat='min') is results
+    # unless the raster is modified
+    with rasterio.open(dem, 'r+') as dst:
+        dst.write(np.where(data == -9999, data, data + 1), 1)
+    mtime = os.stat(dem).st_mtime_ns + 10**9
+    os.utime(dem, ns=(mtime, mtime))
+    modified = grid.get_raster_statistics(dem, stat='min')
+    assert modified is not results
+    assert np.allclose(modified, results + 1, equal_nan=True)
+
+    # statistics combined from small blocks of the raster
+    # should be the same as from the whole raster at once
+    stats = ['min', 'max', 'mean', 'std', 'sum', 'count', 'median']
+    expected = grid_statistics(dem, grid, stats)
+    results = grid_statistics(dem, grid, stats, block_size=5)
+    for stat in stats:
+        assert np.allclose(results[stat], expected[stat], equal_nan=True)
@@ -1,3 +1,4 @@
+import copy
 import pytest
 import sfrmaker
 from sfrmaker.checks import is_to_one
@@ -53,3 +54,29 @@ def test_write_shapefile(tylerforks_lines_from_NHDPlus, test_data_path):
     outshp = test_data_path / 'lines.shp'
     lines.write_shapefile(outshp)
     assert outshp.exists()
+
+
+@pytest.mark.parametrize('engine', ('rtree', 'strtree', 'structured'))
+def test_intersect_engines(tylerforks_lines_from_NHDPlus,
+                           tylerforks_sfrmaker_grid_from_flopy, engine):
+    lines = tylerforks_lines_from_NHDPlus
+    grid = tylerforks_sfrmaker_grid_from_flopy
+    rd = lines.intersect(grid, engine=engine)
+    rd2 = lines.intersect(grid, engine='simple')
+    cols = ['node', 'rno', 'ireach', 'iseg', 'line_id']
+    assert rd[cols].equals(rd2[cols])
+
+
+def test_routing_change_detection(lines_from_shapefile):
+    lines = copy.deepcopy(lines_from_shapefile)
+    routing = lines.routing
+    paths = lines.paths
+    # unchanged routing is reused
+    assert lines.routing is routing
+    assert lines.paths is paths
+    # edits to the toid column are detected
+    id = lines.df.id.values[0]
+    lines.df.loc[lines.df.id == id, 'toid'] = 0
+    assert lines.routing is not routing
+    assert lines.routing[id] == 0
+    assert lines.paths[id] == [id, 0]
@@ -3,10 +3,12 @@ import copy
 import filecmp
 import os
 import platform
+import time
 import numpy as np
 import pandas as pd
 import pytest
 import sfrmaker
+from sfrmaker.mf5to6 import Mf6SFR, connectiondata_to_text, segment_data_to_period_data
 
 
 @pytest.fixture(scope='function')
@@ -68,6 +70,82 @@ def test_connectiondata(mf6sfr_instance_SFRdata, outdir):
     mf6sfr.write_file(filename=outfile)
 
 
+def test_connection_arrays(mf6sfr_instance_SFRdata):
+    mf6sfr = mf6sfr_instance_SFRdata
+    rd = mf6sfr.rd
+    offsets, values = mf6sfr.connection_arrays
+    assert len(offsets) == mf6sfr.nreaches + 1
+    for rno, outreach in zip(rd.rno, rd.outreach):
+        connections = values[offsets[rno - 1]:offsets[rno]].tolist()
+        expected = [-outreach] if outreach != 0 else []
+        expected += rd.loc[rd.outreach == rno, 'rno'].tolist()
+        assert connections == expected
+        assert mf6sfr.connections[rno] == expected
+        assert mf6sfr.graph_r.get(rno, []) == expected[1 if outreach != 0 else 0:]
+    assert np.array_equal(mf6sfr.packagedata.ncon, np.diff(offsets)[rd.rno - 1])
+    text = connectiondata_to_text(offsets, values)
+    expected = ''.join('  {} {}\n'.format(rno, ' '.join(map(str, c)))
+                       for rno, c in mf6sfr.connections.items())
+    assert text == expected
+
+
+def test_connection_arrays_cached(mf6sfr_instance_SFRdata, outdir, monkeypatch):
+    mf6sfr = copy.copy(mf6sfr_instance_SFRdata)
+    # setting the graph resets the connections
+    mf6sfr.graph = dict(mf6sfr.graph)
+    mf6sfr._package_data = None
+    calls = []
+    get_connection_arrays = mf6sfr._get_connection_arrays
+
+    def counted_get_connection_arrays():
+        calls.append(1)
+        return get_connection_arrays()
+    monkeypatch.setattr(mf6sfr, '_get_connection_arrays', counted_get_connection_arrays)
+    # connection arrays are only computed once for the packagedata and connectiondata
+    mf6sfr.write_file(filename=os.path.join(outdir, 'junk.sfr'))
+    assert len(calls) == 1
+
+
+@pytest.mark.slow
+def test_connection_arrays_benchmark():
+    """Scaling of the connection data with the number of reaches."""
+    for nreaches in 10**4, 10**5, 10**6:
+        rno = np.arange(1, nreaches + 1)
+        outreach = np.append(rno[1:], 0)
+        # every 10th reach is a tributary to the reach 2 downstream
+        outreach[::10] = np.minimum(rno[::10] + 2, nreaches)
+        outreach[-1] = 0
+        mf6sfr = Mf6SFR.__new__(Mf6SFR)
+        mf6sfr.rd = pd.DataFrame({'rno': rno, 'outreach': outreach})
+        mf6sfr.nreaches = nreaches
+        mf6sfr.graph = dict(zip(rno, outreach))
+        mf6sfr._connections = None
+        mf6sfr._connection_arrays = None
+        mf6sfr._graph_r = None
+        ta = time.time()
+        offsets, values = mf6sfr.connection_arrays
+        t_arrays = time.time() - ta
+        ta = time.time()
+        text = connectiondata_to_text(offsets, values)
+        t_text = time.time() - ta
+        assert len(text.split('\n')) == nreaches + 1
+        print('{} reaches: connection arrays {:.2f}s, connectiondata text {:.2f}s'.format(
+            nreaches, t_arrays, t_text))
+
+
+def test_write_empty_period_data(mf6sfr_instance_SFRdata, outdir):
+    """Packages without transient data (steady-state models)
+    should be written without any period blocks."""
+    mf6sfr = copy.copy(mf6sfr_instance_SFRdata)
+    mf6sfr._period_data = pd.DataFrame()
+    outfile = os.path.join(outdir, 'junk_no_period_data.sfr')
+    mf6sfr.write_file(filename=outfile)
+    with open(outfile) as src:
+        text = src.read().lower()
+    assert 'end connectiondata' in text
+    assert 'begin period' not in text
+
+
 def test_packagedata_aux(mf6sfr_instance_SFRdata):
     mf6sfr = mf6sfr_instance_SFRdata
     packagedata = mf6sfr._get_packagedata()
@@ -85,6 +163,85 @@ def test_segment_data_to_perioddata(shellmound_sfrdata):
             'ireach', 'icalc', 'per'}
 
 
+def synthetic_segment_data(nseg, nper, seed=0):
+    """Reach data and transient segment data for nseg segments
+    of 1-5 reaches each, over nper stress periods."""
+    rng = np.random.default_rng(seed)
+    nreach = rng.integers(1, 6, nseg)
+    iseg = np.repeat(np.arange(1, nseg + 1), nreach)
+    reach_data = pd.DataFrame({'rno': np.arange(1, len(iseg) + 1),
+                               'iseg': iseg,
+                               'ireach': np.concatenate([np.arange(1, n + 1) for n in nreach]),
+                               'rchlen': rng.uniform(1, 500, len(iseg)),
+                               'strtop': rng.uniform(0, 100, len(iseg))})
+    segment_data = pd.DataFrame({'per': np.repeat(np.arange(nper), nseg),
+                                 'nseg': np.tile(np.arange(1, nseg + 1), nper),
+                                 'icalc': np.tile(rng.integers(0, 2, nseg), nper),
+                                 'roughch': 0.037})
+    for c in 'flow', 'runoff', 'pptsw', 'depth1', 'depth2':
+        segment_data[c] = rng.uniform(1, 10, len(segment_data))
+    return segment_data, reach_data
+
+
+def test_segment_data_to_perioddata_distribution():
+    segment_data, reach_data = synthetic_segment_data(20, 3)
+    results = segment_data_to_period_data(segment_data, reach_data)
+    assert set(results.per) == {0, 1, 2}
+    # icalc=0 reaches without any other values are added to period 0,
+    # with stages from strtop
+    strtop = dict(zip(reach_data.rno, reach_data.strtop))
+    added = results.inflow.isna()
+    assert np.all(results.loc[added, 'per'] == 0)
+    assert np.all(results.loc[added, 'icalc'] == 0)
+    assert np.allclose(results.loc[added, 'stage'], [strtop[rno] for rno in results.loc[added, 'rno']])
+    # inflows are only assigned to reach 1,
+    # which also drops the other reaches (they have no inflow values)
+    perdata = results.loc[~added]
+    assert np.all(perdata.ireach == 1)
+    # one entry for each segment and period
+    assert len(perdata) == len(segment_data)
+    sd = segment_data.set_index(['per', 'nseg'])
+    keys = list(zip(perdata.per, perdata.iseg))
+    assert np.allclose(perdata.inflow, sd.loc[keys, 'flow'])
+    assert np.allclose(perdata.rainfall, sd.loc[keys, 'pptsw'])
+    # runoff is distributed by reach length fraction
+    seglen = reach_data.groupby('iseg').rchlen.sum()
+    rchlen = dict(zip(reach_data.rno, reach_data.rchlen))
+    lenfrac = [rchlen[rno] / seglen[s] for rno, s in zip(perdata.rno, perdata.iseg)]
+    assert np.allclose(perdata.runoff, sd.loc[keys, 'runoff'] * lenfrac)
+    # stages for icalc=0 segments
+    simple = perdata.icalc.values < 1
+    assert np.all(perdata.status.values[simple] == 'SIMPLE')
+    assert np.all(perdata.status.values[~simple] == 'ACTIVE')
+    single_reach = reach_data.groupby('iseg').rno.count() == 1
+    for (i, r), key in zip(perdata.loc[simple].iterrows(), np.array(keys, dtype=object)[simple]):
+        # depth1 at the first reach, except for single reach segments
+        if single_reach[r.iseg]:
+            assert np.allclose(r.stage, strtop[r.rno] + sd.loc[tuple(key), 'depth2'])
+        else:
+            assert np.allclose(r.stage, strtop[r.rno] + sd.loc[tuple(key), 'depth1'])
+
+    # without inflows, values are distributed to all reaches
+    perdata = segment_data_to_period_data(segment_data.drop('flow', axis=1), reach_data)
+    assert len(perdata) == len(reach_data) * 3
+    for per, group in perdata.groupby('per'):
+        group_sd = segment_data.loc[segment_data.per == per].set_index('nseg')
+        assert np.allclose(group.groupby('iseg').runoff.sum(),
+                           group_sd.loc[group.iseg.unique(), 'runoff'])
+
+
+@pytest.mark.slow
+def test_segment_data_to_perioddata_benchmark():
+    """Scaling of segment_data_to_period_data with the number of stress periods."""
+    for nper in 10, 100, 1000:
+        segment_data, reach_data = synthetic_segment_data(2000, nper)
+        ta = time.time()
+        perdata = segment_data_to_period_data(segment_data.drop('flow', axis=1), reach_data)
+        assert len(perdata) == len(reach_data) * nper
+        print('{} segments, {} periods ({} reach entries): {:.2f}s'.format(
+            len(segment_data.nseg.unique()), nper, len(perdata), time.time() - ta))
+
+
 def test_idomain(mf6sfr_instance_ModflowSfr2, shellmound_model):
     ibound = mf6sfr_instance_ModflowSfr2.idomain
     idomain = shellmound_model.dis.idomain.array
@@ -127,3 +284,50 @@ def test_write(shellmound_sfrdata, mf6sfr_instance_SFRdata, outdir, external_fil
             assert os.path.exists(os.path.join(os.path.split(outfile2)[0],
                                             external_files_path,
                                             '{}_packagedata.dat'.format(version)))
+
+
+@pytest.mark.parametrize('external_period_data', (None, 'period', 'variable'))
+@pytest.mark.parametrize('skip_unchanged_periods', (False, True))
+def test_write_period_data(mf6sfr_instance_SFRdata, outdir,
+                           external_period_data, skip_unchanged_periods):
+    mf6sfr = mf6sfr_instance_SFRdata
+    rno = mf6sfr.rd.rno.values[:5]
+    period_data = pd.DataFrame({'per': np.repeat([0, 1, 2], 5),
+                                'rno': np.tile(rno, 3),
+                                'status': 'ACTIVE',
+                                'inflow': [100., np.nan, np.nan, np.nan, np.nan] * 3,
+                                'runoff': np.r_[[10.] * 10, [20.] * 5]})
+    period_data.index = period_data.rno
+    mf6sfr._period_data = period_data
+    outfile = os.path.join(outdir, 'periods.sfr')
+    mf6sfr.write_file(filename=outfile, external_period_data=external_period_data,
+                      skip_unchanged_periods=skip_unchanged_periods)
+
+    # read the period data back in, including any external files
+    with open(outfile) as src:
+        text = src.read()
+    blocks = {}
+    for block in text.split('BEGIN Period ')[1:]:
+        per = int(block.split()[0]) - 1
+        lines = block.split('\n')[1:block.split('\n').index('END Period {}'.format(per + 1))]
+        entries = []
+        for line in lines:
+            if line.strip().startswith('open/close'):
+                assert external_period_data is not None
+                with open(os.path.join(outdir, line.split()[1])) as src:
+                    entries += src.read().strip().split('\n')
+            else:
+                entries.append(line)
+        blocks[per] = entries
+    if skip_unchanged_periods:
+        assert set(blocks.keys()) == {0, 2}
+    else:
+        assert set(blocks.keys()) == {0, 1, 2}
+    for per, entries in blocks.items():
+        expected = period_data.loc[period_data.per == per]
+        assert len(entries) == expected[['inflow', 'runoff']].count().sum()
+        assert '{} inflow 100.0'.format(rno[0]) in entries
+        runoff = [float(line.split()[2]) for line in entries if 'runoff' in line]
+        assert np.allclose(runoff, expected.runoff)
+    with pytest.raises(ValueError):
+        mf6sfr.write_file(filename=outfile, external_period_data='junk')
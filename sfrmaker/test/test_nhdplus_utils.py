@@ -1 +1,55 @@
 # TODO: add unit tests for test_nhdplus_utils.py
+import os
+import numpy as np
+import pandas as pd
+from gisutils import shp2df
+from sfrmaker.nhdplus_utils import (read_nhdplus_table, get_tocomids,
+                                    find_next_comid, find_next_comids)
+
+
+def test_read_nhdplus_table(datapath):
+    attributes_path = os.path.join(datapath, 'tylerforks/NHDPlus/NHDPlusAttributes')
+    pfvaa_file = os.path.join(attributes_path, 'PlusFlowlineVAA.dbf')
+    pf_file = os.path.join(attributes_path, 'PlusFlow.dbf')
+    pfvaa = shp2df(pfvaa_file)
+    comids = pfvaa.ComID.values[::3]
+
+    results = read_nhdplus_table(pfvaa_file, comids, columns=['arbolatesu', 'StreamOrde'],
+                                 index_col='comid')
+    expected = pfvaa.loc[pfvaa.ComID.isin(comids)]
+    assert list(results.columns) == ['ArbolateSu', 'StreamOrde', 'ComID']
+    assert np.array_equal(results.index.values, expected.ComID.values)
+    assert np.allclose(results.ArbolateSu.values, expected.ArbolateSu.values)
+
+    # rows for PlusFlow connections to or from the comids
+    pf = shp2df(pf_file)
+    results = read_nhdplus_table([pf_file], comids, columns=['FROMCOMID', 'TOCOMID'],
+                                 comid_columns=['FROMCOMID', 'TOCOMID'])
+    expected = pf.loc[pf.FROMCOMID.isin(comids) | pf.TOCOMID.isin(comids)]
+    assert np.array_equal(results.FROMCOMID.values, expected.FROMCOMID.values)
+    assert np.array_equal(results.TOCOMID.values, expected.TOCOMID.values)
+
+    # all columns and rows
+    results = read_nhdplus_table(pf_file)
+    assert len(results) == len(pf)
+    assert set(pf.columns).difference(results.columns).issubset({'geometry'})
+
+
+def test_get_tocomids():
+    # 1 -> 2 -> 3 -> 4 -> 5, with a divergence from 2 to 6 -> 5
+    # and 7 -> 8 -> 9 (outlet)
+    pf = pd.DataFrame({'FROMCOMID': [1, 2, 2, 3, 4, 6, 7, 8, 5, 9],
+                       'TOCOMID': [2, 3, 6, 4, 5, 5, 8, 9, 0, 0]})
+    comids = [1, 2, 5, 7, 10]
+    # 6 is missing, and routed to 5;
+    # 3 and 8 are missing, without any downstream links in the culled table
+    tocomids = get_tocomids(pf, comids)
+    assert tocomids == [[2], [0, 5], [0], [0], []]
+
+    # crawl the full PlusFlow table for the next comid in comids
+    nextcomids = find_next_comids([3, 6, 8, 1, 11], pf, comids)
+    assert nextcomids.tolist() == [5, 5, 0, 2, 0]
+    assert find_next_comid(3, pf, comids) == 5
+    assert find_next_comid(3, pf, comids, max_levels=1) == 0
+    # multiple downstream comids in comids; the lowest one is taken
+    assert find_next_comid(1, pf, [3, 6]) == 3
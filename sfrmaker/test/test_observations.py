@@ -175,6 +175,40 @@ def test_get_closest_reach(shellmound_sfrdata, x, y, expected, outdir):
     assert 0 < dist < shellmound_sfrdata.grid.dx
 
 
+@pytest.mark.parametrize('k', (1, 3))
+@pytest.mark.parametrize('threshold', (None, 500))
+def test_get_closest_reach_batch(shellmound_sfrdata, k, threshold):
+    sfrlines = shellmound_sfrdata.reach_data
+    xmin, ymin, xmax, ymax = shellmound_sfrdata.grid.bounds
+    x = np.linspace(xmin, xmax, 50)
+    y = np.linspace(ymin, ymax, 50)
+    rno, dist = get_closest_reach(x, y, sfrlines, rno_column='rno',
+                                  threshold=threshold, k=k)
+    assert len(rno) == len(dist) == len(x)
+    positions = dict(zip(sfrlines.rno, range(len(sfrlines))))
+    # compare to the distances to all reaches
+    for i, (xi, yi) in enumerate(zip(x, y)):
+        distances = np.array([g.distance(Point(xi, yi)) for g in sfrlines.geometry])
+        expected = np.sort(distances)[:k]
+        if threshold is not None:
+            expected = expected[expected <= threshold]
+        if k == 1:
+            if len(expected) == 0:
+                assert rno[i] is None
+                assert np.isnan(dist[i])
+                continue
+            returned_rno, returned_dist = [rno[i]], [dist[i]]
+        else:
+            returned_rno, returned_dist = rno[i], dist[i]
+        assert np.allclose(returned_dist, expected)
+        assert np.allclose([distances[positions[r]] for r in returned_rno], expected)
+
+    # no locations
+    rno, dist = get_closest_reach([], [], sfrlines, rno_column='rno',
+                                  threshold=threshold, k=k)
+    assert rno == dist == []
+
+
 def test_locate_sites(shellmound_sfrdata, outdir):
 
     X, Y, rno = zip(*((515459.9, 1189906.1, 202),
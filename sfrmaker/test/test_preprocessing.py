@@ -3,14 +3,23 @@ Test the preprocessing module
 """
 import os
 from pathlib import Path
+import shutil
+import time
 import yaml
 import numpy as np
 import pandas as pd
-from shapely.geometry import box
+from shapely.geometry import box, MultiLineString
 import pytest
-from gisutils import df2shp, shp2df
+import sfrmaker.preprocessing
+from gisutils import df2shp, shp2df, project, get_shapefile_crs
 from sfrmaker.checks import check_monotonicity
 from sfrmaker.preprocessing import cull_flowlines, preprocess_nhdplus, clip_flowlines_to_polygon, edit_flowlines
+from sfrmaker.preprocessing import fix_invalid_asums, recompute_asums_for_minor_distribs
+from sfrmaker.preprocessing import get_narwidth_statistics
+from sfrmaker.gis import intersect_rtree
+from sfrmaker.logger import Logger
+from sfrmaker.nhdplus_utils import read_nhdplus_table
+from sfrmaker.routing import make_graph
 
 
 @pytest.fixture(scope='module')
@@ -131,6 +140,91 @@ def test_cull_flowlines(clipped_flowlines, culled_flowlines, test_data_path,
     assert results != culled_flowlines
 
 
+def test_cull_flowlines_parallel(clipped_flowlines, test_data_path, outfolder):
+    nhdpaths = [os.path.join(test_data_path, 'NHDPlus08')]
+    results = cull_flowlines(nhdpaths,
+                             asum_thresh=None, intermittent_streams_asum_thresh=None,
+                             cull_invalid=False, cull_isolated=False,
+                             active_area=os.path.join(outfolder, 'active_area.shp'),
+                             outfolder=os.path.join(outfolder, 'parallel'),
+                             n_workers=2, memory_limit=1e9)
+    for key, filename in results.items():
+        df = shp2df(filename)
+        expected = shp2df(clipped_flowlines[key])
+        cols = [c for c in expected.columns if c != 'geometry']
+        pd.testing.assert_frame_equal(df[cols], expected[cols])
+        if 'geometry' in expected.columns:
+            assert all([g1.equals(g2) for g1, g2 in zip(df.geometry, expected.geometry)])
+
+
+@pytest.fixture(scope='module')
+def two_region_nhdplus(test_data_path, outfolder):
+    """Shellmound NHDPlus data split into two drainage basins (regions),
+    with routing connections between them."""
+    nhdpath = os.path.join(test_data_path, 'NHDPlus08')
+    flowlines_file = os.path.join(nhdpath, 'NHDSnapshot/Hydrography/NHDFlowline.shp')
+    fl = shp2df(flowlines_file)
+    x = np.array([g.centroid.x for g in fl.geometry])
+    west = set(fl.loc[x < np.median(x), 'COMID'])
+    tables = {'PlusFlowlineVAA.dbf': 'comid',
+              'PlusFlow.dbf': 'fromcomid',
+              'elevslope.dbf': 'comid'}
+    nhdpaths = []
+    for region, in_west in ('NHDPlusWest', True), ('NHDPlusEast', False):
+        path = os.path.join(outfolder, region)
+        os.makedirs(os.path.join(path, 'NHDSnapshot/Hydrography'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'NHDPlusAttributes'), exist_ok=True)
+        out_flowlines = os.path.join(path, 'NHDSnapshot/Hydrography/NHDFlowline.shp')
+        df2shp(fl.loc[fl.COMID.isin(west) == in_west], out_flowlines, crs=4269)
+        shutil.copy(flowlines_file[:-4] + '.prj', out_flowlines[:-4] + '.prj')
+        for table, comid_column in tables.items():
+            df = read_nhdplus_table(os.path.join(nhdpath, 'NHDPlusAttributes', table))
+            comid_column = [c for c in df.columns if c.lower() == comid_column][0]
+            df2shp(df.loc[df[comid_column].isin(west) == in_west],
+                   os.path.join(path, 'NHDPlusAttributes', table))
+        nhdpaths.append(path)
+    return nhdpaths, west
+
+
+def test_cull_flowlines_parallel_regions(two_region_nhdplus, clipped_flowlines,
+                                         outfolder, active_area, monkeypatch):
+    nhdpaths, west = two_region_nhdplus
+    kwargs = dict(asum_thresh=None, intermittent_streams_asum_thresh=None,
+                  cull_invalid=False, cull_isolated=False,
+                  active_area=active_area)
+    serial = cull_flowlines(nhdpaths, outfolder=os.path.join(outfolder, 'regions_serial'),
+                            **kwargs)
+
+    # record the number of files being read each time the reads are waited on
+    n_reading = []
+    wait = sfrmaker.preprocessing.wait
+
+    def counted_wait(fs, **kwargs):
+        n_reading.append(len(fs))
+        return wait(fs, **kwargs)
+    monkeypatch.setattr(sfrmaker.preprocessing, 'wait', counted_wait)
+    # memory limit smaller than any one file,
+    # so that only one file is read at a time
+    results = cull_flowlines(nhdpaths, outfolder=os.path.join(outfolder, 'regions_parallel'),
+                             n_workers=2, memory_limit=1, **kwargs)
+    assert len(n_reading) > 0
+    assert set(n_reading) == {1}
+    for key, filename in results.items():
+        df = shp2df(filename)
+        expected = shp2df(serial[key])
+        cols = [c for c in expected.columns if c != 'geometry']
+        pd.testing.assert_frame_equal(df[cols], expected[cols])
+
+    # routing connections between the regions are retained,
+    # and are the same as with the data in a single region
+    pf = shp2df(results['pf_file'])
+    in_west = pf.FROMCOMID.isin(west)
+    crosses_regions = in_west != pf.TOCOMID.isin(west)
+    assert np.any(crosses_regions & (pf.TOCOMID != 0))
+    expected = shp2df(clipped_flowlines['pf_file'])
+    assert set(zip(pf.FROMCOMID, pf.TOCOMID)) == set(zip(expected.FROMCOMID, expected.TOCOMID))
+
+
 def test_preprocess_nhdplus(preprocessed_flowlines):
     fl = preprocessed_flowlines
 
@@ -233,4 +327,81 @@ def test_edit_flowlines(flowlines, preprocessed_flowlines, test_data_path):
     add_flowlines = shp2df(os.path.join(test_data_path, 'yazoo.shp'))
     assert not any(set(add_flowlines.comid).difference(edited_flowlines.index))
     if isinstance(flowlines, str):
-        assert os.path.exists(flowlines[:-4] + '.prj')
\ No newline at end of file
+        assert os.path.exists(flowlines[:-4] + '.prj')
+
+def test_fix_invalid_asums():
+    #  1   2
+    #   \ /
+    #    3   5
+    #     \ /
+    #      4
+    graph = {1: 3, 2: 3, 3: 4, 5: 4, 4: 0}
+    graph_r = make_graph(list(graph.values()), list(graph.keys()))
+    fl_lengths = {1: 1., 2: 1., 3: 1., 4: 1., 5: 1.}
+    # break in asum continuity at 3 and 5
+    asums = {4: 5.5, 3: 1.5, 2: 1., 1: 1., 5: 0.5}
+    results = fix_invalid_asums(asums, fl_lengths, graph, graph_r)
+    assert results == {1: 1., 2: 1., 3: 2., 4: 6.5, 5: 1.}
+
+    # recompute asums downstream of 1 and 2 as minor distributaries
+    results = recompute_asums_for_minor_distribs([1, 2], fl_lengths, graph, graph_r)
+    assert results == {1: 1., 2: 1.}
+
+
+def test_get_narwidth_statistics(preprocessed_flowlines, test_data_path):
+    fl = preprocessed_flowlines
+    narwidth_shapefile = os.path.join(test_data_path, 'NARwidth.shp')
+    nw = shp2df(narwidth_shapefile)
+    nw['geometry'] = project(nw.geometry, get_shapefile_crs(narwidth_shapefile), 5070)
+    buffdist = 1000
+
+    # sample the narwidths one flowline at a time
+    t0 = time.time()
+    results = intersect_rtree(nw.geometry.tolist(),
+                              [g.buffer(buffdist) for g in fl.geometry])
+    expected = []
+    for i, r in enumerate(results):
+        fl_g = fl.geometry.iloc[i]
+        append_narwidth = len(r) > 0
+        if append_narwidth and fl.asum_calc.iloc[i] < 500:
+            narwidth_line_buffered = MultiLineString(nw.loc[r, 'geometry'].tolist()).buffer(buffdist)
+            append_narwidth = fl_g.intersection(narwidth_line_buffered).length / fl_g.length > 0.5
+        if append_narwidth:
+            sampled_widths = nw.loc[r, 'width']
+            expected.append([len(r), sampled_widths.mean(), sampled_widths.std(),
+                             sampled_widths.min(), sampled_widths.max()])
+        else:
+            expected.append([np.nan] * 5)
+    expected = pd.DataFrame(expected, columns=['n', 'mean', 'std', 'min', 'max'], dtype=float)
+    loop_time = time.time() - t0
+
+    t0 = time.time()
+    results = get_narwidth_statistics(fl.geometry, fl.asum_calc, nw.geometry, nw.width,
+                                      buffdist=buffdist)
+    print("sampled NARWidth for {} flowlines in {:.2f}s (one at a time: {:.2f}s)".format(
+        len(fl), time.time() - t0, loop_time))
+    assert results.notnull().any().all()
+    pd.testing.assert_frame_equal(results, expected)
+
+
+def test_fix_invalid_asums_circular(tmpdir, capsys):
+    #  1   2
+    #   \ /
+    #    3 <-> 4      7 -> 5 -> 6
+    graph = {1: 3, 2: 3, 3: 4, 4: 3, 7: 5, 5: 6, 6: 0}
+    graph_r = make_graph(list(graph.values()), list(graph.keys()))
+    fl_lengths = {c: 1. for c in graph}
+    # break in asum continuity at 3 and 5
+    asums = {1: 1., 2: 1., 3: 1.5, 4: 2., 7: 1., 5: 0.5, 6: 3.}
+    # lines on the loop are fixed along the (length-limited) path downstream
+    # (same as checking each line in turn); the rest of the network is unaffected
+    logfile = os.path.join(tmpdir, 'sfrmaker.logger')
+    logger = Logger(logfile)
+    results = fix_invalid_asums(asums, fl_lengths, graph, graph_r, logger=logger)
+    assert results == {1: 1., 2: 1., 3: 9.5, 4: 10., 7: 1., 5: 2., 6: 4.5}
+    # only the number of lines on the loop is reported;
+    # the lines themselves are listed in the log file
+    assert '2 lines are on or downstream of loops\n' in capsys.readouterr().out
+    logger.f.close()
+    with open(logfile) as src:
+        assert '2 lines are on or downstream of loops: [3, 4]' in src.read()
@@ -0,0 +1,135 @@
+import operator
+import time
+import numpy as np
+import pytest
+from shapely.geometry import LineString, Polygon
+from sfrmaker.reaches import create_reaches, create_reaches_structured
+
+
+def make_grid_polygons(xedges, yedges, xul, yul, rotation=0.):
+    """Make cell polygons (in node number order) for a structured grid."""
+    theta = np.radians(rotation)
+
+    def to_world(x, y):
+        return (xul + x * np.cos(theta) + y * np.sin(theta),
+                yul + x * np.sin(theta) - y * np.cos(theta))
+
+    polygons = []
+    for i in range(len(yedges) - 1):
+        for j in range(len(xedges) - 1):
+            x0, x1 = xedges[j], xedges[j + 1]
+            y0, y1 = yedges[i], yedges[i + 1]
+            polygons.append(Polygon([to_world(x0, y0), to_world(x1, y0),
+                                     to_world(x1, y1), to_world(x0, y1)]))
+    return polygons
+
+
+def order_by_proximity(part, reach_geoms, reach_nodes):
+    """Original (quadratic) ordering of reaches in create_reaches,
+    by successively finding the closest remaining reach."""
+    from shapely.geometry import Point
+    reach_geoms = dict(enumerate(reach_geoms))
+    current_reach = Point(part.coords[0])
+    ordered_node_numbers = []
+    for i in range(len(reach_geoms)):
+        dist = {j: g.distance(current_reach) for j, g in reach_geoms.items()}
+        r = sorted(dist.items(), key=operator.itemgetter(1))[0][0]
+        current_reach = reach_geoms.pop(r)
+        ordered_node_numbers.append(reach_nodes[r])
+    return ordered_node_numbers
+
+
+def meandering_line(ncells, cellsize=100.):
+    """Make a meandering line that crosses ncells of a grid
+    with the given cell size, starting at the upper left corner."""
+    x = np.linspace(0.5, ncells, ncells * 4) * cellsize / 2
+    y = -(np.sin(x / (cellsize * 2)) + 1.1) * cellsize * 3
+    return LineString(zip(x, y))
+
+
+@pytest.mark.parametrize('ncells', (50, 200))
+def test_create_reaches_order(ncells):
+    cellsize = 100.
+    line = meandering_line(ncells, cellsize)
+    ncol = int(np.ceil(line.bounds[2] / cellsize))
+    xedges = np.arange(ncol + 1) * cellsize
+    yedges = np.arange(8) * cellsize
+    polygons = make_grid_polygons(xedges, yedges, 0., 0.)
+    nodes = [n for n, p in enumerate(polygons) if p.intersects(line)]
+    geoms, node_numbers = create_reaches(line, nodes, polygons)
+    assert node_numbers == order_by_proximity(line, geoms, node_numbers)
+    assert np.allclose(sum([g.length for g in geoms]), line.length)
+
+
+@pytest.mark.slow
+def test_create_reaches_benchmark():
+    """Scaling of the reach ordering in create_reaches with flowline length,
+    compared to the original ordering by proximity."""
+    cellsize = 100.
+    for ncells in 250, 500, 1000, 2000:
+        line = meandering_line(ncells, cellsize)
+        ncol = int(np.ceil(line.bounds[2] / cellsize))
+        xedges = np.arange(ncol + 1) * cellsize
+        yedges = np.arange(8) * cellsize
+        polygons = make_grid_polygons(xedges, yedges, 0., 0.)
+        nodes = [n for n, p in enumerate(polygons) if p.intersects(line)]
+        ta = time.time()
+        geoms, node_numbers = create_reaches(line, nodes, polygons)
+        t_create = time.time() - ta
+        ta = time.time()
+        node_numbers2 = order_by_proximity(line, geoms, node_numbers)
+        t_proximity = time.time() - ta
+        assert node_numbers2 == node_numbers
+        print('{} reaches: create_reaches {:.2f}s, ordering by proximity {:.2f}s'.format(
+            len(geoms), t_create, t_proximity))
+
+
+@pytest.mark.parametrize('rotation', (0., 30.))
+@pytest.mark.parametrize('xedges,yedges', (
+        (np.arange(0, 1100, 100.), np.arange(0, 1100, 100.)),
+        (np.cumsum([0, 50, 100, 150, 200, 50, 75, 100, 200, 75]),
+         np.cumsum([0, 200, 100, 50, 50, 150, 125, 125, 100]))))
+def test_create_reaches_structured(xedges, yedges, rotation):
+    xul, yul = 1000., 5000.
+    polygons = make_grid_polygons(xedges, yedges, xul, yul, rotation=rotation)
+    theta = np.radians(rotation)
+    # a meandering line in grid coordinates that leaves and re-enters cells
+    x = np.array([5, 120, 260, 240, 410, 555, 620, 602, 780, 890])
+    y = np.array([15, 80, 310, 420, 460, 380, 505, 640, 700, 760])
+    line = LineString(zip(xul + x * np.cos(theta) + y * np.sin(theta),
+                          yul + x * np.sin(theta) - y * np.cos(theta)))
+    nodes = [n for n, p in enumerate(polygons) if p.intersects(line)]
+    geoms, node_numbers = create_reaches(line, nodes, polygons, tol=0.001)
+    geoms2, node_numbers2 = create_reaches_structured(line, xedges, yedges,
+                                                      xul, yul, rotation)
+    assert node_numbers2 == node_numbers
+    assert np.allclose([g.length for g in geoms2],
+                       [g.length for g in geoms])
+    assert np.allclose(sum([g.length for g in geoms2]), line.length)
+
+
+@pytest.mark.parametrize('engine', ('rtree', 'structured'))
+def test_setup_reach_data_parallel(tylerforks_lines_from_NHDPlus,
+                                   tylerforks_sfrmaker_grid_from_flopy, engine):
+    lines = tylerforks_lines_from_NHDPlus
+    grid = tylerforks_sfrmaker_grid_from_flopy
+    rd = lines.intersect(grid, engine=engine)
+    rd2 = lines.intersect(grid, engine=engine, n_workers=2)
+    cols = ['node', 'rno', 'ireach', 'iseg', 'line_id']
+    assert rd[cols].equals(rd2[cols])
+    assert all([g1.equals(g2) for g1, g2 in zip(rd.geometry, rd2.geometry)])
+
+
+@pytest.mark.parametrize('tile_size,n_workers', ((10, None),
+                                                 ((25, 40), None),
+                                                 (20, 2)))
+def test_setup_reach_data_tiled(tylerforks_lines_from_NHDPlus,
+                                tylerforks_sfrmaker_grid_from_flopy,
+                                tile_size, n_workers):
+    lines = tylerforks_lines_from_NHDPlus
+    grid = tylerforks_sfrmaker_grid_from_flopy
+    rd = lines.intersect(grid, engine='strtree')
+    rd2 = lines.intersect(grid, tile_size=tile_size, n_workers=n_workers)
+    cols = ['node', 'k', 'i', 'j', 'rno', 'ireach', 'iseg', 'line_id', 'name']
+    assert rd[cols].equals(rd2[cols])
+    assert all([g1.equals(g2) for g1, g2 in zip(rd.geometry, rd2.geometry)])
@@ -1,9 +1,11 @@
+import time
 import numpy as np
+import pytest
 from sfrmaker.routing import make_graph, get_upsegs
 
 from ..checks import routing_is_circular, valid_nsegs
 from ..routing import (get_next_id_in_subset, renumber_segments, find_path,
-                       get_previous_ids_in_subset)
+                       get_previous_ids_in_subset, RoutingGraph, get_routing_digest)
 
 
 def add_line_sequence(routing, nlines=4):
@@ -26,6 +28,51 @@ def add_line_sequence(routing, nlines=4):
     return sequence
 
 
+def renumber_segments_by_level(nseg, outseg):
+    """Original (quadratic) version of renumber_segments,
+    which searches the whole outseg array for the segments upstream
+    of each segment."""
+    nseg = np.array(nseg)
+    outseg = np.array(outseg)
+
+    def reassign_upsegs(r, nexts, upsegs):
+        nextupsegs = []
+        for u in upsegs:
+            r[u] = nexts if u > 0 else u  # handle lakes
+            nexts -= 1
+            nextupsegs += list(nseg[outseg == u])
+        return r, nexts, nextupsegs
+
+    r = {0: 0}
+    r.update({o: 0 for o in outseg if o > 0 and o not in nseg})
+    outseg = np.array([o if o in nseg or o < 0 else 0 for o in outseg])
+    if len(nseg) != len(np.unique(nseg)):
+        d = dict(zip(nseg, outseg))
+        nseg, outseg = np.array(list(d.keys())), np.array(list(d.values()))
+    ns = len(nseg)
+    nexts = ns
+    nextupsegs = nseg[outseg == 0]
+    for i in range(ns):
+        r, nexts, nextupsegs = reassign_upsegs(r, nexts, nextupsegs)
+        if len(nextupsegs) == 0:
+            break
+    return r
+
+
+def random_network(nseg, seed=0):
+    """Make a random dendritic network with nseg segments,
+    numbered in random order."""
+    rng = np.random.RandomState(seed)
+    # each segment routes to one of the previous segments, or is an outlet
+    positions = np.arange(nseg)
+    outpositions = (rng.random_sample(nseg) * positions).astype(int)
+    outlets = (rng.random_sample(nseg) < 0.01) | (positions == 0)
+    numbers = rng.permutation(nseg) + 1
+    nseg = numbers
+    outseg = np.where(outlets, 0, numbers[outpositions])
+    return nseg, outseg
+
+
 def test_get_next_id_in_subset(shellmound_sfrdata):
     rd = shellmound_sfrdata.reach_data.copy()
     line_id = dict(zip(rd.iseg, rd.line_id))
@@ -91,6 +138,36 @@ def test_renumber_segments():
     assert valid_nsegs(nseg1, outseg1)
 
 
+@pytest.mark.parametrize('seed', range(5))
+def test_renumber_segments_order(seed):
+    nseg, outseg = random_network(500, seed=seed)
+    # add some lakes, and outsegs that aren't in nseg
+    outseg[10:15] = -1
+    outseg[20:25] = 1000
+    # and repeated segments (as in reach data)
+    nseg = np.append(nseg, nseg[:50])
+    outseg = np.append(outseg, outseg[:50])
+    assert renumber_segments(nseg, outseg) == renumber_segments_by_level(nseg, outseg)
+
+
+@pytest.mark.slow
+def test_renumber_segments_benchmark():
+    """Scaling of renumber_segments with the number of segments."""
+    for n in 10**4, 10**5, 10**6:
+        nseg, outseg = random_network(n)
+        ta = time.time()
+        r = renumber_segments(nseg, outseg)
+        t_renumber = time.time() - ta
+        nseg2 = [r[s] for s in nseg]
+        outseg2 = [r[s] for s in outseg]
+        assert valid_nsegs(nseg2, outseg2)
+        print('{} segments: {:.2f}s'.format(n, t_renumber))
+        if n == 10**4:
+            ta = time.time()
+            assert r == renumber_segments_by_level(nseg, outseg)
+            print('{} segments (original): {:.2f}s'.format(n, time.time() - ta))
+
+
 def test_get_upsegs(sfr_test_numbering):
     rd, sd = sfr_test_numbering
     graph = dict(zip(sd.nseg, sd.outseg))
@@ -112,3 +189,82 @@ def test_find_path():
     path = find_path(routing, start=1)
     assert path[0] == 1
     assert path[-1] == 0
+
+
+def test_routing_graph(sfr_test_numbering):
+    rd, sd = sfr_test_numbering
+    routing = dict(zip(sd.nseg, sd.outseg))
+    graph_r = make_graph(list(routing.values()),
+                         list(routing.keys()))
+    graph = RoutingGraph(routing)
+    assert not graph.is_circular
+    assert set(graph.outlets) == {s for s, o in routing.items() if o == 0}
+    assert set(graph.headwaters) == set(routing.keys()).difference(routing.values())
+
+    # paths and upstream sets should be the same as with the dictionary methods
+    assert len(graph.paths) == len(routing)
+    for s in sd.nseg:
+        assert graph.paths[s] == find_path(routing, s)
+        assert graph.get_upstream(s) == get_upsegs(graph_r, s)
+
+    # each segment should come before its outseg in the topological order
+    order = {s: i for i, s in enumerate(graph.topological_order)}
+    for s, o in routing.items():
+        if o != 0:
+            assert order[s] < order[o]
+
+    # first segment downstream in a subset
+    subset = set(sd.nseg[::2])
+    next_ids = graph.get_next_in_subset(subset)
+    for s in sd.nseg:
+        expected = [d for d in find_path(routing, s)[1:] if d in subset]
+        expected = expected[0] if len(expected) > 0 else None
+        assert next_ids[s] == expected
+
+
+def test_routing_graph_circular():
+    graph = RoutingGraph({1: 2, 2: 3, 3: 1, 4: 1, 5: 0})
+    assert graph.is_circular
+    assert routing_is_circular([1, 2, 3, 4, 5], [2, 3, 1, 1, 0])
+    # paths through a circular sequence are limited to the number of nodes
+    assert graph.paths[4] == find_path({1: 2, 2: 3, 3: 1, 4: 1, 5: 0}, 4)
+    with pytest.raises(ValueError):
+        graph.topological_order
+    # ids on or downstream of the loop are left out of the acyclic order
+    assert graph.acyclic_order.tolist() == [4, 5]
+    assert graph.circular_ids.tolist() == [1, 2, 3]
+
+
+def test_routing_graph_accumulate(sfr_test_numbering):
+    rd, sd = sfr_test_numbering
+    routing = dict(zip(sd.nseg, sd.outseg))
+    graph_r = make_graph(list(routing.values()),
+                         list(routing.keys()))
+    graph = RoutingGraph(routing)
+    values = dict(zip(sd.nseg, np.arange(len(sd)) + 1.))
+    sums = graph.accumulate(values)
+    minima = graph.accumulate(values, ufunc=np.minimum)
+    for s in sd.nseg:
+        upstream = list(get_upsegs(graph_r, s)) + [s]
+        assert sums[s] == np.sum([values[us] for us in upstream])
+        assert minima[s] == np.min([values[us] for us in upstream])
+    # ids outside of the network get the values of the outlets routing to them
+    assert graph.accumulate(values, ids=[0])[0] == np.sum(list(values.values()))
+
+
+def test_get_routing_digest():
+    import pandas as pd
+    df = pd.DataFrame({'id': [1, 2, 3], 'toid': [2, 3, 0]})
+    digest = get_routing_digest(df, ['id', 'toid'])
+    assert digest == get_routing_digest(df.copy(), ['id', 'toid'])
+    df.loc[1, 'toid'] = 0
+    assert get_routing_digest(df, ['id', 'toid']) != digest
+    # same values, different dtype
+    df.loc[1, 'toid'] = 3
+    assert get_routing_digest(df, ['id', 'toid']) == digest
+    assert get_routing_digest(df.astype(float), ['id', 'toid']) != digest
+    # lists of toids
+    df['toid'] = [[2, 3], [3], [0]]
+    digest = get_routing_digest(df, ['id', 'toid'])
+    df.loc[0, 'toid'].append(4)
+    assert get_routing_digest(df, ['id', 'toid']) != digest
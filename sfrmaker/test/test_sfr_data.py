@@ -178,6 +178,72 @@ def test_ibound_representation_of_idomain(shellmound_sfrdata, shellmound_model):
     assert np.array_equal(ibound, idomain)
 
 
+def test_routing_change_detection(shellmound_sfrdata, monkeypatch):
+    sfrdata = shellmound_sfrdata
+    paths = sfrdata.paths
+    reach_paths = sfrdata.reach_paths
+    segment_routing = sfrdata.segment_routing
+
+    # unchanged routing is only checked in full once
+    calls = []
+    rno_nseg_routing_consistent = sfrmaker.sfrdata.rno_nseg_routing_consistent
+
+    def counted_check(*args, **kwargs):
+        calls.append(1)
+        return rno_nseg_routing_consistent(*args, **kwargs)
+    monkeypatch.setattr(sfrmaker.sfrdata, 'rno_nseg_routing_consistent', counted_check)
+    for i in range(10):
+        assert sfrdata.paths is paths
+        assert sfrdata.reach_paths is reach_paths
+        assert sfrdata.segment_routing is segment_routing
+    assert len(calls) <= 1
+
+    # edits to the routing columns are detected
+    sd = sfrdata.segment_data
+    seg = sd.loc[(sd.per == 0) & (sd.outseg > 0), 'nseg'].values[0]
+    sd.loc[(sd.per == 0) & (sd.nseg == seg), 'outseg'] = 0
+    assert sfrdata.segment_routing[seg] == 0
+    rd = sfrdata.reach_data
+    rd.loc[rd.outreach > 0, 'outreach'] = 0
+    assert sfrdata._routing_changed()
+
+
+def test_update_from_lines(tylerforks_model, tylerforks_lines_from_NHDPlus,
+                           tylerforks_sfrmaker_grid_from_flopy):
+    from shapely.affinity import translate
+    m = tylerforks_model
+    grid = tylerforks_sfrmaker_grid_from_flopy
+    lines = tylerforks_lines_from_NHDPlus
+    # to_sfr reprojects the lines to the grid CRS in place
+    df = lines.df.copy()
+    crs = lines.crs
+    sfrdata = lines.to_sfr(grid=grid, model=m)
+
+    # edit the lines: remove a headwater line, move another,
+    # and route a third line to an outlet
+    line_ids = sfrdata.reach_data.line_id.unique()
+    headwaters = [i for i in line_ids if i not in set(np.ravel(df.toid.tolist()))]
+    removed = headwaters[0]
+    moved, rerouted = [i for i in line_ids if i != removed][:2]
+    df = df.loc[df.id != removed].copy()
+    df['geometry'] = [translate(g, xoff=0.0005) if i == moved else g
+                      for i, g in zip(df.id, df.geometry)]
+    df['toid'] = [[0] if i == rerouted else toid for i, toid in zip(df.id, df.toid)]
+
+    def edited_lines():
+        return sfrmaker.Lines(df.copy(), attr_length_units=lines.attr_length_units,
+                              attr_height_units=lines.attr_height_units, crs=crs)
+
+    updated = sfrdata.update_from_lines(edited_lines(), changed_ids=[moved])
+    rebuilt = edited_lines().to_sfr(grid=grid, model=m)
+    assert removed not in set(updated.reach_data.line_id)
+    cols = [c for c in rebuilt.reach_data.columns if c != 'geometry']
+    pd.testing.assert_frame_equal(updated.reach_data[cols], rebuilt.reach_data[cols])
+    assert all([g1.equals(g2) for g1, g2 in zip(updated.reach_data.geometry,
+                                                rebuilt.reach_data.geometry)])
+    pd.testing.assert_frame_equal(updated.segment_data, rebuilt.segment_data)
+
+
 @pytest.mark.xfail(version.parse(flopy.__version__) <= version.parse('3.3.0'),
                    reason="")
 def test_write_mf6_package(shellmound_sfrdata, mf6sfr, outdir):
@@ -245,6 +311,26 @@ def test_write_mf6_package(shellmound_sfrdata, mf6sfr, outdir):
                                   check_dtype=False)
 
 
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_write_tables(shellmound_sfrdata, outdir, file_format):
+    if file_format != 'csv':
+        pytest.importorskip('pyarrow')
+    sfrdata = shellmound_sfrdata
+    sfrdata.write_tables(os.path.join(outdir, 'tables'), file_format=file_format)
+    reach_data_file = os.path.join(outdir, 'tables_sfr_reach_data.{}'.format(file_format))
+    segment_data_file = os.path.join(outdir, 'tables_sfr_segment_data.{}'.format(file_format))
+    sfrdata2 = sfrmaker.SFRData.from_tables(reach_data_file, segment_data_file,
+                                            grid=sfrdata.grid)
+    cols = ['rno', 'node', 'iseg', 'ireach', 'outreach', 'rchlen', 'strtop']
+    pd.testing.assert_frame_equal(sfrdata2.reach_data[cols].reset_index(drop=True),
+                                  sfrdata.reach_data[cols].reset_index(drop=True),
+                                  check_dtype=False)
+    if file_format != 'csv':
+        assert sfrdata2.reach_data.geometry.values[0].equals(sfrdata.reach_data.geometry.values[0])
+    with pytest.raises(ValueError):
+        sfrdata.write_tables(os.path.join(outdir, 'tables'), file_format='xlsx')
+
+
 @pytest.mark.parametrize('kwargs', [{'rno': 1},  # specified reach(es)
                                     {'segments': 1},  # specified segment(s)
                                     {'line_ids': 17955471},  # specified line numbers in source hydrography
@@ -50,6 +50,14 @@ def test_asum(sfr_test_numbering):
     asum = arbolate_sum(sd.nseg, lengths, graph)
     assert (asum[1] == 6) & (asum[2] == np.arange(len(sd)).sum())
 
+    # results for the whole network should be the same
+    # as for individual segments (computed by searching upstream)
+    starting_asums = {3: 10., 5: 100.}
+    asum = arbolate_sum(sd.nseg, lengths, graph, starting_asums=starting_asums)
+    for s in sd.nseg:
+        expected = arbolate_sum(s, lengths, graph, starting_asums=starting_asums)
+        assert np.allclose(asum[s], expected[s])
+
 
 def test_make_config_summary():
     results = make_config_summary()
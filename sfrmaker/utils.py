@@ -7,7 +7,7 @@ import pprint
 import numpy as np
 import flopy
 import sfrmaker
-from sfrmaker.routing import get_upsegs, make_graph
+from sfrmaker.routing import get_upsegs, make_graph, RoutingGraph
 from sfrmaker.units import convert_length_units
 
 unit_conversion = {'feetmeters': 0.3048,
@@ -152,9 +152,24 @@ def arbolate_sum(segment, lengths, routing, starting_asums=None):
     -------
     asum : float or dict
         Arbolate sums for each segment.
+
+    Notes
+    -----
+    If more than one segment is requested, arbolate sums are computed
+    for the whole network in one pass (see :meth:`sfrmaker.routing.RoutingGraph.accumulate`),
+    instead of searching upstream from each segment.
     """
     if np.isscalar(segment):
         segment = [segment]
+    if len(segment) > 1:
+        graph = RoutingGraph(routing)
+        if not graph.is_circular:
+            values = dict(lengths)
+            if starting_asums is not None:
+                for s, starting_asum in starting_asums.items():
+                    values[s] = values.get(s, 0.) + starting_asum
+            return graph.accumulate(values, ids=segment)
+
     graph_r = make_graph(list(routing.values()), list(routing.keys()))
 
     asum = {}